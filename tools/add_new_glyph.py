@@ -1,4 +1,7 @@
 # encoding: utf8
+# needs catalogue.py to be installed next to this script
+from catalogue import Catalogue
+
 def addCharacters(crap, font):
     text = fontforge.askString("Add charcter", u"model new mark₁ mark₂ ...")
     text = text.split()
@@ -8,9 +11,11 @@ def addCharacters(crap, font):
         addCharacter(font, text[0], text[1], text[2:])
 
 def addCharacter(font, model, new, marks):
+    catalogue = Catalogue(font)
     names = []
-    for glyph in font.glyphs():
-        if (glyph.glyphname == model) or (model+"." in glyph.glyphname):
+    for name in [model] + catalogue.variantsOf(model):
+        if name in font:
+            glyph = font[name]
             for ref in glyph.references:
                 if (font[ref[0]].glyphclass == "baseglyph") or (font[ref[0]].glyphclass == "automatic"):
                     names.append((glyph.glyphname, ref[0], glyph.anchorPoints))
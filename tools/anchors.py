@@ -0,0 +1,342 @@
+# coding=utf-8
+#
+# anchors.py - Compile anchor classes straight into GPOS lookups
+#
+# To the extent possible under law, the author have dedicated all copyright
+# and related and neighboring rights to this software to the public domain
+# worldwide. This software is distributed without any warranty.
+#
+# You should have received a copy of the CC0 Public Domain Dedication along
+# with this software. If not, see
+# <http://creativecommons.org/publicdomain/zero/1.0/>.
+
+"""Instead of turning the thousands of mark anchors into feature file text
+and having FontForge parse it again, the anchor data is read from the font
+before its anchor lookups are removed, and after the font is generated the
+cursive, mark-to-base, mark-to-ligature and mark-to-mark lookups are built
+with fontTools and put in place of a placeholder lookup that the feature file
+has where the generated anchor features used to be inserted, so that lookup
+order (kerning before mark positioning) is kept."""
+
+import fontTools.subset # adds subset_lookups() to the layout tables
+from fontTools.otlLib import builder as otl
+from fontTools.ttLib import TTFont
+from fontTools.ttLib.tables import otTables as ot
+
+from layoutcache import saveFont
+
+ANCHOR_LOOKUPS = ("gpos_cursive", "gpos_mark2base", "gpos_mark2ligature", "gpos_mark2mark")
+
+FLAGS = {
+    "right_to_left": 0x1,
+    "ignore_bases": 0x2,
+    "ignore_ligatures": 0x4,
+    "ignore_marks": 0x8,
+}
+
+# A lookup we can find again in the compiled font, dummy1 is never positioned
+# by the feature file.
+PLACEHOLDER_GLYPH = "dummy1"
+PLACEHOLDER = """
+feature mark {
+  lookup AnchorsPlaceholder {
+    pos %s 1;
+  } AnchorsPlaceholder;
+} mark;
+""" % PLACEHOLDER_GLYPH
+
+def collectAnchorLookups(font):
+    """Returns (lookups, anchors) for the anchor lookups of a FontForge font.
+    lookups is a list of (name, type, flag, features, subtables) in font
+    order, where subtables is the list of anchor class names of each
+    subtable, and anchors is {class: {anchor type: {glyph: (x, y)}}}, with
+    ligature anchors being {glyph: {component: (x, y)}}.
+
+    Returns None if the lookups use anything we don't compile directly (mark
+    attachment classes or mark filtering sets)."""
+
+    lookups = []
+    classes = set()
+    for lookup in font.gpos_lookups:
+        ltype, flags, features = font.getLookupInfo(lookup)[:3]
+        if ltype not in ANCHOR_LOOKUPS:
+            continue
+
+        flag = 0
+        for name in flags:
+            if name not in FLAGS:
+                return None
+            flag |= FLAGS[name]
+
+        subtables = []
+        for subtable in font.getLookupSubtables(lookup):
+            names = tuple(font.getLookupSubtableAnchorClasses(subtable))
+            subtables.append(names)
+            classes.update(names)
+
+        lookups.append((lookup, ltype, flag, features, subtables))
+
+    anchors = {}
+    for glyph in font.glyphs():
+        for anchor in glyph.anchorPoints:
+            name, kind = anchor[0], anchor[1]
+            if name not in classes:
+                continue
+            point = (int(round(anchor[2])), int(round(anchor[3])))
+            points = anchors.setdefault(name, {}).setdefault(kind, {})
+            if kind == "ligature":
+                points.setdefault(glyph.glyphname, {})[anchor[4]] = point
+            else:
+                points[glyph.glyphname] = point
+
+    # a mark can belong to only one class of each subtable
+    for lookup in lookups:
+        for names in lookup[4]:
+            seen = set()
+            for name in names:
+                marks = set(anchors.get(name, {}).get("mark", {}))
+                if marks & seen:
+                    return None
+                seen |= marks
+
+    return lookups, anchors
+
+def buildAnchor(point):
+    return otl.buildAnchor(point[0], point[1])
+
+def buildMarks(names, anchors, glyphMap):
+    marks = {}
+    for index, name in enumerate(names):
+        for glyph, point in anchors.get(name, {}).get("mark", {}).items():
+            if glyph in glyphMap:
+                marks[glyph] = (index, buildAnchor(point))
+    return marks
+
+def buildBases(names, anchors, kind, glyphMap):
+    bases = {}
+    for index, name in enumerate(names):
+        for glyph, point in anchors.get(name, {}).get(kind, {}).items():
+            if glyph in glyphMap:
+                bases.setdefault(glyph, {})[index] = buildAnchor(point)
+    return bases
+
+def buildCursive(names, anchors, glyphMap):
+    attach = {}
+    for name in names:
+        points = anchors.get(name, {})
+        for kind, position in (("entry", 0), ("exit", 1)):
+            for glyph, point in points.get(kind, {}).items():
+                if glyph in glyphMap:
+                    attach.setdefault(glyph, [None, None])[position] = buildAnchor(point)
+    if not attach:
+        return None
+    return otl.buildCursivePosSubtable(dict((g, tuple(a)) for g, a in attach.items()), glyphMap)
+
+def buildMarkMark(marks, bases, classCount, glyphMap):
+    st = ot.MarkMarkPos()
+    st.Format = 1
+    st.ClassCount = classCount
+    st.Mark1Coverage = otl.buildCoverage(marks, glyphMap)
+    st.Mark1Array = otl.buildMarkArray(marks, glyphMap)
+    st.Mark2Coverage = otl.buildCoverage(bases, glyphMap)
+    st.Mark2Array = ot.Mark2Array()
+    st.Mark2Array.Mark2Record = []
+    for glyph in st.Mark2Coverage.glyphs:
+        record = ot.Mark2Record()
+        record.Mark2Anchor = [bases[glyph].get(i) for i in range(classCount)]
+        st.Mark2Array.Mark2Record.append(record)
+    st.Mark2Array.Mark2Count = len(st.Mark2Array.Mark2Record)
+    return st
+
+def buildSubtable(ltype, names, anchors, glyphMap):
+    if ltype == "gpos_cursive":
+        return buildCursive(names, anchors, glyphMap)
+
+    marks = buildMarks(names, anchors, glyphMap)
+    if ltype == "gpos_mark2base":
+        bases = buildBases(names, anchors, "base", glyphMap)
+        if marks and bases:
+            return otl.buildMarkBasePosSubtable(marks, bases, glyphMap)
+    elif ltype == "gpos_mark2mark":
+        bases = buildBases(names, anchors, "basemark", glyphMap)
+        if marks and bases:
+            return buildMarkMark(marks, bases, len(names), glyphMap)
+    elif ltype == "gpos_mark2ligature":
+        ligatures = {}
+        for index, name in enumerate(names):
+            for glyph, components in anchors.get(name, {}).get("ligature", {}).items():
+                if glyph in glyphMap:
+                    for component, point in components.items():
+                        ligature = ligatures.setdefault(glyph, [])
+                        while len(ligature) <= component:
+                            ligature.append({})
+                        ligature[component][index] = buildAnchor(point)
+        if marks and ligatures:
+            return otl.buildMarkLigPosSubtable(marks, ligatures, glyphMap)
+
+    return None
+
+def findLangSys(table, script, lang):
+    """Returns the LangSys of script/lang, creating it if missing."""
+
+    def newLangSys():
+        langsys = ot.LangSys()
+        langsys.LookupOrder = None
+        langsys.ReqFeatureIndex = 0xFFFF
+        langsys.FeatureIndex = []
+        langsys.FeatureCount = 0
+        return langsys
+
+    records = table.ScriptList.ScriptRecord
+    for record in records:
+        if record.ScriptTag == script:
+            break
+    else:
+        record = ot.ScriptRecord()
+        record.ScriptTag = script
+        record.Script = ot.Script()
+        record.Script.DefaultLangSys = None
+        record.Script.LangSysRecord = []
+        record.Script.LangSysCount = 0
+        records.append(record)
+        records.sort(key=lambda r: r.ScriptTag)
+        table.ScriptList.ScriptCount = len(records)
+
+    if lang == "dflt":
+        if record.Script.DefaultLangSys is None:
+            record.Script.DefaultLangSys = newLangSys()
+        return record.Script.DefaultLangSys
+
+    for langrecord in record.Script.LangSysRecord:
+        if langrecord.LangSysTag == lang:
+            return langrecord.LangSys
+
+    langrecord = ot.LangSysRecord()
+    langrecord.LangSysTag = lang
+    langrecord.LangSys = newLangSys()
+    record.Script.LangSysRecord.append(langrecord)
+    record.Script.LangSysRecord.sort(key=lambda r: r.LangSysTag)
+    record.Script.LangSysCount = len(record.Script.LangSysRecord)
+    return langrecord.LangSys
+
+def allLangSys(table):
+    for record in table.ScriptList.ScriptRecord:
+        if record.Script.DefaultLangSys is not None:
+            yield record.Script.DefaultLangSys
+        for langrecord in record.Script.LangSysRecord:
+            yield langrecord.LangSys
+
+def addFeatureLookups(table, additions):
+    """Adds lookups to features, additions being {(script, lang): {tag:
+    [lookup indices]}}. Shapers only look at the first feature with a given
+    tag in a language system, so the feature list is rebuilt with a single
+    feature per tag in each language system, shared between the language
+    systems that end up with the same lookups, and sorted by tag as the
+    specification asks."""
+
+
+    for script, lang in additions:
+        findLangSys(table, script, lang)
+
+    old = table.FeatureList.FeatureRecord
+    records = []
+    shared = {}
+    def featureIndex(tag, lookups, params):
+        key = (tag, tuple(lookups), id(params))
+        if key not in shared:
+            record = ot.FeatureRecord()
+            record.FeatureTag = tag
+            record.Feature = ot.Feature()
+            record.Feature.FeatureParams = params
+            record.Feature.LookupListIndex = list(lookups)
+            record.Feature.LookupCount = len(lookups)
+            shared[key] = len(records)
+            records.append(record)
+        return shared[key]
+
+    for record in table.ScriptList.ScriptRecord:
+        langsystems = [("dflt", record.Script.DefaultLangSys)]
+        langsystems += [(r.LangSysTag, r.LangSys) for r in record.Script.LangSysRecord]
+        for lang, langsys in langsystems:
+            if langsys is None:
+                continue
+
+            tags = []
+            features = {}
+            for index in langsys.FeatureIndex:
+                feature = old[index]
+                if feature.FeatureTag not in features:
+                    tags.append(feature.FeatureTag)
+                    features[feature.FeatureTag] = (set(), feature.Feature.FeatureParams)
+                features[feature.FeatureTag][0].update(feature.Feature.LookupListIndex)
+            for tag, lookups in additions.get((record.ScriptTag, lang), {}).items():
+                if tag not in features:
+                    tags.append(tag)
+                    features[tag] = (set(), None)
+                features[tag][0].update(lookups)
+
+            langsys.FeatureIndex = [featureIndex(tag, sorted(features[tag][0]), features[tag][1]) for tag in tags]
+            if langsys.ReqFeatureIndex != 0xFFFF:
+                feature = old[langsys.ReqFeatureIndex]
+                langsys.ReqFeatureIndex = featureIndex(feature.FeatureTag, feature.Feature.LookupListIndex, feature.Feature.FeatureParams)
+
+    order = sorted(range(len(records)), key=lambda i: records[i].FeatureTag)
+    remap = dict((old, new) for new, old in enumerate(order))
+    table.FeatureList.FeatureRecord = [records[i] for i in order]
+    table.FeatureList.FeatureCount = len(records)
+    for langsys in allLangSys(table):
+        langsys.FeatureIndex = sorted(remap[i] for i in langsys.FeatureIndex)
+        langsys.FeatureCount = len(langsys.FeatureIndex)
+        if langsys.ReqFeatureIndex != 0xFFFF:
+            langsys.ReqFeatureIndex = remap[langsys.ReqFeatureIndex]
+
+def insertAnchorLookups(ttfont, lookups, anchors):
+    """Builds the anchor lookups and puts them in the GPOS table of a
+    compiled font in place of the placeholder lookup."""
+
+    gpos = ttfont["GPOS"]
+    table = gpos.table
+    glyphMap = ttfont.getReverseGlyphMap()
+
+    placeholder = None
+    for index, lookup in enumerate(table.LookupList.Lookup):
+        subtables = lookup.SubTable
+        if lookup.LookupType == 9:
+            subtables = [st.ExtSubTable for st in subtables]
+        if len(subtables) == 1 and subtables[0].LookupType == 1 and \
+           subtables[0].Coverage.glyphs == [PLACEHOLDER_GLYPH]:
+            placeholder = index
+            break
+    if placeholder is None:
+        raise ValueError("anchors placeholder lookup not found in the GPOS table")
+
+    new = []
+    for name, ltype, flag, features, subtables in lookups:
+        built = [buildSubtable(ltype, names, anchors, glyphMap) for names in subtables]
+        built = [st for st in built if st is not None]
+        if built:
+            new.append((otl.buildLookup(built, flags=flag), features))
+
+    # append the new lookups, then move them to where the placeholder is
+    count = len(table.LookupList.Lookup)
+    table.LookupList.Lookup += [lookup for lookup, features in new]
+    table.LookupList.LookupCount = len(table.LookupList.Lookup)
+    order = list(range(placeholder)) + list(range(count, count + len(new))) + list(range(placeholder + 1, count))
+    gpos.subset_lookups(order)
+
+    # and register them with their features
+    additions = {}
+    for index, (lookup, features) in enumerate(new):
+        for tag, scripts in features:
+            for script, langs in scripts:
+                for lang in langs:
+                    additions.setdefault((script, lang), {}).setdefault(tag, []).append(placeholder + index)
+    addFeatureLookups(table, additions)
+
+def compileAnchors(fontfile, lookups, anchors):
+    """Puts the anchor lookups into a font generated with the placeholder
+    lookup in its features."""
+
+    ttfont = TTFont(fontfile)
+    insertAnchorLookups(ttfont, lookups, anchors)
+    saveFont(ttfont, fontfile)
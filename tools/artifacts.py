@@ -0,0 +1,322 @@
+#!/usr/bin/env python3
+# coding=utf-8
+#
+# artifacts.py - Content addressed cache of pipeline outputs
+#
+# To the extent possible under law, the author have dedicated all copyright
+# and related and neighboring rights to this software to the public domain
+# worldwide. This software is distributed without any warranty.
+#
+# You should have received a copy of the CC0 Public Domain Dedication along
+# with this software. If not, see
+# <http://creativecommons.org/publicdomain/zero/1.0/>.
+
+"""Stores the outputs of pipeline stages under a key made from everything
+that can change them: the bytes of every input file (source directories are
+keyed by their glyph file hashes, see sfdcache.py), the command line, and the
+versions of the tools it runs. A stage whose key is already in the store gets
+its outputs copied out of it instead of being run, whichever branch or
+checkout stored them.
+
+A store is either a directory, which can be shared, or the URL of a server
+started with:
+
+    artifacts.py serve DIR [--port 8765]
+
+Either way it holds objects/XX/SHA1 (output file contents) and actions/KEY
+(a JSON manifest mapping output paths to object hashes)."""
+
+from __future__ import print_function
+
+import argparse
+import hashlib
+import json
+import os
+import subprocess
+import sys
+
+try:
+    from urllib.request import Request, urlopen
+    from urllib.error import HTTPError, URLError
+    from http.server import BaseHTTPRequestHandler, HTTPServer
+except ImportError:
+    from urllib2 import Request, urlopen, HTTPError, URLError
+    from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+
+import sfdcache
+
+FORMAT = 1
+
+# Printed by an interpreter running a stage, on top of its own version.
+VERSION_SCRIPT = """
+import sys
+print(sys.version)
+try:
+    import fontTools
+    print("fontTools " + fontTools.version)
+except ImportError:
+    pass
+try:
+    from sortsmill import ffcompat as fontforge
+    print("fontforge " + str(fontforge.version()))
+except ImportError:
+    pass
+"""
+
+versions = {}
+
+def hashBytes(data):
+    return hashlib.sha1(data).hexdigest()
+
+def readFile(path):
+    with open(path, "rb") as f:
+        return f.read()
+
+def hashInput(path, cachedir=None):
+    """Hash of an input file or directory, a missing input has a fixed
+    hash so that it is still part of the key."""
+
+    if os.path.isdir(path):
+        if path.endswith(".sfdir") and cachedir:
+            try:
+                return sfdcache.sourceDigest(path, cachedir)
+            except ValueError:
+                pass
+        key = hashlib.sha1()
+        for root, dirs, files in os.walk(path):
+            dirs.sort()
+            for name in sorted(files):
+                filename = os.path.join(root, name)
+                key.update(("%s %s\n" % (os.path.relpath(filename, path),
+                            hashBytes(readFile(filename)))).encode("utf-8"))
+        return key.hexdigest()
+    if os.path.exists(path):
+        return hashBytes(readFile(path))
+    return "missing"
+
+def toolVersion(executable):
+    """Version of a program, Python interpreters also report the versions of
+    fontTools and FontForge they would use. Remembered per program."""
+
+    if executable not in versions:
+        if os.path.basename(executable).startswith("python"):
+            command = [executable, "-c", VERSION_SCRIPT]
+        else:
+            command = [executable, "--version"]
+        try:
+            output = subprocess.check_output(command, stderr=subprocess.STDOUT)
+        except (OSError, subprocess.CalledProcessError):
+            output = b""
+        versions[executable] = output.decode("utf-8", "replace").strip()
+    return versions[executable]
+
+def actionKey(command, inputs, cachedir=None):
+    """The key of running command (an argument list) on inputs."""
+
+    key = hashlib.sha1()
+    key.update(("format %d\n" % FORMAT).encode("utf-8"))
+    key.update(("tool %s\n" % toolVersion(command[0])).encode("utf-8"))
+    key.update(("command %s\n" % json.dumps(command)).encode("utf-8"))
+    for path in sorted(set(inputs)):
+        key.update(("input %s %s\n" % (path, hashInput(path, cachedir))).encode("utf-8"))
+    return key.hexdigest()
+
+class DirectoryStore(object):
+    """A store in a local or shared directory."""
+
+    def __init__(self, directory):
+        self.directory = directory
+        self.location = directory
+
+    def path(self, kind, name):
+        if kind == "objects":
+            return os.path.join(self.directory, kind, name[:2], name[2:])
+        return os.path.join(self.directory, kind, name)
+
+    def get(self, kind, name):
+        try:
+            return readFile(self.path(kind, name))
+        except (IOError, OSError):
+            return None
+
+    def has(self, kind, name):
+        return os.path.exists(self.path(kind, name))
+
+    def put(self, kind, name, data):
+        path = self.path(kind, name)
+        directory = os.path.dirname(path)
+        if not os.path.isdir(directory):
+            try:
+                os.makedirs(directory)
+            except OSError:
+                # made by a concurrent writer
+                if not os.path.isdir(directory):
+                    raise
+        tmp = "%s.%d.tmp" % (path, os.getpid())
+        with open(tmp, "wb") as f:
+            f.write(data)
+        os.rename(tmp, path)
+
+class HTTPStore(object):
+    """A store behind a server started with ‘artifacts.py serve’. Errors
+    talking to it are reported once and then treated as cache misses."""
+
+    def __init__(self, url):
+        self.url = url.rstrip("/")
+        self.location = url
+        self.failed = False
+
+    def request(self, method, kind, name, data=None):
+        if self.failed:
+            return None
+        request = Request("%s/%s/%s" % (self.url, kind, name), data=data)
+        request.get_method = lambda: method
+        try:
+            response = urlopen(request, timeout=30)
+            return response.read()
+        except HTTPError as e:
+            if e.code == 404:
+                return None
+            error = e
+        except (URLError, IOError, OSError) as e:
+            error = e
+        print("   CACHE\t%s unavailable (%s), not using it" % (self.url, error))
+        self.failed = True
+        return None
+
+    def get(self, kind, name):
+        return self.request("GET", kind, name)
+
+    def has(self, kind, name):
+        return self.request("HEAD", kind, name) is not None
+
+    def put(self, kind, name, data):
+        self.request("PUT", kind, name, data)
+
+# URL scheme -> store class, anything else is a directory
+BACKENDS = {
+    "http": HTTPStore,
+    "https": HTTPStore,
+}
+
+def openStore(location):
+    scheme = location.split("://", 1)[0] if "://" in location else None
+    if scheme in BACKENDS:
+        return BACKENDS[scheme](location)
+    return DirectoryStore(location)
+
+def restore(store, key, outputs):
+    """Writes the stored outputs of the action key, returns False if it is
+    not in the store (or any of its objects is missing)."""
+
+    data = store.get("actions", key)
+    if data is None:
+        return False
+    try:
+        manifest = json.loads(data.decode("utf-8"))
+    except ValueError:
+        return False
+    if sorted(manifest.get("outputs", {})) != sorted(outputs):
+        return False
+
+    contents = {}
+    for path, digest in manifest["outputs"].items():
+        content = store.get("objects", digest)
+        if content is None or hashBytes(content) != digest:
+            return False
+        contents[path] = content
+
+    for path, content in contents.items():
+        directory = os.path.dirname(path)
+        if directory and not os.path.isdir(directory):
+            os.makedirs(directory)
+        tmp = "%s.%d.tmp" % (path, os.getpid())
+        with open(tmp, "wb") as f:
+            f.write(content)
+        os.rename(tmp, path)
+    return True
+
+def save(store, key, outputs):
+    """Stores the outputs of the action key, objects first so that a
+    manifest never refers to missing objects."""
+
+    manifest = {"outputs": {}}
+    for path in outputs:
+        content = readFile(path)
+        digest = hashBytes(content)
+        if not store.has("objects", digest):
+            store.put("objects", digest, content)
+        manifest["outputs"][path] = digest
+    store.put("actions", key, json.dumps(manifest, indent=1, sort_keys=True).encode("utf-8"))
+
+def makeHandler(store):
+    class Handler(BaseHTTPRequestHandler):
+        def target(self):
+            parts = self.path.strip("/").split("/")
+            if len(parts) != 2 or parts[0] not in ("objects", "actions"):
+                return None
+            kind, name = parts
+            if not name or not all(c in "0123456789abcdef" for c in name):
+                return None
+            return kind, name
+
+        def reply(self, code, data=b""):
+            self.send_response(code)
+            self.send_header("Content-Length", str(len(data)))
+            self.end_headers()
+            if self.command != "HEAD":
+                self.wfile.write(data)
+
+        def do_GET(self):
+            target = self.target()
+            data = target and store.get(*target)
+            if data is None:
+                self.reply(404)
+            else:
+                self.reply(200, data)
+
+        do_HEAD = do_GET
+
+        def do_PUT(self):
+            target = self.target()
+            if target is None:
+                self.reply(400)
+                return
+            length = int(self.headers.get("Content-Length", 0))
+            data = self.rfile.read(length)
+            kind, name = target
+            if kind == "objects" and hashBytes(data) != name:
+                self.reply(400)
+                return
+            store.put(kind, name, data)
+            self.reply(201)
+
+    return Handler
+
+def serve(args):
+    server = HTTPServer((args.bind, args.port), makeHandler(DirectoryStore(args.directory)))
+    print("Serving %s on http://%s:%d/" % (args.directory, args.bind, args.port))
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+
+def main():
+    parser = argparse.ArgumentParser(description="Serve an artifact cache directory over HTTP.")
+    subparsers = parser.add_subparsers(dest="action")
+    parser_serve = subparsers.add_parser("serve", help="serve a cache directory to other builds")
+    parser_serve.add_argument("directory", metavar="DIR", help="cache directory")
+    parser_serve.add_argument("--port", metavar="PORT", type=int, default=8765, help="port to listen on (default: 8765)")
+    parser_serve.add_argument("--bind", metavar="ADDRESS", default="127.0.0.1",
+            help="address to listen on (default: 127.0.0.1)")
+
+    args = parser.parse_args()
+
+    if args.action == "serve":
+        serve(args)
+    else:
+        parser.print_help()
+        sys.exit(1)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,299 @@
+#!/usr/bin/env python3
+# coding=utf-8
+#
+# benchmark.py - Timing and memory benchmark of the build stages
+#
+# To the extent possible under law, the author have dedicated all copyright
+# and related and neighboring rights to this software to the public domain
+# worldwide. This software is distributed without any warranty.
+#
+# You should have received a copy of the CC0 Public Domain Dedication along
+# with this software. If not, see
+# <http://creativecommons.org/publicdomain/zero/1.0/>.
+
+"""Runs every stage of the pipeline (feapp.py, build.py,
+makeclr.py and makeweb.py) for each of the fonts several times on the
+checked-in sources, and records the median and spread of the wall time, CPU
+time and peak RSS of each stage, e.g.:
+
+    benchmark.py --version 0.109 --save baseline.json
+    (change something)
+    benchmark.py --version 0.109 --baseline baseline.json --threshold 5
+
+Outputs go to a scratch directory, and build.py runs without its caches so
+that every run does the same work. With --baseline, the results are compared
+to a previous --save and the exit status is 1 if any stage got slower or
+bigger by more than the threshold."""
+
+from __future__ import print_function
+
+import argparse
+import json
+import os
+import platform
+import subprocess
+import sys
+import time
+
+import pipeline
+from pipeline import NAME, SRC, FF, PY, VARIANTS, SLANT, Stage, tool, fontFile
+
+FORMAT = 1
+
+# (key, label, unit), times are in seconds, memory in MiB
+METRICS = (
+    ("wall", "wall", "s"),
+    ("cpu", "cpu", "s"),
+    ("rss", "peak rss", "MiB"),
+)
+
+# changes smaller than this (in seconds or MiB) are noise however big they
+# are relative to the baseline
+NOISE = {"wall": 0.05, "cpu": 0.05, "rss": 1.0}
+
+def makeStages(version, work):
+    """The pipeline stages for all the fonts, writing to the work directory."""
+
+    web = os.path.join(work, "web")
+    stages = []
+    fonts = []
+    for style, source, latin, kind, defines in VARIANTS:
+        pp = os.path.join(work, "%s-%s.fea.pp" % (NAME, style))
+        command = [PY, tool("feapp.py"), "-I" + SRC] + ["-D" + d for d in defines] + \
+                  [os.path.join(SRC, NAME + ".fea"), "-o", pp]
+        stages.append(Stage("feapp " + style, "feapp", command, [], [pp]))
+
+        font = os.path.join(work, fontFile(style))
+        command = [FF, tool("build.py"), "--input", os.path.join(SRC, "%s-%s.sfdir" % (NAME, source)),
+                   "--output", font, "--features=" + pp, "--version", version]
+        if kind == "quran":
+            command.append("--quran")
+        elif kind == "slanted":
+            command.append("--slant=%s" % SLANT)
+        stages.append(Stage("build " + style, "build", command, [pp], [font]))
+        fonts.append(font)
+
+    quran = os.path.join(work, fontFile("quran"))
+    colored = os.path.join(work, fontFile("quran-colored"))
+    stages.append(Stage("makeclr quran-colored", "makeclr",
+        [PY, tool("makeclr.py"), quran, colored], [quran], [colored]))
+    fonts.insert(2, colored)
+
+    # makeweb.py names its outputs after the input path, so it runs in the
+    # work directory
+    for font in fonts:
+        base = os.path.splitext(os.path.basename(font))[0]
+        outputs = [os.path.join(web, base + ext) for ext in (".ttf", ".woff", ".woff2")]
+        stage = Stage("makeweb " + base[len(NAME) + 1:], "makeweb",
+            [PY, os.path.abspath(tool("makeweb.py")), os.path.basename(font), "web"], [font], outputs)
+        stage.cwd = work
+        stages.append(stage)
+
+    return stages
+
+def selectStages(stages, kinds, styles):
+    """The stages to measure, and the stages they depend on in the order to
+    run them."""
+
+    order = pipeline.makeGraph(stages)
+    selected = set(s for s in stages
+                   if (not kinds or s.kind in kinds) and (not styles or s.name.split()[1] in styles))
+
+    needed = set(selected)
+    worklist = list(selected)
+    while worklist:
+        for dep in worklist.pop().deps:
+            if dep not in needed:
+                needed.add(dep)
+                worklist.append(dep)
+
+    return [s for s in order if s in needed], selected
+
+def runOnce(stage, log):
+    """Runs the stage, returns (wall, cpu, rss) measured with wait4()."""
+
+    start = time.time()
+    process = subprocess.Popen(stage.command, stdout=log, stderr=subprocess.STDOUT,
+                               cwd=getattr(stage, "cwd", None))
+    pid, status, usage = os.wait4(process.pid, 0)
+    wall = time.time() - start
+    process.returncode = status
+    if status:
+        raise RuntimeError("%s failed, see %s" % (stage.name, log.name))
+    # ru_maxrss is in KiB on Linux
+    return wall, usage.ru_utime + usage.ru_stime, usage.ru_maxrss / 1024.0
+
+def median(values):
+    values = sorted(values)
+    middle = len(values) // 2
+    if len(values) % 2:
+        return values[middle]
+    return (values[middle - 1] + values[middle]) / 2.0
+
+def summarize(samples):
+    """Median and spread (half the range) of each metric."""
+
+    result = {}
+    for i, (key, label, unit) in enumerate(METRICS):
+        values = [sample[i] for sample in samples]
+        result[key] = {
+            "median": median(values),
+            "spread": (max(values) - min(values)) / 2.0,
+            "samples": values,
+        }
+    return result
+
+def runBenchmark(order, selected, repeat, warmup, work):
+    """Runs the measured stages repeat times after warmup runs, and the
+    others once. Returns {stage name: summary}."""
+
+    results = {}
+    logpath = os.path.join(work, "benchmark.log")
+    with open(logpath, "w") as log:
+        for stage in order:
+            if stage not in selected:
+                print("   RUN\t%s" % stage.name)
+                runOnce(stage, log)
+                continue
+            samples = []
+            for i in range(warmup + repeat):
+                sample = runOnce(stage, log)
+                if i >= warmup:
+                    samples.append(sample)
+            results[stage.name] = summarize(samples)
+            print("   BENCH\t%-28s %8.2f s ±%.2f" % (stage.name, results[stage.name]["wall"]["median"],
+                  results[stage.name]["wall"]["spread"]))
+    return results
+
+def formatValue(value, unit):
+    return "%.2f %s ±%.2f" % (value["median"], unit, value["spread"])
+
+def report(results):
+    print("")
+    print("%-28s %18s %18s %20s" % ("stage", "wall", "cpu", "peak rss"))
+    for name in sorted(results):
+        print("%-28s %18s %18s %20s" % ((name,) +
+              tuple(formatValue(results[name][key], unit) for key, label, unit in METRICS)))
+
+def compare(baseline, results, thresholds):
+    """Prints the changes from the baseline, returns the list of regressions
+    as (stage, metric) pairs."""
+
+    regressions = []
+    lines = []
+    for name in sorted(results):
+        if name not in baseline:
+            lines.append("%-28s %-9s new stage" % (name, ""))
+            continue
+        for key, label, unit in METRICS:
+            old = baseline[name][key]
+            new = results[name][key]
+            delta = new["median"] - old["median"]
+            change = old["median"] and delta * 100.0 / old["median"] or 0.0
+            flag = ""
+            if change > thresholds[key] and delta > NOISE[key]:
+                flag = "REGRESSION"
+                regressions.append((name, label))
+            elif change < -thresholds[key] and -delta > NOISE[key]:
+                flag = "improved"
+            lines.append("%-28s %-9s %20s %20s %+8.1f%%  %s" % (name, label,
+                         formatValue(old, unit), formatValue(new, unit), change, flag))
+    for name in sorted(set(baseline) - set(results)):
+        lines.append("%-28s %-9s not measured" % (name, ""))
+
+    print("")
+    print("%-28s %-9s %20s %20s %9s" % ("stage", "metric", "baseline", "current", "change"))
+    for line in lines:
+        print(line.rstrip())
+    return regressions
+
+def loadBaseline(path):
+    with open(path) as f:
+        data = json.load(f)
+    if data.get("format") != FORMAT:
+        raise ValueError("%s: unsupported baseline format" % path)
+    return data
+
+def saveBaseline(path, results, args):
+    data = {
+        "format": FORMAT,
+        "version": args.version,
+        "repeat": args.repeat,
+        "machine": "%s %s, Python %s" % (platform.node(), platform.machine(), platform.python_version()),
+        "date": time.strftime("%Y-%m-%d %H:%M:%S"),
+        "stages": results,
+    }
+    tmp = "%s.%d.tmp" % (path, os.getpid())
+    with open(tmp, "w") as f:
+        json.dump(data, f, indent=1, sort_keys=True)
+    os.rename(tmp, path)
+    print("   SAVE\t%s" % path)
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark the build stages of the Amiri fonts.")
+    parser.add_argument("--version", metavar="VERSION", help="font version", required=True)
+    parser.add_argument("--stage", metavar="KIND", action="append", choices=("feapp", "build", "makeclr", "makeweb"),
+            help="stage to measure, can be repeated (default: all)")
+    parser.add_argument("--font", metavar="STYLE", action="append",
+            help="font to measure, e.g. regular or quran-colored, can be repeated (default: all)")
+    parser.add_argument("--repeat", metavar="N", type=int, default=5, help="number of measured runs (default: 5)")
+    parser.add_argument("--warmup", metavar="N", type=int, default=1,
+            help="number of unmeasured runs before them (default: 1)")
+    parser.add_argument("--work", metavar="DIR", default=os.path.join(".cache", "benchmark"),
+            help="scratch directory for the outputs (default: .cache/benchmark)")
+    parser.add_argument("--save", metavar="FILE", help="save the results as a baseline")
+    parser.add_argument("--baseline", metavar="FILE", help="compare the results to a saved baseline")
+    parser.add_argument("--threshold", metavar="PERCENT", type=float, default=10,
+            help="slowdown of the median time that counts as a regression (default: 10)")
+    parser.add_argument("--memory-threshold", metavar="PERCENT", type=float,
+            help="growth of the median peak RSS that counts as a regression (default: --threshold)")
+
+    args = parser.parse_args()
+
+    if args.repeat < 1:
+        parser.error("--repeat must be at least 1")
+
+    baseline = None
+    if args.baseline:
+        try:
+            baseline = loadBaseline(args.baseline)
+        except (IOError, OSError, ValueError) as e:
+            parser.error(str(e))
+
+    if not os.path.isdir(os.path.join(args.work, "web")):
+        os.makedirs(os.path.join(args.work, "web"))
+
+    stages = makeStages(args.version, args.work)
+    order, selected = selectStages(stages, args.stage, args.font)
+    if not selected:
+        parser.error("no stage matches the given --stage and --font")
+
+    try:
+        results = runBenchmark(order, selected, args.repeat, args.warmup, args.work)
+    except RuntimeError as e:
+        print("   FAIL\t%s" % e)
+        sys.exit(1)
+
+    report(results)
+
+    if args.save:
+        saveBaseline(args.save, results, args)
+
+    if baseline:
+        if baseline["version"] != args.version:
+            print("")
+            print("warning: baseline is for version %s" % baseline["version"])
+        memory = args.memory_threshold
+        if memory is None:
+            memory = args.threshold
+        thresholds = {"wall": args.threshold, "cpu": args.threshold, "rss": memory}
+        regressions = compare(baseline["stages"], results, thresholds)
+        if regressions:
+            print("")
+            print("%d regression(s) over the threshold:" % len(regressions))
+            for name, label in regressions:
+                print("   %s (%s)" % (name, label))
+            sys.exit(1)
+
+if __name__ == "__main__":
+    main()
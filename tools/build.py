@@ -20,6 +20,39 @@ from sortsmill import psMat
 import sys
 import os
 
+import buildtrace
+import sfdcache
+from buildtrace import traced
+from catalogue import Catalogue
+
+# the modules this script uses, the same list as BUILD_TOOLS in pipeline.py
+BUILD_TOOLS = ["build.py", "sfdcache.py", "glyphcache.py", "refgraph.py", "catalogue.py", "layoutcache.py", "anchors.py", "geometry.py",
+               "buildtrace.py"]
+
+# directory of the build caches, None disables caching
+cache_dir = None
+
+# reuse per glyph clean up results from the previous build (needs cache_dir)
+incremental = False
+
+# layout cache key of each font (by id), whether the cache had it and the
+# feature text to compile if the cached tables turn out not to fit
+layout_keys = {}
+
+# compile anchor lookups with fontTools instead of through the feature file
+direct_anchors = False
+
+# anchor lookups and data of each font (by id) waiting to be compiled
+pending_anchors = {}
+
+@traced
+def openFont(path):
+    """Opens a source font, going through the source snapshot cache if
+    caching is enabled."""
+
+    return fontforge.open(sfdcache.openSource(path, cache_dir))
+
+@traced
 def cleanAnchors(font):
     """Removes anchor classes (and associated lookups) that are used only
     internally for building composite glyph."""
@@ -55,39 +88,41 @@ def cleanAnchors(font):
         lookup = font.getLookupOfSubtable(subtable)
         font.removeLookup(lookup)
 
-def flattenNestedReferences(font, ref, new_transform=(1, 0, 0, 1, 0, 0)):
-    """Flattens nested references by replacing them with the ultimate reference
-    and applying any transformation matrices involved, so that the final font
-    has only simple composite glyphs. This to work around what seems to be an
-    Apple bug that results in ignoring transformation matrix of nested
-    references."""
-
-    name = ref[0]
-    transform = ref[1]
-    glyph = font[name]
-    new_ref = []
-    if glyph.references and glyph.foreground.isEmpty():
-        for nested_ref in glyph.references:
-            for i in flattenNestedReferences(font, nested_ref, transform):
-                matrix = psMat.compose(i[1], new_transform)
-                new_ref.append((i[0], matrix))
-    else:
-        matrix = psMat.compose(transform, new_transform)
-        new_ref.append((name, matrix))
-
-    return new_ref
-
-def validateGlyphs(font):
+@traced
+def validateGlyphs(font, glyphs=None):
     """Fixes some common FontForge validation warnings, currently handles:
         * wrong direction
         * flipped references
-    In addition to flattening nested references."""
+    In addition to flattening nested references, so that the final font has
+    only simple composite glyphs. This to work around what seems to be an
+    Apple bug that results in ignoring transformation matrix of nested
+    references. Only the given glyphs are processed, if any."""
+
+    import refgraph
 
     wrong_dir = 0x8
     flipped_ref = 0x10
-    for glyph in font.glyphs():
+    if glyphs is None:
+        glyphs = list(font.glyphs())
+
+    cache = None
+    if cache_dir:
+        import glyphcache
+        cache = glyphcache.ValidationCache(cache_dir, font.fontname)
+        hashes = glyphcache.glyphHashes(font)
+
+    for glyph in glyphs:
+        entry = cache and cache.lookup(hashes[glyph.glyphname])
+        if entry:
+            # validated before, just apply the stored fixes
+            state, contours = entry
+            if state & flipped_ref:
+                glyph.references = ()
+            if contours is not None:
+                glyph.foreground = glyphcache.makeLayer(contours)
+            continue
+
         state = glyph.validate(True)
-        refs = []
 
         if state & flipped_ref:
             glyph.unlinkRef()
@@ -95,9 +130,23 @@ def validateGlyphs(font):
         if state & wrong_dir:
             glyph.correctDirection()
 
-        for ref in glyph.references:
-            for i in flattenNestedReferences(font, ref):
-                refs.append(i)
+        if cache:
+            contours = None
+            if state & (flipped_ref | wrong_dir):
+                contours = glyphcache.contoursData(glyph.foreground)
+            cache.store(hashes[glyph.glyphname], state, contours)
+
+    if cache:
+        cache.save()
+        print "   VALID\t%s: %d of %d glyphs from cache (%.1f%%)" % ((font.fontname,) + cache.stats())
+
+    graph = refgraph.ReferenceGraph(font)
+    composites, nested, depth = graph.stats()
+    if nested:
+        print "   REFS\t%s: %d composite glyphs, %d nested, maximum depth %d" % (font.fontname, composites, nested, depth)
+
+    for glyph in glyphs:
+        refs = graph.expand(glyph.references)
         if refs:
             glyph.references = refs
 
@@ -120,6 +169,7 @@ def updateInfo(font, version):
             elif name[1] == "Copyright":
                 font.appendSFNTName(name[0], name[1], name[2] % datetime.now().year)
 
+@traced
 def mergeFeatures(font, feafile):
     """Merges feature file into the font while making sure mark positioning
     lookups (already in the font) come after kerning lookups (from the feature
@@ -131,7 +181,25 @@ def mergeFeatures(font, feafile):
         dummy = font.createChar(-1, "dummy%s" %i)
         dummy.width = 0
 
-    oldfea = font.generateFeatureString()
+    data = None
+    if direct_anchors:
+        try:
+            import anchors
+            data = anchors.collectAnchorLookups(font)
+            if data is None:
+                print "   ANCHORS\tunsupported lookup flags, going through the feature file"
+        except ImportError:
+            print "   ANCHORS\tfontTools is not available, going through the feature file"
+
+    if data:
+        # what is left is the non-anchor lookups, followed by a placeholder
+        # that is replaced by the compiled anchor lookups after generating
+        for lookup in data[0]:
+            font.removeLookup(lookup[0])
+        oldfea = font.generateFeatureString() + anchors.PLACEHOLDER
+        pending_anchors[id(font)] = data
+    else:
+        oldfea = font.generateFeatureString()
 
     for lookup in font.gpos_lookups:
         font.removeLookup(lookup)
@@ -146,20 +214,124 @@ def mergeFeatures(font, feafile):
     fea_text = fea_text.replace("{%anchors%}", oldfea)
     fea.close()
 
+    if cache_dir:
+        try:
+            import layoutcache
+        except ImportError:
+            layoutcache = None
+            print "   LAYOUT\tfontTools is not available, not caching layout tables"
+
+        if layoutcache:
+            key = layoutcache.layoutKey(fea_text, layoutcache.fontFingerprint(font), repr(data), buildTools())
+            hit = layoutcache.LayoutCache(cache_dir).has(key)
+            layout_keys[id(font)] = (key, hit, fea_text)
+            if hit:
+                # the stored tables will be put into the generated font
+                return
+
     # now merge it into the font
     font.mergeFeatureString(fea_text)
 
+@traced
+def mergeLateFeatures(font, fea_text):
+    """Merges the feature text skipped by mergeFeatures because of a layout
+    cache hit. Lookups added since then (the Quran over/underline) are put
+    back after the merged ones, where they would have been without the
+    cache."""
+
+    later = ""
+    lookups = font.gsub_lookups + font.gpos_lookups
+    if lookups:
+        later = font.generateFeatureString()
+        for lookup in lookups:
+            font.removeLookup(lookup)
+
+    font.mergeFeatureString(fea_text + later)
+
+@traced
 def generateFont(font, outfile):
     flags  = ("opentype", "dummy-dsig", "round", "omit-instructions", "no-mac-names")
 
-    font.selection.all()
+    if incremental and cache_dir:
+        processGlyphsIncrementally(font, outfile)
+    else:
+        font.selection.all()
+        font.correctReferences()
+        font.selection.none()
+
+        # fix some common font issues
+        validateGlyphs(font)
+
+    with buildtrace.stage("generate"):
+        font.generate(outfile, flags=flags)
+
+    layout = layout_keys.pop(id(font), None)
+    data = pending_anchors.pop(id(font), None)
+    hit = False
+    if layout:
+        import layoutcache
+
+        key, hit, fea_text = layout
+        cache = layoutcache.LayoutCache(cache_dir)
+        if hit:
+            with buildtrace.stage("layoutCache", hit=True):
+                hit = cache.inject(key, outfile)
+            if not hit:
+                # gone, or compiled for another glyph order
+                print "   LAYOUT	%s: cached tables do not fit, compiling the features" % outfile
+                mergeLateFeatures(font, fea_text)
+                with buildtrace.stage("generate"):
+                    font.generate(outfile, flags=flags)
+
+    if data and not hit:
+        import anchors
+        with buildtrace.stage("compileAnchors"):
+            anchors.compileAnchors(outfile, *data)
+
+    if layout:
+        if not hit:
+            with buildtrace.stage("layoutCache", hit=False):
+                cache.store(key, outfile)
+        cache.record(key, outfile)
+
+@traced
+def processGlyphsIncrementally(font, outfile):
+    """Does the same clean up as generateFont, but only for glyphs that
+    changed (themselves or any glyph they reference) since the last build of
+    outfile, the stored results are reused for the rest."""
+
+    import glyphcache
+
+    manifest = glyphcache.GlyphManifest(cache_dir, outfile)
+    hashes = glyphcache.glyphHashes(font)
+
+    changed = []
+    for glyph in font.glyphs():
+        result = manifest.lookup(glyph.glyphname, hashes[glyph.glyphname])
+        if result is None or [r for r in result[1] if r[0] not in font]:
+            changed.append(glyph.glyphname)
+        else:
+            glyphcache.restoreGlyph(glyph, result)
+            glyph.lcarets = ()
+
+    print "   GLYPHS\t%s: %d of %d glyphs changed" % (os.path.basename(outfile), len(changed), len(hashes))
+
+    font.selection.none()
+    for name in changed:
+        font.selection.select(("more",), name)
     font.correctReferences()
     font.selection.none()
 
-    # fix some common font issues
-    validateGlyphs(font)
+    # correctReferences might have added glyphs
+    changed += [g.glyphname for g in font.glyphs() if g.glyphname not in hashes]
+    glyphs = [font[name] for name in changed]
 
-    font.generate(outfile, flags=flags)
+    validateGlyphs(font, glyphs)
+
+    for glyph in glyphs:
+        if glyph.glyphname in hashes:
+            manifest.store(glyph.glyphname, hashes[glyph.glyphname], glyphcache.glyphResult(glyph))
+    manifest.save()
 
 def drawOverUnderline(font, name, uni, glyphclass, pos, thickness, width):
     glyph = font.createChar(uni, name)
@@ -176,7 +348,17 @@ def drawOverUnderline(font, name, uni, glyphclass, pos, thickness, width):
 
     return glyph
 
-def makeOverUnderline(font, over=True, under=True, o_pos=None, u_pos=None):
+def fontGeometry(font, names=None):
+    """A geometry.Geometry of the font, or None if NumPy is not installed,
+    the metric passes then ask FontForge glyph by glyph."""
+    try:
+        from geometry import Geometry
+    except ImportError:
+        return None
+    return Geometry(font, names)
+
+@traced
+def makeOverUnderline(font, over=True, under=True, o_pos=None, u_pos=None, geometry=None):
     # test string:
     # صِ̅فْ̅ ̅خَ̅ل̅قَ̅ ̅بًّ̅ صِ̲فْ̲ ̲خَ̲ل̲قَ̲ ̲بِ̲
 
@@ -191,9 +373,15 @@ def makeOverUnderline(font, over=True, under=True, o_pos=None, u_pos=None):
 
     # collect glyphs grouped by their widths rounded by 100 units, we will use
     # them to decide the widths of over/underline glyphs we will draw
-    widths = {}
-    for glyph in font.glyphs():
-        if glyph.glyphclass == 'baseglyph' and glyph.unicode != 0xFDFD:
+    if geometry is None:
+        geometry = fontGeometry(font)
+    bases = [n for n in Catalogue(font).ofClass('baseglyph') if font[n].unicode != 0xFDFD]
+    if geometry is not None:
+        widths = geometry.widthGroups(bases, 100, minwidth)
+    else:
+        widths = {}
+        for name in bases:
+            glyph = font[name]
             width = round(glyph.width/100) * 100
             width = width > minwidth and width or minwidth
             if not width in widths:
@@ -210,13 +398,32 @@ def makeOverUnderline(font, over=True, under=True, o_pos=None, u_pos=None):
 
     font.addMarkSet("OverUnderSet", markset)
 
+    # the feature file lookups are missing if their compiled tables come from
+    # the layout cache
+    after = font.gsub_lookups and (font.gsub_lookups[-1],) or ()
+
     context_lookup_name = 'OverUnderLine'
-    font.addLookup(context_lookup_name, 'gsub_contextchain', ('OverUnderSet'), (('mark', script_lang),), font.gsub_lookups[-1])
+    font.addLookup(context_lookup_name, 'gsub_contextchain', ('OverUnderSet'), (('mark', script_lang),), *after)
+
+    # a single class based subtable, with one class per width group and one
+    # for the over/underline marks. OpenType single substitutions map a glyph
+    # to exactly one glyph, so each width still needs its own single lookup,
+    # but those are only reached through this subtable and are not walked by
+    # the shaper for every glyph.
+    context = []
+    if over:
+        context.append(o_base.glyphname)
+    if under:
+        context.append(u_base.glyphname)
+
+    classes = [(), tuple(context)]
+    classnames = ["0", "marks"]
+    rules = []
 
     for width in sorted(widths.keys()):
         # for each width group we create an over/underline glyph with the same
-        # width, and add a contextual substitution lookup to use it when an
-        # over/underline follows any glyph in this group
+        # width, and a rule to use it when an over/underline follows any glyph
+        # in this group
 
         single_lookup_name = str(width)
 
@@ -233,42 +440,56 @@ def makeOverUnderline(font, over=True, under=True, o_pos=None, u_pos=None):
             u_glyph = drawOverUnderline(font, u_name, -1, 'mark', u_pos, thickness, width)
             u_base.addPosSub(single_lookup_name + '1', u_name)
 
-        context = "%s %s" %(over and o_base.glyphname or "", under and u_base.glyphname or "")
+        classname = "width%d" % width
+        classes.append(tuple(widths[width]))
+        classnames.append(classname)
+        rules.append('| %s marks @<%s> | ' %(classname, single_lookup_name))
 
-        rule = '| [%s] [%s] @<%s> | ' %(" ".join(widths[width]), context, single_lookup_name)
-
-        font.addContextualSubtable(context_lookup_name, context_lookup_name + str(width), 'coverage', rule)
+    font.addContextualSubtable(context_lookup_name, context_lookup_name + '1', 'class', "\n".join(rules),
+            mclasses=tuple(classes), mclassnames=tuple(classnames))
 
 def centerGlyph(glyph):
     width = glyph.width
     glyph.right_side_bearing = glyph.left_side_bearing = (glyph.right_side_bearing + glyph.left_side_bearing)/2
     glyph.width = width
 
+@traced
 def subsetFont(font, glyphnames, similar=False):
-    # keep any glyph with the same base name
-    reported = []
+    """Removes every glyph not in glyphnames, except glyphs referenced
+    (directly or indirectly) by the kept glyphs. If similar is set, glyphs
+    having a requested glyph name as their base name are kept as well."""
+
+    requested = list(glyphnames)
 
+    # keep any glyph with the same base name
     if similar:
+        catalogue = Catalogue(font)
         for name in glyphnames:
-            for glyph in font.glyphs():
-                if "." in glyph.glyphname and glyph.glyphname.split(".")[0] == name:
-                    glyphnames.append(glyph.glyphname)
+            requested += catalogue.variantsOf(name)
 
     # keep any glyph referenced requested glyphs
-    for name in glyphnames:
+    keep = set()
+    reported = set()
+    worklist = requested[::-1]
+    while worklist:
+        name = worklist.pop()
+        if name in keep:
+            continue
         if name in font:
-            glyph = font[name]
-            for ref in glyph.references:
-                glyphnames.append(ref[0])
-        else:
-            if name not in reported:
-                print 'Font ‘%s’ is missing glyph: %s' %(font.fontname, name)
-                reported.append(name)
+            keep.add(name)
+            for ref in font[name].references:
+                if ref[0] not in keep:
+                    worklist.append(ref[0])
+        elif name not in reported:
+            print 'Font ‘%s’ is missing glyph: %s' %(font.fontname, name)
+            reported.add(name)
 
     # remove everything else
-    for glyph in font.glyphs():
-        if glyph.glyphname not in glyphnames:
-            font.removeGlyph(glyph)
+    remove = [glyph for glyph in font.glyphs() if glyph.glyphname not in keep]
+    for glyph in remove:
+        font.removeGlyph(glyph)
+
+    print "   SUBSET\t%s: kept %d glyphs (%d requested), removed %d" % (font.fontname, len(keep), len(set(requested)), len(remove))
 
 def buildComposition(font, glyphnames):
     newnames = []
@@ -277,6 +498,7 @@ def buildComposition(font, glyphnames):
     font.addLookupSubtable("Latin composition", "Latin composition subtable")
 
     import unicodedata
+    catalogue = Catalogue(font)
     for name in glyphnames:
         u = fontforge.unicodeFromName(name)
         if 0 < u < 0xfb00:
@@ -285,14 +507,8 @@ def buildComposition(font, glyphnames):
                 base = decomp.split()[0]
                 mark = decomp.split()[1]
                 if not '<' in base:
-                    nmark = None
-                    nbase = None
-
-                    for g in font.glyphs():
-                        if g.unicode == int(base, 16):
-                            nbase = g.glyphname
-                        if g.unicode == int(mark, 16):
-                            nmark = g.glyphname
+                    nbase = catalogue.byUnicode(int(base, 16))
+                    nmark = catalogue.byUnicode(int(mark, 16))
 
                     if not nbase:
                         nbase = "uni%04X" % int(base, 16)
@@ -309,6 +525,7 @@ def buildComposition(font, glyphnames):
 
     return newnames
 
+@traced
 def makeNumerators(font):
     digits = ("zero", "one", "two", "three", "four", "five", "six", "seven",
               "eight", "nine",
@@ -325,19 +542,16 @@ def makeNumerators(font):
             numr.addReference(small.glyphname, psMat.translate(0, 550))
             numr.width = small.width
 
-def mergeLatin(font, feafile, italic=False, glyphs=None, quran=False):
-    styles = {"Regular": "regular",
-              "Slanted": "italic",
-              "Bold": "bold",
-              "BoldSlanted": "bolditalic"}
-
-    style = styles[font.fontname.split("-")[1]]
+@traced
+def prepareLatin(style, italic=False, glyphs=None, quran=False):
+    """Opens the Latin font of the given style and subsets it to the glyphs
+    we want to merge into the Arabic font. Returns the Latin font (with all
+    of its lookups removed), the names of the kept glyphs and the kerning
+    classes to be added back after merging."""
 
     latinfile = "amirilatin-%s.sfdir" %style
 
-    from tempfile import mkstemp
-    tmpfont = mkstemp(suffix=os.path.basename(latinfile).replace("sfdir", "sfd"))[1]
-    latinfont = fontforge.open("sources/latin/%s" %latinfile)
+    latinfont = openFont("sources/latin/%s" %latinfile)
 
     validateGlyphs(latinfont) # to flatten nested refs mainly
 
@@ -404,10 +618,6 @@ def mergeLatin(font, feafile, italic=False, glyphs=None, quran=False):
                     latinglyphs.append(name)
 
     if not quran:
-        # we want our ring above and below in Quran font only
-        for name in ("uni030A", "uni0325"):
-            font[name].clear()
-
         latinglyphs += buildComposition(latinfont, latinglyphs)
     subsetFont(latinfont, latinglyphs)
 
@@ -421,9 +631,9 @@ def mergeLatin(font, feafile, italic=False, glyphs=None, quran=False):
     # upright so it works reasonably with bot scripts
     if italic:
         if "bold" in style:
-            upright = fontforge.open("sources/latin/amirilatin-bold.sfdir")
+            upright = openFont("sources/latin/amirilatin-bold.sfdir")
         else:
-            upright = fontforge.open("sources/latin/amirilatin-regular.sfdir")
+            upright = openFont("sources/latin/amirilatin-regular.sfdir")
 
         shared = ("exclam", "quotedbl", "numbersign", "dollar", "percent",
                   "quotesingle", "asterisk", "plus", "colon", "semicolon",
@@ -492,11 +702,94 @@ def mergeLatin(font, feafile, italic=False, glyphs=None, quran=False):
     for lookup in latinfont.gsub_lookups:
         latinfont.removeLookup(lookup)
 
-    latinfont.save(tmpfont)
-    latinfont.close()
+    return latinfont, latinglyphs, kern_lookups
+
+def latinKey(style, italic, glyphs, quran):
+    """Cache key of a prepared Latin font, covering the Latin sources it is
+    built from, the options and the build tools, or None if the sources
+    can't be hashed."""
 
-    font.mergeFonts(tmpfont)
-    os.remove(tmpfont)
+    import hashlib
+
+    sources = ["sources/latin/amirilatin-%s.sfdir" % style]
+    if italic:
+        sources.append("sources/latin/amirilatin-%s.sfdir" % ("bold" in style and "bold" or "regular"))
+
+    key = hashlib.sha1()
+    for source in sources:
+        try:
+            key.update(sfdcache.sourceDigest(source, cache_dir))
+        except ValueError as err:
+            print "   CACHE\t%s" % err
+            return None
+    key.update(repr((style, italic, glyphs, quran)))
+    key.update(buildTools())
+    return key.hexdigest()
+
+def buildTools():
+    """Hashes of this script and the modules it uses, part of cache keys of
+    things it builds."""
+
+    directory = os.path.dirname(os.path.abspath(__file__))
+    hashes = []
+    for name in BUILD_TOOLS:
+        data = sfdcache.readFile(os.path.join(directory, name))
+        hashes.append("%s %s\n" % (name, sfdcache.hashBytes(data)))
+    return "".join(hashes)
+
+@traced
+def mergeLatin(font, feafile, italic=False, glyphs=None, quran=False):
+    styles = {"Regular": "regular",
+              "Slanted": "italic",
+              "Bold": "bold",
+              "BoldSlanted": "bolditalic"}
+
+    style = styles[font.fontname.split("-")[1]]
+
+    if not quran:
+        # we want our ring above and below in Quran font only
+        for name in ("uni030A", "uni0325"):
+            font[name].clear()
+
+    key = cache_dir and latinKey(style, italic, glyphs, quran)
+    if key:
+        # the prepared Latin font depends only on its sources, so keep it
+        # around and merge the cached copy directly
+        import cPickle as pickle
+
+        directory = os.path.join(cache_dir, "latin")
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+        latinpath = os.path.join(directory, key + ".sfd")
+        metapath = os.path.join(directory, key + ".pickle")
+
+        if os.path.exists(latinpath) and os.path.exists(metapath):
+            with open(metapath, "rb") as f:
+                latinglyphs, kern_lookups = pickle.load(f)
+        else:
+            latinfont, latinglyphs, kern_lookups = prepareLatin(style, italic, glyphs, quran)
+            tmp = "%s.%d.tmp" % (key, os.getpid())
+            latinfont.save(os.path.join(directory, tmp + ".sfd"))
+            latinfont.close()
+            with open(os.path.join(directory, tmp + ".pickle"), "wb") as f:
+                pickle.dump((latinglyphs, kern_lookups), f, pickle.HIGHEST_PROTOCOL)
+            os.rename(os.path.join(directory, tmp + ".pickle"), metapath)
+            os.rename(os.path.join(directory, tmp + ".sfd"), latinpath)
+
+        font.mergeFonts(latinpath)
+    else:
+        from tempfile import mkstemp
+        tmpfont = mkstemp(suffix="amirilatin-%s.sfd" % style)[1]
+
+        latinfont, latinglyphs, kern_lookups = prepareLatin(style, italic, glyphs, quran)
+        latinfont.save(tmpfont)
+        latinfont.close()
+
+        font.mergeFonts(tmpfont)
+        os.remove(tmpfont)
+
+    digits = ("zero", "one", "two", "three", "four", "five", "six", "seven",
+              "eight", "nine")
 
     if not quran:
         buildComposition(font, latinglyphs)
@@ -551,10 +844,7 @@ def mergeLatin(font, feafile, italic=False, glyphs=None, quran=False):
             if any(first) and any(second):
                 font.addKerningClass(lookup, subtable[0], first, second, offsets)
 
-def makeSlanted(infile, outfile, feafile, version, slant):
-
-    font = makeDesktop(infile, outfile, feafile, version, False, False)
-
+def makeSlanted(font, outfile, feafile, slant):
     # compute amout of skew, magic formula copied from fontforge sources
     import math
     skew = psMat.skew(-slant * math.pi/180.0)
@@ -594,30 +884,39 @@ def makeSlanted(infile, outfile, feafile, version, slant):
 
     generateFont(font, outfile)
 
-def scaleGlyph(glyph, amount):
-    """Scales the glyph, but keeps it centered around its original bounding
-    box.
+@traced
+def scaleGlyphs(font, amounts):
+    """Scales glyphs, given as {glyph name: amount}, but keeps each centered
+    around its original bounding box.
 
     Logic copied (and simplified for our simple case) from code of FontForge
     transform dialog, since that logic is not exported to Python interface."""
-    width = glyph.width
-    bbox = glyph.boundingBox()
-    x = (bbox[0] + bbox[2]) / 2
-    y = (bbox[1] + bbox[3]) / 2
-    move = psMat.translate(-x, -y)
-    scale = psMat.scale(amount)
-
-    matrix = list(scale)
-    matrix[4] = move[4] * scale[0] + x;
-    matrix[5] = move[5] * scale[3] + y;
-
-    glyph.transform(matrix)
-    if width == 0:
-        glyph.width = width
-
-def makeQuran(infile, outfile, feafile, version):
-    font = makeDesktop(infile, outfile, feafile, version, False, False)
-
+    names = list(amounts.keys())
+    geometry = fontGeometry(font, names)
+    if geometry is not None:
+        from geometry import scaleMatrices
+        matrices = scaleMatrices(geometry.boundingBoxes(names), [amounts[name] for name in names]).tolist()
+    else:
+        matrices = []
+        for name in names:
+            bbox = font[name].boundingBox()
+            x = (bbox[0] + bbox[2]) / 2
+            y = (bbox[1] + bbox[3]) / 2
+            move = psMat.translate(-x, -y)
+            scale = psMat.scale(amounts[name])
+            matrix = list(scale)
+            matrix[4] = move[4] * scale[0] + x
+            matrix[5] = move[5] * scale[3] + y
+            matrices.append(matrix)
+
+    for name, matrix in zip(names, matrices):
+        glyph = font[name]
+        width = glyph.width
+        glyph.transform(matrix)
+        if width == 0:
+            glyph.width = width
+
+def makeQuran(font, outfile, feafile):
     # fix metadata
     font.fontname = font.fontname.replace("-Regular", "Quran-Regular")
     font.familyname += " Quran"
@@ -647,12 +946,14 @@ def makeQuran(infile, outfile, feafile, version):
     dotbelow.addAnchorPoint("TashkilTashkilBelow", "basemark", 220, dotbelow.boundingBox()[1] - 100)
 
     # scale some vowel marks and dots down a bit
-    scaleGlyph(font["uni0651"], 0.8)
+    amounts = {"uni0651": 0.8}
     for mark in ("uni064B", "uni064C", "uni064E", "uni064F", "uni06E1"):
-        scaleGlyph(font[mark], 0.9)
+        amounts[mark] = 0.9
 
     for dot in ("TwoDots.a", "ThreeDots.a", "vTwoDots.a"):
-        scaleGlyph(font[dot], 0.9)
+        amounts[dot] = 0.9
+
+    scaleGlyphs(font, amounts)
 
     quran_glyphs = []
     for glyph in font.glyphs():
@@ -698,23 +999,32 @@ def makeQuran(infile, outfile, feafile, version):
     # we could have set os2_typoascent_add and hhea_ascent_add, but ff makes
     # the offset relative to em-size in the former and font bounds in the
     # later, but we want both to be relative to font bounds
-    ymax = 0
-    for glyph in font.glyphs():
-        bb = glyph.boundingBox()
-        if bb[-1] > ymax:
-            ymax = bb[-1]
+    geometry = fontGeometry(font)
+    if geometry is not None:
+        ymax = max(geometry.extrema()[3], 0)
+        overline_pos = geometry.boundingBox(font[0x06D7].glyphname)[1]
+    else:
+        ymax = 0
+        for glyph in font.glyphs():
+            bb = glyph.boundingBox()
+            if bb[-1] > ymax:
+                ymax = bb[-1]
+        overline_pos = font[0x06D7].boundingBox()[1]
 
     font.os2_typoascent = font.hhea_ascent = ymax
 
     # create overline glyph to be used for sajda line, it is positioned
     # vertically at the level of the base of waqf marks
-    overline_pos = font[0x06D7].boundingBox()[1]
-    makeOverUnderline(font, under=False, o_pos=overline_pos)
+    makeOverUnderline(font, under=False, o_pos=overline_pos, geometry=geometry)
 
     generateFont(font, outfile)
 
-def makeDesktop(infile, outfile, feafile, version, latin=True, generate=True):
-    font = fontforge.open(infile)
+@traced
+def prepareFont(infile, version):
+    """Opens the source font and does the work common to all the fonts built
+    from it."""
+
+    font = openFont(infile)
     font.encoding = "UnicodeFull" # avoid a crash if compact was set
 
     updateInfo(font, version)
@@ -730,19 +1040,76 @@ def makeDesktop(infile, outfile, feafile, version, latin=True, generate=True):
     for lang in ('Arabic (Egypt)', 'English (US)'):
         font.appendSFNTName(lang, 'Sample Text', sample)
 
-    if latin:
-        mergeLatin(font, feafile)
-        makeNumerators(font)
+    return font
 
-        # we want to merge features after merging the latin font because many
-        # referenced glyphs are in the latin font
-        mergeFeatures(font, feafile)
+def makeDesktop(font, outfile, feafile):
+    mergeLatin(font, feafile)
+    makeNumerators(font)
 
+    # we want to merge features after merging the latin font because many
+    # referenced glyphs are in the latin font
+    mergeFeatures(font, feafile)
 
-    if generate:
-        generateFont(font, outfile)
-    else:
-        return font
+    generateFont(font, outfile)
+
+def makeVariant(font, kind, outfile, feafile, slant):
+    with buildtrace.stage(kind, output=outfile):
+        if kind == "slanted":
+            makeSlanted(font, outfile, feafile, slant)
+        elif kind == "quran":
+            makeQuran(font, outfile, feafile)
+        else:
+            makeDesktop(font, outfile, feafile)
+
+def buildVariants(variants, version, slant):
+    """Builds several fonts in one go. variants is a list of (kind, input,
+    output, features) tuples, each input is opened and prepared only once,
+    then a child process is forked for each font built from it, so that they
+    all start from a copy-on-write copy of the prepared font."""
+
+    masters = []
+    for kind, infile, outfile, feafile in variants:
+        if infile not in masters:
+            masters.append(infile)
+
+    children = {}
+    for infile in masters:
+        font = prepareFont(infile, version)
+        for kind, source, outfile, feafile in variants:
+            if source != infile:
+                continue
+            sys.stdout.flush()
+            pid = os.fork()
+            if pid == 0:
+                buildtrace.forked(os.path.basename(outfile))
+                code = 0
+                try:
+                    makeVariant(font, kind, outfile, feafile, slant)
+                except:
+                    import traceback
+                    traceback.print_exc()
+                    code = 1
+                buildtrace.savePart()
+                sys.stdout.flush()
+                os._exit(code)
+            buildtrace.child(pid)
+            children[pid] = outfile
+        font.close()
+
+    failed = []
+    while children:
+        pid, status = os.wait()
+        outfile = children.pop(pid)
+        if status:
+            failed.append(outfile)
+        else:
+            print "   FF\t%s" % outfile
+
+    buildtrace.finish()
+
+    if failed:
+        print "Failed to build: %s" % " ".join(failed)
+        sys.exit(1)
 
 def usage(extramessage, code):
     if extramessage:
@@ -756,6 +1123,19 @@ Options:
   --features=FILE       file name of features file
   --version=VALUE       set font version to VALUE
   --slant=VALUE         autoslant
+  --quran               build the Quran font
+  --variant=KIND,INPUT,OUTPUT,FEATURES
+                        build OUTPUT from INPUT, KIND is one of ‘regular’,
+                        ‘quran’ or ‘slanted’; can be repeated to build several
+                        fonts at once, in which case --input, --output and
+                        --features are not needed
+  --cache=DIR           cache parsed sources and build results in DIR
+  --incremental         only clean up glyphs that changed since the last
+                        build, needs --cache
+  --direct-anchors      compile the anchor lookups directly instead of going
+                        through the feature file, needs fontTools
+  --trace=FILE          write the time and memory used by each build stage to
+                        FILE as Chrome trace events, and print a summary
 
   -h, --help            print this message and exit
 """ % os.path.basename(sys.argv[0])
@@ -772,7 +1152,7 @@ if __name__ == "__main__":
     try:
         opts, args = getopt.gnu_getopt(sys.argv[1:],
                 "h",
-                ["help", "input=", "output=", "features=", "version=", "slant=", "quran"])
+                ["help", "input=", "output=", "features=", "version=", "slant=", "quran", "variant=", "cache=", "incremental", "direct-anchors", "trace="])
     except getopt.GetoptError, err:
         usage(str(err), -1)
 
@@ -782,6 +1162,8 @@ if __name__ == "__main__":
     version = None
     slant = False
     quran = False
+    variants = []
+    tracefile = None
 
     for opt, arg in opts:
         if opt in ("-h", "--help"):
@@ -792,20 +1174,41 @@ if __name__ == "__main__":
         elif opt == "--version": version = arg
         elif opt == "--slant": slant = float(arg)
         elif opt == "--quran": quran = True
+        elif opt == "--variant": variants.append(tuple(arg.split(",")))
+        elif opt == "--cache": cache_dir = arg
+        elif opt == "--incremental": incremental = True
+        elif opt == "--direct-anchors": direct_anchors = True
+        elif opt == "--trace": tracefile = arg
+
+    if not version:
+        usage("No version specified", -1)
+    if incremental and not cache_dir:
+        usage("--incremental needs --cache", -1)
+    if tracefile:
+        buildtrace.start(tracefile, outfile and os.path.basename(outfile) or "build")
+
+    if variants:
+        for variant in variants:
+            if len(variant) != 4 or variant[0] not in ("regular", "quran", "slanted"):
+                usage("Invalid variant: %s" % ",".join(variant), -1)
+            if variant[0] == "slanted" and not slant:
+                usage("No slant specified for slanted variant", -1)
+        buildVariants(variants, version, slant)
+        sys.exit(0)
 
     if not infile:
         usage("No input file specified", -1)
     if not outfile:
         usage("No output file specified", -1)
-
-    if not version:
-        usage("No version specified", -1)
     if not feafile:
         usage("No features file specified", -1)
 
     if slant:
-        makeSlanted(infile, outfile, feafile, version, slant)
+        kind = "slanted"
     elif quran:
-        makeQuran(infile, outfile, feafile, version)
+        kind = "quran"
     else:
-        makeDesktop(infile, outfile, feafile, version)
+        kind = "regular"
+
+    makeVariant(prepareFont(infile, version), kind, outfile, feafile, slant)
+    buildtrace.finish()
@@ -0,0 +1,197 @@
+# coding=utf-8
+#
+# buildtrace.py - Timing and memory trace of the font build
+#
+# To the extent possible under law, the author have dedicated all copyright
+# and related and neighboring rights to this software to the public domain
+# worldwide. This software is distributed without any warranty.
+#
+# You should have received a copy of the CC0 Public Domain Dedication along
+# with this software. If not, see
+# <http://creativecommons.org/publicdomain/zero/1.0/>.
+
+"""Records the wall time, CPU time and peak RSS of named build stages, and
+writes them as a Chrome trace event file (load it in chrome://tracing or
+Perfetto) plus a summary table.
+
+Tracing is off unless start() is called, stages are then no-ops. Forked
+children call forked() and, before exiting, savePart(); the parent merges
+their events when calling finish().
+
+Peak RSS is per stage on Linux, where the high water mark of the process can
+be reset; elsewhere it is the peak of the process so far."""
+
+from __future__ import print_function
+
+import functools
+import json
+import os
+import resource
+import time
+from contextlib import contextmanager
+
+path = None    # trace file, None when tracing is off
+label = None   # what this process builds, shown as the process name
+events = []
+stack = []     # peak RSS (KiB) of the open stages
+parts = []     # part files of forked children
+
+def start(tracefile, name="build"):
+    global path, label
+    path = tracefile
+    label = name
+    directory = os.path.dirname(path)
+    if directory and not os.path.isdir(directory):
+        os.makedirs(directory)
+
+def enabled():
+    return path is not None
+
+def cpuTime():
+    usage = resource.getrusage(resource.RUSAGE_SELF)
+    return usage.ru_utime + usage.ru_stime
+
+def peakRSS():
+    """Peak resident set size in KiB since the last resetPeak()."""
+
+    try:
+        with open("/proc/self/status") as f:
+            for line in f:
+                if line.startswith("VmHWM:"):
+                    return int(line.split()[1])
+    except (IOError, OSError):
+        pass
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+def resetPeak():
+    try:
+        with open("/proc/self/clear_refs", "w") as f:
+            f.write("5")
+    except (IOError, OSError):
+        pass
+
+@contextmanager
+def stage(name, **args):
+    """Records the enclosed code as a stage called name, args are added to
+    the trace event."""
+
+    if not enabled():
+        yield
+        return
+
+    # the peak so far belongs to the enclosing stage, then start afresh
+    if stack:
+        stack[-1] = max(stack[-1], peakRSS())
+    resetPeak()
+    stack.append(0)
+
+    wall = time.time()
+    cpu = cpuTime()
+    try:
+        yield
+    finally:
+        peak = max(stack.pop(), peakRSS())
+        if stack:
+            stack[-1] = max(stack[-1], peak)
+        args = dict(args)
+        args["cpu"] = round(cpuTime() - cpu, 6)
+        args["peak_rss_kb"] = peak
+        events.append({
+            "name": name,
+            "cat": label,
+            "ph": "X",
+            "ts": int(wall * 1e6),
+            "dur": int((time.time() - wall) * 1e6),
+            "pid": os.getpid(),
+            "tid": os.getpid(),
+            "args": args,
+        })
+
+def traced(function):
+    """Decorator recording every call of function as a stage."""
+
+    @functools.wraps(function)
+    def wrapper(*args, **kwargs):
+        with stage(function.__name__):
+            return function(*args, **kwargs)
+    return wrapper
+
+def processName():
+    return {
+        "name": "process_name",
+        "ph": "M",
+        "pid": os.getpid(),
+        "tid": os.getpid(),
+        "args": {"name": label},
+    }
+
+def partPath(pid):
+    return "%s.%d.part" % (path, pid)
+
+def forked(name):
+    """To be called in a forked child, the events of the parent stay with
+    the parent."""
+
+    global label
+    if not enabled():
+        return
+    label = name
+    del events[:]
+    del parts[:]
+    stack[:] = [0] * len(stack)
+
+def savePart():
+    """Saves the events of a forked child for the parent to merge."""
+
+    if not enabled():
+        return
+    with open(partPath(os.getpid()), "w") as f:
+        json.dump([processName()] + events, f)
+
+def child(pid):
+    """Tells the parent about a forked child whose events are to be merged."""
+
+    if enabled():
+        parts.append(partPath(pid))
+
+def summary(allevents):
+    """Returns the summary table of the events as a string, stages are listed
+    per process in the order they finished."""
+
+    names = {}
+    rows = []
+    for event in allevents:
+        if event["ph"] == "M":
+            names[event["pid"]] = event["args"]["name"]
+        else:
+            rows.append(event)
+
+    lines = ["%-24s %-28s %9s %9s %10s" % ("build", "stage", "wall (s)", "cpu (s)", "peak (MiB)")]
+    for event in sorted(rows, key=lambda e: (names.get(e["pid"], ""), e["ts"] + e["dur"])):
+        lines.append("%-24s %-28s %9.2f %9.2f %10.1f" % (names.get(event["pid"], ""), event["name"],
+                     event["dur"] / 1e6, event["args"]["cpu"], event["args"]["peak_rss_kb"] / 1024.0))
+    return "\n".join(lines)
+
+def finish():
+    """Merges the events of the children, writes the trace file and prints
+    the summary."""
+
+    if not enabled():
+        return
+
+    allevents = [processName()] + events
+    for part in parts:
+        try:
+            with open(part) as f:
+                allevents += json.load(f)
+            os.remove(part)
+        except (IOError, OSError, ValueError):
+            print("   TRACE\tmissing events of %s" % part)
+
+    tmp = "%s.%d.tmp" % (path, os.getpid())
+    with open(tmp, "w") as f:
+        json.dump({"traceEvents": allevents, "displayTimeUnit": "ms"}, f)
+    os.rename(tmp, path)
+
+    print("   TRACE\t%s" % path)
+    print(summary(allevents))
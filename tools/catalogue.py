@@ -0,0 +1,64 @@
+# coding=utf-8
+#
+# catalogue.py - Indexed view of the glyphs of a FontForge font
+#
+# To the extent possible under law, the author have dedicated all copyright
+# and related and neighboring rights to this software to the public domain
+# worldwide. This software is distributed without any warranty.
+#
+# You should have received a copy of the CC0 Public Domain Dedication along
+# with this software. If not, see
+# <http://creativecommons.org/publicdomain/zero/1.0/>.
+
+"""Indexes of the glyphs of a font, built with a single pass over it so that
+code looking glyphs up by code point, name prefix, class or references does
+not have to scan the whole font each time.
+
+It only uses the font object API, so it works both with the build scripts
+and with the FontForge menu scripts. The indexes are not updated when the
+font changes, so build a new catalogue after adding or removing glyphs."""
+
+class Catalogue(object):
+    def __init__(self, font):
+        self.unicodes = {}   # code point -> glyph name
+        self.variants = {}   # dotted prefix -> names of glyphs with a suffix
+        self.classes = {}    # glyph class -> glyph names
+        self.users = {}      # glyph name -> names of glyphs referencing it
+
+        for glyph in font.glyphs():
+            name = glyph.glyphname
+
+            if glyph.unicode != -1:
+                self.unicodes[glyph.unicode] = name
+
+            # uni0628.init.alt is a variant of both uni0628 and uni0628.init
+            parts = name.split(".")
+            for i in range(1, len(parts)):
+                self.variants.setdefault(".".join(parts[:i]), []).append(name)
+
+            self.classes.setdefault(glyph.glyphclass, []).append(name)
+
+            for ref in glyph.references:
+                self.users.setdefault(ref[0], set()).add(name)
+
+    def byUnicode(self, codepoint):
+        """Name of the glyph encoded at codepoint, or None."""
+
+        return self.unicodes.get(codepoint)
+
+    def variantsOf(self, name):
+        """Names of the glyphs whose name starts with name and a dot, e.g.
+        uni0628.init and uni0628.fina for uni0628, or uni0628.init.alt for
+        uni0628.init."""
+
+        return self.variants.get(name, [])
+
+    def ofClass(self, glyphclass):
+        """Names of the glyphs with the given glyph class."""
+
+        return self.classes.get(glyphclass, [])
+
+    def usersOf(self, name):
+        """Names of the glyphs referencing the given glyph directly."""
+
+        return self.users.get(name, set())
@@ -0,0 +1,227 @@
+#!/usr/bin/env python3
+# coding=utf-8
+#
+# feapp.py - Preprocessor for the feature files
+#
+# To the extent possible under law, the author have dedicated all copyright
+# and related and neighboring rights to this software to the public domain
+# worldwide. This software is distributed without any warranty.
+#
+# You should have received a copy of the CC0 Public Domain Dedication along
+# with this software. If not, see
+# <http://creativecommons.org/publicdomain/zero/1.0/>.
+
+"""Handles the subset of gpp that the feature files use: #include "file",
+#ifdef, #ifndef, #else, #endif, #define and #undef. Macros are only used in
+conditions, they are not expanded in the text. Lines starting with # followed
+by anything else (comments, commented out rules) are kept as they are.
+
+Parsed files are cached, so preprocessing the same files for several
+variants reads and parses each of them once. Besides the text, preprocessing
+returns the files it actually included, which depend on the defines, e.g.:
+
+    feapp.py -Isources -DQURAN sources/amiri.fea -o amiri-quran.fea.pp -M amiri-quran.fea.pp.d
+
+writes a Makefile dependency list next to the output, so that a change to a
+file a variant does not include does not rebuild it. The output is only
+written when its contents change, for the same reason."""
+
+from __future__ import print_function
+
+import argparse
+import io
+import os
+import re
+import sys
+
+DIRECTIVE = re.compile(r"^\s*#(include|ifdef|ifndef|else|endif|define|undef)\b\s*(.*?)\s*$")
+
+class PreprocessorError(ValueError):
+    pass
+
+def parseLines(path, lines):
+    """Turns the lines of a file into a tree of ("text", [lines]),
+    ("include", name, lineno), ("define", name), ("undef", name) and
+    ("if", name, negated, then, otherwise) nodes."""
+
+    root = []
+    stack = []  # (if node, line number, after #else) of the open conditionals
+    current = root
+    for lineno, line in enumerate(lines, 1):
+        match = DIRECTIVE.match(line)
+        if not match:
+            if current and current[-1][0] == "text":
+                current[-1][1].append(line)
+            else:
+                current.append(("text", [line]))
+            continue
+
+        directive, argument = match.groups()
+        where = "%s:%d" % (path, lineno)
+        if directive == "include":
+            name = argument.strip("\"<>")
+            if not name:
+                raise PreprocessorError("%s: #include without a file name" % where)
+            current.append(("include", name, lineno))
+        elif directive in ("define", "undef"):
+            if not argument:
+                raise PreprocessorError("%s: #%s without a macro name" % (where, directive))
+            current.append((directive, argument.split()[0]))
+        elif directive in ("ifdef", "ifndef"):
+            if not argument:
+                raise PreprocessorError("%s: #%s without a macro name" % (where, directive))
+            node = ("if", argument.split()[0], directive == "ifndef", [], [])
+            current.append(node)
+            stack.append((node, lineno, False))
+            current = node[3]
+        elif directive == "else":
+            if not stack or stack[-1][2]:
+                raise PreprocessorError("%s: unexpected #else" % where)
+            node, start, seen = stack.pop()
+            stack.append((node, start, True))
+            current = node[4]
+        elif directive == "endif":
+            if not stack:
+                raise PreprocessorError("%s: unexpected #endif" % where)
+            stack.pop()
+            if not stack:
+                current = root
+            else:
+                node, start, seen = stack[-1]
+                current = node[4] if seen else node[3]
+
+    if stack:
+        raise PreprocessorError("%s:%d: #%s without #endif" % (path, stack[-1][1],
+                                stack[-1][0][2] and "ifndef" or "ifdef"))
+    return root
+
+class Preprocessor(object):
+    def __init__(self, includes=()):
+        self.includes = list(includes)
+        self.parsed = {}  # path -> (size, mtime, tree)
+
+    def parse(self, path):
+        st = os.stat(path)
+        stamp = (st.st_size, st.st_mtime)
+        cached = self.parsed.get(path)
+        if cached and cached[:2] == stamp:
+            return cached[2]
+        with io.open(path, encoding="utf-8", newline="") as f:
+            lines = f.read().splitlines(True)
+        tree = parseLines(path, lines)
+        self.parsed[path] = stamp + (tree,)
+        return tree
+
+    def find(self, name, parent):
+        for directory in [os.path.dirname(parent)] + self.includes:
+            path = os.path.normpath(os.path.join(directory, name))
+            if os.path.isfile(path):
+                return path
+        return None
+
+    def preprocess(self, path, defines=()):
+        """Returns the preprocessed text of path, and the list of the files
+        it included (path first)."""
+
+        output = []
+        files = [os.path.normpath(path)]
+        self.expand(files[0], dict((name, True) for name in defines), output, files, [])
+        return "".join(output), files
+
+    def expand(self, path, defines, output, files, including):
+        if path in including:
+            raise PreprocessorError("%s: recursive #include" % " -> ".join(including + [path]))
+        including = including + [path]
+
+        def walk(nodes):
+            for node in nodes:
+                kind = node[0]
+                if kind == "text":
+                    output.extend(node[1])
+                elif kind == "include":
+                    found = self.find(node[1], path)
+                    if found is None:
+                        raise PreprocessorError("%s:%d: cannot find ‘%s’" % (path, node[2], node[1]))
+                    if found not in files:
+                        files.append(found)
+                    self.expand(found, defines, output, files, including)
+                elif kind == "define":
+                    defines[node[1]] = True
+                elif kind == "undef":
+                    defines.pop(node[1], None)
+                else:
+                    name, negated, then, otherwise = node[1:]
+                    if (name in defines) != negated:
+                        walk(then)
+                    else:
+                        walk(otherwise)
+
+        walk(self.parse(path))
+
+def writeIfChanged(path, text):
+    """Writes text to path unless it already has it, returns True if the
+    file was written."""
+
+    data = text.encode("utf-8")
+    try:
+        with open(path, "rb") as f:
+            if f.read() == data:
+                return False
+    except (IOError, OSError):
+        pass
+    tmp = "%s.%d.tmp" % (path, os.getpid())
+    with open(tmp, "wb") as f:
+        f.write(data)
+    os.rename(tmp, path)
+    return True
+
+def writeDependencies(depfile, target, files):
+    """Writes a Makefile fragment making target depend on files, with an
+    empty rule for each of them so that removing one does not break the
+    build."""
+
+    lines = ["%s: %s" % (target, " ".join(files)), ""]
+    lines += ["%s:" % f for f in files[1:]]
+    writeIfChanged(depfile, "\n".join(lines) + "\n")
+
+def readDependencies(depfile):
+    """The files listed by writeDependencies(), or None if depfile does not
+    exist."""
+
+    try:
+        with open(depfile) as f:
+            line = f.readline()
+    except (IOError, OSError):
+        return None
+    return line.split(":", 1)[1].split()
+
+def run(preprocessor, infile, outfile, defines=(), depfile=None):
+    """Preprocesses infile into outfile, and writes the dependencies of
+    outfile to depfile if given. Returns True if outfile changed."""
+
+    text, files = preprocessor.preprocess(infile, defines)
+    changed = writeIfChanged(outfile, text)
+    if depfile:
+        writeDependencies(depfile, outfile, files)
+    return changed
+
+def main():
+    parser = argparse.ArgumentParser(description="Preprocess Amiri feature files.")
+    parser.add_argument("infile", metavar="FILE", help="input feature file")
+    parser.add_argument("-o", dest="outfile", metavar="FILE", required=True, help="output file")
+    parser.add_argument("-I", dest="includes", metavar="DIR", action="append", default=[],
+            help="directory to search for included files, can be repeated")
+    parser.add_argument("-D", dest="defines", metavar="NAME", action="append", default=[],
+            help="macro to define, can be repeated")
+    parser.add_argument("-M", dest="depfile", metavar="FILE", help="write the dependencies of the output to FILE")
+
+    args = parser.parse_args()
+
+    try:
+        run(Preprocessor(args.includes), args.infile, args.outfile, args.defines, args.depfile)
+    except (PreprocessorError, IOError, OSError) as e:
+        print("feapp.py: %s" % e, file=sys.stderr)
+        sys.exit(1)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,266 @@
+# coding=utf-8
+#
+# geometry.py - Whole font outline geometry in NumPy arrays
+#
+# To the extent possible under law, the author have dedicated all copyright
+# and related and neighboring rights to this software to the public domain
+# worldwide. This software is distributed without any warranty.
+#
+# You should have received a copy of the CC0 Public Domain Dedication along
+# with this software. If not, see
+# <http://creativecommons.org/publicdomain/zero/1.0/>.
+
+"""The outlines, references and advance widths of a font loaded once into
+contiguous NumPy arrays, so that metric passes over the whole font (bounding
+boxes, extrema, width groups) are a handful of array operations instead of
+thousands of calls into FontForge.
+
+Outlines are stored as cubic Bézier segments (lines and quadratic curves are
+converted exactly), bounding boxes take curve extrema into account and
+include references, like FontForge's glyph.boundingBox(). Matrices are in
+psMat order (xx, xy, yx, yy, dx, dy). The store is not updated when the font
+changes, so build a new one after modifying glyphs.
+
+NumPy is optional, build.py imports this module only when it uses it and
+asks FontForge glyph by glyph when NumPy is not installed."""
+
+import numpy
+
+from refgraph import topologicalOrder
+
+def applyMatrix(matrix, points):
+    """Applies one (shape (6,)) or one per point (shape (..., 6)) affine
+    matrix to points of shape (..., 2)."""
+
+    matrix = numpy.asarray(matrix, dtype=float)
+    points = numpy.asarray(points, dtype=float)
+    x, y = points[..., 0], points[..., 1]
+    return numpy.stack((matrix[..., 0] * x + matrix[..., 2] * y + matrix[..., 4],
+                        matrix[..., 1] * x + matrix[..., 3] * y + matrix[..., 5]), axis=-1)
+
+def scaleMatrices(bboxes, amounts):
+    """Matrices scaling each box by its amount around the box center, as
+    FontForge's transform dialog does."""
+
+    bboxes = numpy.asarray(bboxes, dtype=float).reshape(-1, 4)
+    amounts = numpy.asarray(amounts, dtype=float).reshape(-1)
+    center = (bboxes[:, :2] + bboxes[:, 2:]) / 2
+    matrices = numpy.zeros((len(bboxes), 6))
+    matrices[:, 0] = matrices[:, 3] = amounts
+    matrices[:, 4:] = center * (1 - amounts[:, None])
+    return matrices
+
+def segmentBounds(segments):
+    """Returns (mins, maxs) of cubic segments of shape (n, 4, 2), using the
+    end points and the points where the derivative of each coordinate is
+    zero."""
+
+    p0, p1, p2, p3 = segments[:, 0], segments[:, 1], segments[:, 2], segments[:, 3]
+    lo = numpy.minimum(p0, p3)
+    hi = numpy.maximum(p0, p3)
+
+    # B'(t)/3 = a t² + b t + c
+    a = -p0 + 3 * p1 - 3 * p2 + p3
+    b = 2 * (p0 - 2 * p1 + p2)
+    c = p1 - p0
+    with numpy.errstate(divide="ignore", invalid="ignore"):
+        quadratic = numpy.abs(a) > 1e-9
+        disc = b * b - 4 * a * c
+        root = numpy.sqrt(numpy.maximum(disc, 0))
+        roots = (numpy.where(quadratic, (-b + root) / (2 * a), -c / b),
+                 numpy.where(quadratic, (-b - root) / (2 * a), -c / b))
+        for t in roots:
+            valid = numpy.isfinite(t) & (t > 0) & (t < 1) & (~quadratic | (disc >= 0))
+            t = numpy.where(valid, t, 0)
+            mt = 1 - t
+            point = mt ** 3 * p0 + 3 * mt * mt * t * p1 + 3 * mt * t * t * p2 + t ** 3 * p3
+            lo = numpy.minimum(lo, point)
+            hi = numpy.maximum(hi, point)
+
+    return lo, hi
+
+def contourSegments(points, quadratic, closed):
+    """Converts a contour, as a list of (x, y, on_curve), to a list of cubic
+    segments."""
+
+    points = list(points)
+    if not points:
+        return []
+
+    if quadratic:
+        # add the implied on-curve points between two off-curve points
+        expanded = []
+        count = len(points)
+        for i, point in enumerate(points):
+            expanded.append(point)
+            following = points[(i + 1) % count]
+            if not point[2] and not following[2] and (closed or i + 1 < count):
+                expanded.append(((point[0] + following[0]) / 2.0, (point[1] + following[1]) / 2.0, True))
+        points = expanded
+
+    # start from an on-curve point
+    for start, point in enumerate(points):
+        if point[2]:
+            break
+    points = points[start:] + points[:start]
+    if closed:
+        points.append(points[0])
+
+    segments = []
+    current = points[0]
+    offcurve = []
+    for point in points[1:]:
+        if not point[2]:
+            offcurve.append(point)
+            continue
+        p0, p3 = current[:2], point[:2]
+        if not offcurve:
+            p1 = (p0[0] + (p3[0] - p0[0]) / 3.0, p0[1] + (p3[1] - p0[1]) / 3.0)
+            p2 = (p0[0] + (p3[0] - p0[0]) * 2 / 3.0, p0[1] + (p3[1] - p0[1]) * 2 / 3.0)
+        elif len(offcurve) == 1:
+            q = offcurve[0]
+            p1 = (p0[0] + (q[0] - p0[0]) * 2 / 3.0, p0[1] + (q[1] - p0[1]) * 2 / 3.0)
+            p2 = (p3[0] + (q[0] - p3[0]) * 2 / 3.0, p3[1] + (q[1] - p3[1]) * 2 / 3.0)
+        else:
+            p1, p2 = offcurve[0][:2], offcurve[-1][:2]
+        segments.append((p0, p1, p2, p3))
+        current = point
+        offcurve = []
+
+    return segments
+
+class Geometry(object):
+    """Widths, outlines and references of the given glyphs of a font (all
+    glyphs by default) and of every glyph they reference. Outlines are only
+    read from the font when first needed."""
+
+    def __init__(self, font, glyphs=None):
+        self.font = font
+
+        if glyphs is None:
+            names = [glyph.glyphname for glyph in font.glyphs()]
+        else:
+            names = []
+            seen = set()
+            worklist = list(glyphs)
+            while worklist:
+                name = worklist.pop()
+                if name in seen or name not in font:
+                    continue
+                seen.add(name)
+                names.append(name)
+                worklist.extend(ref[0] for ref in font[name].references)
+
+        self.names = names
+        self.index = dict((name, i) for i, name in enumerate(names))
+        self.widths = numpy.array([font[name].width for name in names], dtype=float)
+
+        self.segments = None  # (n, 4, 2) cubic segments of all outlines
+        self.owners = None    # glyph index of each segment
+        self.components = {}  # glyph name -> [(component name, matrix)]
+        self.bboxes = None
+
+    def loadOutlines(self):
+        if self.segments is not None:
+            return
+
+        segments = []
+        owners = []
+        for i, name in enumerate(self.names):
+            glyph = self.font[name]
+            for contour in glyph.foreground:
+                points = [(p.x, p.y, p.on_curve) for p in contour]
+                found = contourSegments(points, contour.is_quadratic, contour.closed)
+                segments.extend(found)
+                owners.extend([i] * len(found))
+            if glyph.references:
+                self.components[name] = [(ref[0], tuple(ref[1])) for ref in glyph.references if ref[0] in self.index]
+
+        self.segments = numpy.array(segments, dtype=float).reshape(-1, 4, 2)
+        self.owners = numpy.array(owners, dtype=int)
+
+    def glyphSegments(self, name, matrix=None):
+        """All the segments of a glyph, references included, optionally
+        transformed."""
+
+        self.loadOutlines()
+        segments = [self.segments[self.owners == self.index[name]]]
+        for component, transform in self.components.get(name, ()):
+            segments.append(self.glyphSegments(component, transform))
+        segments = numpy.concatenate(segments)
+        if matrix is not None:
+            segments = applyMatrix(matrix, segments)
+        return segments
+
+    def computeBoundingBoxes(self):
+        self.loadOutlines()
+
+        count = len(self.names)
+        lo = numpy.full((count, 2), numpy.inf)
+        hi = numpy.full((count, 2), -numpy.inf)
+        if len(self.segments):
+            seglo, seghi = segmentBounds(self.segments)
+            numpy.minimum.at(lo, self.owners, seglo)
+            numpy.maximum.at(hi, self.owners, seghi)
+
+        # references, a glyph after all of its components, so their boxes are
+        # complete when used. Transformed boxes are exact for matrices without
+        # rotation or skew, the segments are transformed otherwise.
+        for name in topologicalOrder(self.components):
+            i = self.index[name]
+            components = self.components.get(name)
+            if not components:
+                continue
+            indices = numpy.array([self.index[c[0]] for c in components])
+            matrices = numpy.array([c[1] for c in components], dtype=float)
+            corners = numpy.stack((lo[indices], numpy.stack((lo[indices, 0], hi[indices, 1]), axis=-1),
+                                   numpy.stack((hi[indices, 0], lo[indices, 1]), axis=-1), hi[indices]), axis=1)
+            empty = ~numpy.isfinite(corners).all(axis=(1, 2))
+            corners = applyMatrix(matrices[:, None, :], numpy.where(empty[:, None, None], 0, corners))
+            aligned = (matrices[:, 1] == 0) & (matrices[:, 2] == 0) & ~empty
+            if aligned.any():
+                lo[i] = numpy.minimum(lo[i], corners[aligned].min(axis=(0, 1)))
+                hi[i] = numpy.maximum(hi[i], corners[aligned].max(axis=(0, 1)))
+            for j in numpy.nonzero(~aligned & ~empty)[0]:
+                seglo, seghi = segmentBounds(self.glyphSegments(*components[j]))
+                lo[i] = numpy.minimum(lo[i], seglo.min(axis=0))
+                hi[i] = numpy.maximum(hi[i], seghi.max(axis=0))
+
+        bboxes = numpy.concatenate((lo, hi), axis=1)
+        bboxes[~numpy.isfinite(bboxes).all(axis=1)] = 0
+        self.bboxes = bboxes
+
+    def boundingBoxes(self, names=None):
+        """(xmin, ymin, xmax, ymax) of the given glyphs (of all glyphs by
+        default) as an (n, 4) array, empty glyphs are all zeros."""
+
+        if self.bboxes is None:
+            self.computeBoundingBoxes()
+        if names is None:
+            return self.bboxes
+        return self.bboxes[[self.index[name] for name in names]]
+
+    def boundingBox(self, name):
+        return tuple(self.boundingBoxes([name])[0].tolist())
+
+    def extrema(self):
+        """Returns (xmin, ymin, xmax, ymax) over all the glyphs."""
+
+        bboxes = self.boundingBoxes()
+        if not len(bboxes):
+            return (0.0, 0.0, 0.0, 0.0)
+        return tuple(bboxes[:, :2].min(axis=0).tolist() + bboxes[:, 2:].max(axis=0).tolist())
+
+    def widthGroups(self, names, step=100, minimum=100.0):
+        """Groups glyphs by their widths rounded down to multiples of step,
+        groups narrower than minimum are merged into minimum. Returns
+        {width: [names]}."""
+
+        indices = numpy.array([self.index[name] for name in names], dtype=int)
+        widths = numpy.floor_divide(self.widths[indices], step) * step
+        widths = numpy.maximum(widths, minimum)
+
+        groups = {}
+        for name, width in zip(names, widths.tolist()):
+            groups.setdefault(width, []).append(name)
+        return groups
@@ -0,0 +1,190 @@
+# coding=utf-8
+#
+# glyphcache.py - Per glyph cache of processed outlines
+#
+# To the extent possible under law, the author have dedicated all copyright
+# and related and neighboring rights to this software to the public domain
+# worldwide. This software is distributed without any warranty.
+#
+# You should have received a copy of the CC0 Public Domain Dedication along
+# with this software. If not, see
+# <http://creativecommons.org/publicdomain/zero/1.0/>.
+
+"""Remembers the outcome of the per glyph clean up done before generating a
+font, so that the next build only needs to process glyphs whose outlines or
+references (directly or through any of their components) changed, as well as
+the results of FontForge validation of each glyph."""
+
+from sortsmill import ffcompat as fontforge
+import hashlib
+import os
+
+try:
+    import cPickle as pickle
+except ImportError:
+    import pickle
+
+def contoursData(layer):
+    contours = []
+    for contour in layer:
+        points = tuple((p.x, p.y, p.on_curve) for p in contour)
+        contours.append((contour.is_quadratic, contour.closed, points))
+    return tuple(contours)
+
+def referencesData(glyph):
+    return tuple((ref[0], tuple(ref[1])) for ref in glyph.references)
+
+def glyphHashes(font):
+    """Returns a {glyphname: sha1} dictionary where the hash covers the
+    outlines, references and width of the glyph, and the hashes of every glyph
+    it references."""
+
+    own = {}
+    for glyph in font.glyphs():
+        own[glyph.glyphname] = (glyph.width, contoursData(glyph.foreground), referencesData(glyph))
+
+    hashes = {}
+    def deepHash(name):
+        if name not in hashes:
+            hashes[name] = None # guard against reference loops
+            data = own.get(name)
+            digest = hashlib.sha1(repr(data).encode("utf-8"))
+            if data:
+                for ref in data[2]:
+                    digest.update((hashes.get(ref[0]) or deepHash(ref[0]) or "").encode("utf-8"))
+            hashes[name] = digest.hexdigest()
+        return hashes[name]
+
+    for name in own:
+        deepHash(name)
+
+    return hashes
+
+def glyphResult(glyph):
+    """What the clean up produced for this glyph."""
+
+    return (contoursData(glyph.foreground), referencesData(glyph))
+
+def restoreGlyph(glyph, result):
+    """Replaces the outlines and references of the glyph with a previously
+    stored result."""
+
+    contours, references = result
+    glyph.foreground = makeLayer(contours)
+    glyph.references = references
+
+def makeLayer(contours):
+    layer = fontforge.layer()
+    for quadratic, closed, points in contours:
+        contour = fontforge.contour()
+        contour.is_quadratic = quadratic
+        for x, y, on_curve in points:
+            contour += fontforge.point(x, y, on_curve)
+        contour.closed = closed
+        layer += contour
+    return layer
+
+class GlyphManifest(object):
+    """The stored results of the previous build of one output font, keyed by
+    glyph name and checked against the glyph hash."""
+
+    def __init__(self, cachedir, outfile):
+        directory = os.path.join(cachedir, "glyphs")
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+        self.path = os.path.join(directory, os.path.basename(outfile) + ".pickle")
+        self.entries = {}
+        try:
+            with open(self.path, "rb") as f:
+                self.entries = pickle.load(f)
+        except (IOError, OSError, EOFError, pickle.UnpicklingError):
+            pass
+        self.fresh = {}
+
+    def lookup(self, name, digest):
+        entry = self.entries.get(name)
+        if entry and entry[0] == digest:
+            self.fresh[name] = entry
+            return entry[1]
+        return None
+
+    def store(self, name, digest, result):
+        self.fresh[name] = (digest, result)
+
+    def save(self):
+        tmp = self.path + ".tmp"
+        with open(tmp, "wb") as f:
+            pickle.dump(self.fresh, f, pickle.HIGHEST_PROTOCOL)
+        os.rename(tmp, self.path)
+
+class ValidationCache(object):
+    """FontForge validation results, keyed by glyph hash (see glyphHashes) and
+    shared by all fonts. Each entry is the validation state and, if the glyph
+    needed fixing, the fixed outlines.
+
+    The hashes each of the last KEEP builds of a font used are recorded, and
+    entries no recorded build used are dropped when saving, so that edited
+    glyphs do not pile up."""
+
+    KEEP = 4 # number of builds remembered per font
+
+    def __init__(self, cachedir, fontname):
+        if not os.path.isdir(cachedir):
+            os.makedirs(cachedir)
+        self.path = os.path.join(cachedir, "validation.pickle")
+        self.fontname = fontname
+        self.entries = self.load()["entries"]
+        self.new = {}
+        self.used = set()
+        self.hits = 0
+        self.misses = 0
+
+    def load(self):
+        try:
+            with open(self.path, "rb") as f:
+                data = pickle.load(f)
+        except (IOError, OSError, EOFError, pickle.UnpicklingError):
+            data = None
+        if not isinstance(data, dict) or "builds" not in data:
+            # missing, or written before builds were recorded
+            data = {"entries": {}, "builds": {}}
+        return data
+
+    def lookup(self, digest):
+        entry = self.entries.get(digest)
+        if entry is None:
+            self.misses += 1
+        else:
+            self.hits += 1
+            self.used.add(digest)
+        return entry
+
+    def store(self, digest, state, contours):
+        self.new[digest] = (state, contours)
+        self.used.add(digest)
+
+    def stats(self):
+        total = self.hits + self.misses
+        return self.hits, total, total and 100.0 * self.hits / total or 0.0
+
+    def save(self):
+        # other build processes might have saved in the mean time
+        data = self.load()
+        builds = data["builds"].setdefault(self.fontname, [])
+        if not self.new and builds and builds[-1] == self.used:
+            return
+        builds.append(self.used)
+        del builds[:-self.KEEP]
+
+        keep = set()
+        for used in data["builds"].values():
+            for digests in used:
+                keep.update(digests)
+        entries = data["entries"]
+        entries.update(self.new)
+        data["entries"] = dict((digest, entry) for digest, entry in entries.items() if digest in keep)
+
+        tmp = "%s.%d.tmp" % (self.path, os.getpid())
+        with open(tmp, "wb") as f:
+            pickle.dump(data, f, pickle.HIGHEST_PROTOCOL)
+        os.rename(tmp, self.path)
@@ -0,0 +1,197 @@
+# coding=utf-8
+#
+# glyphorder.py - Glyph id to glyph name index of compiled fonts
+#
+# To the extent possible under law, the author have dedicated all copyright
+# and related and neighboring rights to this software to the public domain
+# worldwide. This software is distributed without any warranty.
+#
+# You should have received a copy of the CC0 Public Domain Dedication along
+# with this software. If not, see
+# <http://creativecommons.org/publicdomain/zero/1.0/>.
+
+"""Turns the glyph ids HarfBuzz returns into glyph names without keeping a
+decompiled font around: only the table directory and the ‘maxp’ and ‘post’
+tables are read, and the names are kept in an array indexed by glyph id.
+
+The index can also be saved as a sidecar file in a cache directory, a table
+of offsets followed by the names, which later runs memory map and read names
+from on demand. Sidecars are tied to the size and modification time of the
+font they were made from and remade when it changes."""
+
+import mmap
+import os
+import struct
+
+SIDECAR_MAGIC = b"AGO1"
+SIDECAR_HEADER = struct.Struct(">4sQQI")  # magic, font size, font mtime (us), count
+
+def readTables(f, tags):
+    """Reads the given tables of the sfnt file f, returns {tag: data}."""
+
+    f.seek(0)
+    header = f.read(12)
+    if len(header) < 12:
+        raise ValueError("not an OpenType font")
+    numTables = struct.unpack(">H", header[4:6])[0]
+    directory = f.read(16 * numTables)
+    tables = {}
+    for i in range(numTables):
+        tag, checksum, offset, length = struct.unpack(">4sLLL", directory[16 * i:16 * (i + 1)])
+        tag = tag.decode("latin-1")
+        if tag in tags:
+            f.seek(offset)
+            tables[tag] = f.read(length)
+    return tables
+
+def postNames(post, numGlyphs):
+    """Glyph names from a format 2.0 ‘post’ table, or None for the other
+    formats. Missing names are made up and duplicate names made unique the
+    same way as in fontTools (see post.build_psNameMapping), so that the
+    names match TTFont.getGlyphOrder()."""
+
+    from fontTools.ttLib.standardGlyphOrder import standardGlyphOrder
+
+    if struct.unpack(">L", post[:4])[0] != 0x00020000:
+        return None
+
+    # a count larger than ‘maxp’ is taken to be bogus, like fontTools does
+    count = min(struct.unpack(">H", post[32:34])[0], numGlyphs)
+    indices = struct.unpack(">%dH" % count, post[34:34 + 2 * count])
+    strings = []
+    pos = 34 + 2 * count
+    while pos < len(post):
+        length = ord(post[pos:pos + 1])
+        strings.append(post[pos + 1:pos + 1 + length].decode("latin-1"))
+        pos += 1 + length
+
+    psnames = []
+    for gid in range(numGlyphs):
+        name = ""
+        if gid < count:
+            index = indices[gid]
+            if index < 258:
+                name = standardGlyphOrder[index]
+            elif index - 258 < len(strings):
+                name = strings[index - 258]
+        psnames.append(name)
+
+    existing = set(psnames)
+    names = []
+    seen = {}
+    for gid, name in enumerate(psnames):
+        if not name:
+            name = "glyph%05d" % gid
+        if name in seen:
+            n = seen[name]
+            while "%s.%d" % (name, n) in existing:
+                n += 1
+            seen[name] = n + 1
+            name = "%s.%d" % (name, n)
+        seen[name] = 1
+        names.append(name)
+    return names
+
+def readNames(fontfile):
+    """The glyph names of a font, by glyph id."""
+
+    with open(fontfile, "rb") as f:
+        tables = readTables(f, ("maxp", "post"))
+    names = None
+    if "maxp" in tables and "post" in tables:
+        numGlyphs = struct.unpack(">H", tables["maxp"][4:6])[0]
+        names = postNames(tables["post"], numGlyphs)
+    if names is None:
+        # no names in ‘post’ (e.g. CFF fonts), let fontTools make them up
+        from fontTools.ttLib import TTFont
+        font = TTFont(fontfile, lazy=True)
+        names = list(font.getGlyphOrder())
+        font.close()
+    return names
+
+def fontStamp(fontfile):
+    st = os.stat(fontfile)
+    return st.st_size, int(st.st_mtime * 1000000)
+
+def writeSidecar(path, names, stamp):
+    encoded = [name.encode("utf-8") for name in names]
+    offsets = [0]
+    for name in encoded:
+        offsets.append(offsets[-1] + len(name))
+
+    directory = os.path.dirname(path)
+    if directory and not os.path.isdir(directory):
+        os.makedirs(directory)
+    tmp = "%s.%d.tmp" % (path, os.getpid())
+    with open(tmp, "wb") as f:
+        f.write(SIDECAR_HEADER.pack(SIDECAR_MAGIC, stamp[0], stamp[1], len(names)))
+        f.write(struct.pack(">%dL" % len(offsets), *offsets))
+        f.write(b"".join(encoded))
+    os.rename(tmp, path)
+
+class GlyphOrder(object):
+    """Glyph names by glyph id, from a list or from a memory mapped sidecar
+    (names are decoded the first time they are looked up)."""
+
+    def __init__(self, names=None, sidecar=None):
+        self.map = None
+        if sidecar is not None:
+            with open(sidecar, "rb") as f:
+                self.map = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+            magic, size, mtime, self.count = SIDECAR_HEADER.unpack_from(self.map, 0)
+            self.offsets = SIDECAR_HEADER.size
+            self.data = self.offsets + 4 * (self.count + 1)
+            self.names = [None] * self.count
+        else:
+            self.count = len(names)
+            self.names = names
+
+    def __len__(self):
+        return self.count
+
+    def __getitem__(self, gid):
+        return self.getGlyphName(gid)
+
+    def getGlyphName(self, gid):
+        if gid >= self.count:
+            return "glyph%05d" % gid
+        name = self.names[gid]
+        if name is None:
+            start, end = struct.unpack_from(">LL", self.map, self.offsets + 4 * gid)
+            name = self.map[self.data + start:self.data + end].decode("utf-8")
+            self.names[gid] = name
+        return name
+
+    def close(self):
+        if self.map is not None:
+            self.map.close()
+            self.map = None
+
+def sidecarPath(fontfile, cachedir):
+    return os.path.join(cachedir, "glyphorder", os.path.basename(fontfile) + ".names")
+
+def sidecarStamp(path):
+    try:
+        with open(path, "rb") as f:
+            header = f.read(SIDECAR_HEADER.size)
+        magic, size, mtime, count = SIDECAR_HEADER.unpack(header)
+    except (IOError, OSError, struct.error):
+        return None
+    if magic != SIDECAR_MAGIC:
+        return None
+    return size, mtime
+
+def openGlyphOrder(fontfile, cachedir=None):
+    """The glyph order of a font, through its sidecar in cachedir if given,
+    making or remaking the sidecar as needed."""
+
+    if not cachedir:
+        return GlyphOrder(readNames(fontfile))
+
+    path = sidecarPath(fontfile, cachedir)
+    stamp = fontStamp(fontfile)
+    if sidecarStamp(path) != stamp:
+        names = readNames(fontfile)
+        writeSidecar(path, names, stamp)
+        return GlyphOrder(names)
+    return GlyphOrder(sidecar=path)
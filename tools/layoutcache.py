@@ -0,0 +1,146 @@
+# coding=utf-8
+#
+# layoutcache.py - Cache of compiled OpenType layout tables
+#
+# To the extent possible under law, the author have dedicated all copyright
+# and related and neighboring rights to this software to the public domain
+# worldwide. This software is distributed without any warranty.
+#
+# You should have received a copy of the CC0 Public Domain Dedication along
+# with this software. If not, see
+# <http://creativecommons.org/publicdomain/zero/1.0/>.
+
+"""Keeps the GDEF, GSUB and GPOS tables of generated fonts, so that a build
+whose feature file, anchors and glyph set did not change can skip feature
+compilation and have the stored tables put into the generated font.
+
+An index records the keys used by the last KEEP builds of each font file,
+tables no recorded build used are removed."""
+
+import fcntl
+import hashlib
+import json
+import os
+
+try:
+    import cPickle as pickle
+except ImportError:
+    import pickle
+
+from fontTools.ttLib import TTFont, newTable
+
+TABLES = ("GDEF", "GSUB", "GPOS")
+
+KEEP = 4 # number of keys kept per font file
+
+def fontFingerprint(font):
+    """Everything in a FontForge font, other than the feature file itself,
+    that feature compilation (and the lookups we add after it) depends on."""
+
+    data = [repr(font.markClasses), repr(font.markSets)]
+    for glyph in font.glyphs():
+        refs = tuple(ref[0] for ref in glyph.references)
+        data.append(repr((glyph.glyphname, glyph.unicode, glyph.glyphclass, glyph.width, refs)))
+    return "\n".join(data)
+
+def layoutKey(*parts):
+    key = hashlib.sha1()
+    for part in parts:
+        if not isinstance(part, bytes):
+            part = part.encode("utf-8")
+        key.update(hashlib.sha1(part).digest())
+    return key.hexdigest()
+
+def saveFont(ttfont, path):
+    tmp = "%s.%d.tmp" % (path, os.getpid())
+    ttfont.save(tmp)
+    ttfont.close()
+    os.rename(tmp, path)
+
+class LayoutCache(object):
+    def __init__(self, cachedir):
+        self.directory = os.path.join(cachedir, "layout")
+        if not os.path.isdir(self.directory):
+            os.makedirs(self.directory)
+
+    def record(self, key, fontfile):
+        """Remembers that the build of fontfile used key, and removes the
+        tables none of the last KEEP builds of any font used."""
+
+        index = os.path.join(self.directory, "index.json")
+        # builds of other fonts update the index at the same time
+        with open(index + ".lock", "w") as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            try:
+                with open(index) as f:
+                    fonts = json.load(f)
+            except (IOError, OSError, ValueError):
+                fonts = {}
+
+            name = os.path.basename(fontfile)
+            keys = [k for k in fonts.get(name, []) if k != key] + [key]
+            fonts[name] = keys[-KEEP:]
+
+            tmp = "%s.%d.tmp" % (index, os.getpid())
+            with open(tmp, "w") as f:
+                json.dump(fonts, f, indent=1, sort_keys=True)
+            os.rename(tmp, index)
+
+            keep = set(k for keys in fonts.values() for k in keys)
+            for filename in os.listdir(self.directory):
+                stored, ext = os.path.splitext(filename)
+                if ext == ".pickle" and stored not in keep:
+                    os.remove(os.path.join(self.directory, filename))
+
+    def path(self, key):
+        return os.path.join(self.directory, key + ".pickle")
+
+    def has(self, key):
+        return os.path.exists(self.path(key))
+
+    def store(self, key, fontfile):
+        """Saves the layout tables of a freshly generated font."""
+
+        ttfont = TTFont(fontfile)
+        entry = {
+            "glyphOrder": ttfont.getGlyphOrder(),
+            "maxContext": ttfont["OS/2"].usMaxContext,
+            "tables": dict((tag, ttfont.getTableData(tag)) for tag in TABLES if tag in ttfont),
+        }
+        ttfont.close()
+
+        tmp = "%s.%d.tmp" % (self.path(key), os.getpid())
+        with open(tmp, "wb") as f:
+            pickle.dump(entry, f, pickle.HIGHEST_PROTOCOL)
+        os.rename(tmp, self.path(key))
+
+    def inject(self, key, fontfile):
+        """Replaces the layout tables of a font generated without compiling
+        the features with the stored ones. Returns False if the entry is gone
+        (the build of another font may have removed it since has()) or the
+        font does not have the glyph order the tables were compiled for, the
+        features then have to be compiled and the tables stored again."""
+
+        try:
+            with open(self.path(key), "rb") as f:
+                entry = pickle.load(f)
+        except (IOError, OSError, EOFError, pickle.UnpicklingError):
+            return False
+
+        # tables we don't touch are copied as is when saving
+        ttfont = TTFont(fontfile)
+        if ttfont.getGlyphOrder() != entry["glyphOrder"]:
+            ttfont.close()
+            return False
+
+        for tag in TABLES:
+            if tag in ttfont:
+                del ttfont[tag]
+            if tag in entry["tables"]:
+                table = newTable(tag)
+                table.decompile(entry["tables"][tag], ttfont)
+                ttfont[tag] = table
+        ttfont["OS/2"].usMaxContext = entry["maxContext"]
+
+        saveFont(ttfont, fontfile)
+        return True
@@ -0,0 +1,122 @@
+#!/usr/bin/env python
+# coding=utf-8
+#
+# layoutstats.py - Layout table statistics and shaping speed of fonts
+#
+# To the extent possible under law, the author have dedicated all copyright
+# and related and neighboring rights to this software to the public domain
+# worldwide. This software is distributed without any warranty.
+#
+# You should have received a copy of the CC0 Public Domain Dedication along
+# with this software. If not, see
+# <http://creativecommons.org/publicdomain/zero/1.0/>.
+
+"""Prints the number of GSUB and GPOS lookups and subtables of one or more
+fonts, and the time HarfBuzz takes to shape a text with each of them, so that
+changes to the generated lookups can be compared before and after, e.g.:
+
+    layoutstats.py old/amiri-quran.ttf amiri-quran.ttf --overline
+
+The default text is the Quran samples in the test suite, --overline and
+--underline add U+0305 or U+0332 after every letter to exercise the
+over/underline lookups."""
+
+from __future__ import print_function
+
+import argparse
+import io
+import os
+import re
+import time
+import unicodedata
+
+from fontTools.ttLib import TTFont
+
+from shaping import Shaper
+
+TESTS = os.path.join(os.path.dirname(__file__), os.pardir, "test-suite")
+TEXTS = ("fatiha.pango", "baqara-intro.pango")
+
+def layoutStats(fontname):
+    """Returns {table: (lookups, lookups used by features, subtables)}."""
+
+    ttfont = TTFont(fontname)
+    stats = {}
+    for tag in ("GSUB", "GPOS"):
+        if tag not in ttfont:
+            continue
+        table = ttfont[tag].table
+        used = set()
+        if table.FeatureList:
+            for record in table.FeatureList.FeatureRecord:
+                used.update(record.Feature.LookupListIndex)
+        lookups = table.LookupList and table.LookupList.Lookup or []
+        subtables = sum(len(lookup.SubTable) for lookup in lookups)
+        stats[tag] = (len(lookups), len(used), subtables)
+    ttfont.close()
+    return stats
+
+def readText(paths, marks):
+    """Reads the text files, dropping Pango markup, and adds the given marks
+    after every letter."""
+
+    lines = []
+    for path in paths:
+        with io.open(path, encoding="utf-8") as f:
+            for line in f:
+                line = re.sub(r"<[^>]*>", "", line).strip()
+                if not line:
+                    continue
+                if marks:
+                    line = "".join(c + (unicodedata.category(c) == "Lo" and marks or "") for c in line)
+                lines.append(line)
+    return lines
+
+def shapingTime(fontname, lines, repeat):
+    """Best time, out of repeat runs, to shape all the lines."""
+
+    shaper = Shaper(fontname)
+    rows = [(None, None, None, None, line) for line in lines]
+    best = None
+    for i in range(repeat):
+        start = time.time()
+        shaper.shapeMany(rows)
+        elapsed = time.time() - start
+        if best is None or elapsed < best:
+            best = elapsed
+    return best
+
+def main():
+    parser = argparse.ArgumentParser(description="Compare layout tables and shaping speed of fonts.")
+    parser.add_argument("fonts", metavar="FONT", nargs="+", help="fonts to compare, the first is the reference")
+    parser.add_argument("--text", metavar="FILE", action="append",
+            help="text file to shape, can be repeated (default: the Quran samples of the test suite)")
+    parser.add_argument("--overline", action="store_true", help="add an overline after every letter")
+    parser.add_argument("--underline", action="store_true", help="add an underline after every letter")
+    parser.add_argument("--repeat", metavar="N", type=int, default=20, help="number of timed runs (default: 20)")
+
+    args = parser.parse_args()
+
+    marks = (args.overline and u"\u0305" or u"") + (args.underline and u"\u0332" or u"")
+    texts = args.text or [os.path.join(TESTS, t) for t in TEXTS]
+    lines = readText(texts, marks)
+    chars = sum(len(line) for line in lines)
+
+    print("%-24s %5s %5s %6s %5s %5s %6s %10s %7s" % ("font", "GSUB", "used", "subtb",
+          "GPOS", "used", "subtb", "us/char", "ratio"))
+
+    reference = None
+    for fontname in args.fonts:
+        stats = layoutStats(fontname)
+        perchar = shapingTime(fontname, lines, args.repeat) * 1e6 / chars
+        if reference is None:
+            reference = perchar
+        gsub = stats.get("GSUB", (0, 0, 0))
+        gpos = stats.get("GPOS", (0, 0, 0))
+        print("%-24s %5d %5d %6d %5d %5d %6d %10.3f %7.2f" % ((os.path.basename(fontname),) +
+              gsub + gpos + (perchar, perchar / reference)))
+
+    print("%d lines, %d characters, best of %d runs" % (len(lines), chars, args.repeat))
+
+if __name__ == "__main__":
+    main()
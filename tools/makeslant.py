@@ -0,0 +1,242 @@
+#!/usr/bin/env python3
+# coding=utf-8
+#
+# makeslant.py - Slanted fonts from compiled upright ones
+#
+# To the extent possible under law, the author have dedicated all copyright
+# and related and neighboring rights to this software to the public domain
+# worldwide. This software is distributed without any warranty.
+#
+# You should have received a copy of the CC0 Public Domain Dedication along
+# with this software. If not, see
+# <http://creativecommons.org/publicdomain/zero/1.0/>.
+
+"""Makes a slanted font out of a compiled upright one, as build.py's
+makeSlanted() does from the sources, e.g.:
+
+    makeslant.py amiri-regular.ttf amiri-slanted.ttf --slant 10
+
+The upright-only Arabic math alphanumerics are removed, the outlines,
+component offsets and GPOS anchors of all glyphs but a few punctuation ones
+are skewed, and the style names and italic flags are updated. This is the
+SLANT=post mode of the Makefile; the Latin glyphs are obliqued upright ones
+rather than the Latin italics."""
+
+import argparse
+import math
+import re
+
+import numpy
+
+from fontTools.ttLib import TTFont
+from fontTools.ttLib.tables._g_l_y_f import GlyphCoordinates
+from fontTools import subset
+
+# glyphs that are kept upright, as in build.py's makeSlanted()
+PUNCT = ("period", "guillemotleft", "guillemotright", "braceleft", "bar",
+         "braceright", "bracketleft", "bracketright", "parenleft",
+         "parenright", "slash", "backslash", "brokenbar", "uni061F")
+
+# build.py makes the numerators after slanting, by raising the slanted small
+# digits by this amount, so that raise is not slanted
+NUMERATOR_RAISE = 550
+
+# Arabic math alphanumerics are upright-only, they are removed
+UPRIGHT_ONLY = (0x1EE00, 0x1EEFF)
+
+def removeUprightOnly(font):
+    """Removes the glyphs of the upright-only ranges, keeping everything else
+    in the font."""
+
+    cmap = font.getBestCmap()
+    drop = set(name for code, name in cmap.items() if UPRIGHT_ONLY[0] <= code <= UPRIGHT_ONLY[1])
+    if not drop:
+        return
+
+    keep = [name for name in font.getGlyphOrder() if name not in drop]
+    unicodes = [code for code in cmap if not UPRIGHT_ONLY[0] <= code <= UPRIGHT_ONLY[1]]
+
+    options = subset.Options()
+    options.set(layout_features='*', name_IDs='*', name_languages='*', name_legacy=True,
+                glyph_names=True, notdef_outline=True, recalc_bounds=True,
+                legacy_kern=True, hinting=True, drop_tables=[], passthrough_tables=True,
+                prune_unicode_ranges=False, legacy_cmap=True, symbol_cmap=True)
+    subsetter = subset.Subsetter(options=options)
+    subsetter.populate(glyphs=keep, unicodes=unicodes)
+    subsetter.subset(font)
+
+    # like FontForge, only keep the full Unicode subtables if they are needed
+    cmap = font["cmap"]
+    if all(code <= 0xFFFF for code in unicodes):
+        cmap.tables = [t for t in cmap.tables if t.format not in (12, 13)]
+
+def slantedGlyphs(font):
+    """Names of the glyphs to slant. The .refN glyphs FontForge splits out of
+    glyphs mixing outlines and references follow the glyph they came from."""
+
+    slanted = set()
+    for name in font.getGlyphOrder():
+        base = re.sub(r"\.ref\d+$", "", name)
+        if base not in PUNCT:
+            slanted.add(name)
+    return slanted
+
+def skewMatrix(k):
+    return numpy.array([[1.0, -k], [0.0, 1.0]])
+
+def skewGlyphs(font, slanted, k):
+    """Skews the outlines of the slanted glyphs in one pass over all their
+    points, and fixes component offsets and transforms so that composite
+    glyphs stay in sync with their (slanted or upright) components."""
+
+    glyf = font["glyf"]
+
+    simple = [name for name in slanted if glyf[name].numberOfContours > 0]
+    if simple:
+        coordinates = [numpy.array(glyf[name].coordinates, dtype=float).reshape(-1, 2) for name in simple]
+        points = numpy.concatenate(coordinates)
+        points[:, 0] -= k * points[:, 1]
+        points = numpy.rint(points).astype(int)
+        offsets = numpy.cumsum([len(c) for c in coordinates])[:-1]
+        for name, new in zip(simple, numpy.split(points, offsets)):
+            glyf[name].coordinates = GlyphCoordinates(new.tolist())
+
+    # with S the skew, a component with transform A and offset d of a
+    # slanted glyph becomes S A S^-1 and S d, like FontForge does it
+    # references to upright glyphs are left alone
+    skew = skewMatrix(k)
+    unskew = numpy.linalg.inv(skew)
+    for name in font.getGlyphOrder():
+        glyph = glyf[name]
+        if not glyph.isComposite() or name not in slanted:
+            continue
+        raised = name.endswith(".numr") and NUMERATOR_RAISE or 0
+        for component in glyph.components:
+            if component.glyphName not in slanted:
+                continue
+            if hasattr(component, "transform"):
+                # fontTools uses row vectors
+                matrix = numpy.array(component.transform, dtype=float).T
+                matrix = skew.dot(matrix).dot(unskew)
+                component.transform = matrix.T.tolist()
+            component.x = int(round(component.x - k * (component.y - raised)))
+
+    for name in font.getGlyphOrder():
+        glyf[name].recalcBounds(glyf)
+
+    hmtx = font["hmtx"]
+    for name in font.getGlyphOrder():
+        glyph = glyf[name]
+        width = hmtx[name][0]
+        hmtx[name] = (width, glyph.numberOfContours and glyph.xMin or 0)
+
+def anchorRecords(subtable):
+    """Yields (glyph, anchor) for every anchor of a cursive or mark
+    attachment subtable."""
+
+    kind = subtable.LookupType
+    if kind == 3:
+        for glyph, record in zip(subtable.Coverage.glyphs, subtable.EntryExitRecord):
+            yield glyph, record.EntryAnchor
+            yield glyph, record.ExitAnchor
+        return
+
+    if kind == 6:
+        marks = zip(subtable.Mark1Coverage.glyphs, subtable.Mark1Array.MarkRecord)
+        bases = zip(subtable.Mark2Coverage.glyphs, subtable.Mark2Array.Mark2Record)
+        anchors = lambda record: record.Mark2Anchor
+    elif kind == 5:
+        marks = zip(subtable.MarkCoverage.glyphs, subtable.MarkArray.MarkRecord)
+        bases = zip(subtable.LigatureCoverage.glyphs, subtable.LigatureArray.LigatureAttach)
+        anchors = lambda record: [a for c in record.ComponentRecord for a in c.LigatureAnchor]
+    else:
+        marks = zip(subtable.MarkCoverage.glyphs, subtable.MarkArray.MarkRecord)
+        bases = zip(subtable.BaseCoverage.glyphs, subtable.BaseArray.BaseRecord)
+        anchors = lambda record: record.BaseAnchor
+
+    for glyph, record in marks:
+        yield glyph, record.MarkAnchor
+    for glyph, record in bases:
+        for anchor in anchors(record):
+            yield glyph, anchor
+
+def skewAnchors(font, slanted, k):
+    """Moves the GPOS anchors of the slanted glyphs with their outlines."""
+
+    if "GPOS" not in font:
+        return
+
+    anchors = {}
+    for lookup in font["GPOS"].table.LookupList.Lookup:
+        for subtable in lookup.SubTable:
+            if lookup.LookupType == 9:
+                subtable = subtable.ExtSubTable
+            if subtable.LookupType not in (3, 4, 5, 6):
+                continue
+            for glyph, anchor in anchorRecords(subtable):
+                # anchors can be shared between records
+                if anchor is not None and glyph in slanted:
+                    anchors[id(anchor)] = anchor
+
+    anchors = list(anchors.values())
+    if anchors:
+        points = numpy.array([(a.XCoordinate, a.YCoordinate) for a in anchors], dtype=float)
+        xs = numpy.rint(points[:, 0] - k * points[:, 1]).astype(int).tolist()
+        for anchor, x in zip(anchors, xs):
+            anchor.XCoordinate = x
+
+def updateInfo(font, slant):
+    font["post"].italicAngle = slant
+    font["hhea"].caretSlopeRise = 100
+    font["hhea"].caretSlopeRun = -int(round(100 * math.tan(math.radians(slant))))
+
+    # italic, not regular
+    font["OS/2"].fsSelection = (font["OS/2"].fsSelection | 1) & ~(1 << 6)
+    font["head"].macStyle |= 2
+
+    name = font["name"]
+    fullname = name.getDebugName(4)
+    bold = name.getDebugName(2) == "Bold"
+    for record in name.names:
+        text = record.toUnicode()
+        if record.nameID == 2:
+            if record.langID == 0xC01:
+                text = bold and u"عريض مائل" or u"مائل"
+            else:
+                text = bold and "Bold Slanted" or "Slanted"
+        elif record.nameID in (3, 4):
+            text = text.replace(fullname, fullname + " Slanted")
+        elif record.nameID == 6:
+            text = bold and text.replace("Bold", "BoldSlanted") or text.replace("Regular", "Slanted")
+        else:
+            continue
+        record.string = text
+
+def makeSlant(args):
+    """Makes a slanted font from a compiled upright one."""
+
+    font = TTFont(args.file)
+    k = math.tan(math.radians(args.slant))
+
+    removeUprightOnly(font)
+
+    slanted = slantedGlyphs(font)
+    skewGlyphs(font, slanted, k)
+    skewAnchors(font, slanted, k)
+    updateInfo(font, args.slant)
+
+    font.save(args.output)
+    font.close()
+
+def main():
+    parser = argparse.ArgumentParser(description="Create a slanted version of a compiled upright Amiri font.")
+    parser.add_argument("file", help="input upright font")
+    parser.add_argument("output", help="output slanted font")
+    parser.add_argument("--slant", metavar="DEGREES", type=float, default=10, help="slant angle (default: 10)")
+
+    args = parser.parse_args()
+
+    makeSlant(args)
+
+if __name__ == "__main__":
+    main()
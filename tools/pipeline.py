@@ -0,0 +1,503 @@
+#!/usr/bin/env python3
+# coding=utf-8
+#
+# pipeline.py - Amiri build orchestrator
+#
+# To the extent possible under law, the author have dedicated all copyright
+# and related and neighboring rights to this software to the public domain
+# worldwide. This software is distributed without any warranty.
+#
+# You should have received a copy of the CC0 Public Domain Dedication along
+# with this software. If not, see
+# <http://creativecommons.org/publicdomain/zero/1.0/>.
+
+"""Runs the same pipeline as the Makefile, modelled as a graph of stages.
+
+Dependencies between stages are derived from their input and output files,
+stages whose outputs are up to date are skipped, and the rest are scheduled
+on a pool of worker processes, starting with the stage with the longest
+estimated path to the end of the pipeline. Durations are remembered between
+runs to improve the estimates, and a critical path report is printed at the
+end."""
+
+from __future__ import print_function
+
+import argparse
+import glob
+import heapq
+import json
+import os
+import sys
+import time
+
+import artifacts
+import feapp
+
+NAME = "amiri"
+TOOLS = "tools"
+SRC = "sources"
+WEB = "webfonts"
+DOC = "documentation"
+TESTS = "test-suite"
+
+PY = sys.executable
+FF = "python2.7"
+
+# Tool scripts, a change to any of them invalidates the outputs of the stages
+# using them. build.py has the same list for its own caches.
+BUILD_TOOLS = ["build.py", "sfdcache.py", "glyphcache.py", "refgraph.py", "catalogue.py", "layoutcache.py", "anchors.py", "geometry.py",
+               "buildtrace.py"]
+
+# Rough estimates in seconds, used until we have timings from a previous run.
+ESTIMATES = {
+    "build": 150.0,
+    "makeclr": 15.0,
+    "makeweb": 30.0,
+    "makecss": 3.0,
+    "ots": 2.0,
+    "runtest": 60.0,
+    "table": 30.0,
+    "documentation": 90.0,
+}
+
+# (font, source, Latin source, kind, feature file defines)
+VARIANTS = (
+    ("regular", "regular", "regular", "regular", ()),
+    ("quran", "regular", "regular", "quran", ("QURAN",)),
+    ("slanted", "regular", "italic", "slanted", ("ITALIC",)),
+    ("bold", "bold", "bold", "regular", ()),
+    ("boldslanted", "bold", "bolditalic", "slanted", ("ITALIC",)),
+)
+
+SLANT = 10
+
+def tool(name):
+    return os.path.join(TOOLS, name)
+
+def fontFile(style):
+    return "%s-%s.ttf" % (NAME, style)
+
+class Stage(object):
+    """A node in the pipeline graph. command is either an argument list to
+    execute, or a Python callable that is run in a forked child."""
+
+    def __init__(self, name, kind, command, inputs, outputs):
+        self.name = name
+        self.kind = kind
+        self.command = command
+        self.inputs = list(inputs)
+        self.outputs = list(outputs)
+        self.deps = set()
+        self.users = set()
+        self.stale = True
+        self.estimate = ESTIMATES.get(kind, 1.0)
+        self.rank = 0.0
+        self.start = None
+        self.end = None
+        self.status = None
+        self.cached = False
+
+    def duration(self):
+        if self.start is None or self.end is None:
+            return 0.0
+        return self.end - self.start
+
+    def __lt__(self, other):
+        return self.name < other.name
+
+    def __repr__(self):
+        return "<Stage %s>" % self.name
+
+def newestInput(path):
+    """Modification time of a file, or of the newest file in a directory."""
+
+    if os.path.isdir(path):
+        mtimes = [os.path.getmtime(os.path.join(path, f)) for f in os.listdir(path)]
+        return max(mtimes + [os.path.getmtime(path)])
+    return os.path.getmtime(path)
+
+def isUpToDate(stage):
+    if not stage.outputs:
+        return False
+    for output in stage.outputs:
+        if not os.path.exists(output):
+            return False
+    oldest = min(os.path.getmtime(o) for o in stage.outputs)
+    for i in stage.inputs:
+        if os.path.exists(i) and newestInput(i) > oldest:
+            return False
+    return True
+
+def preprocessFeatures():
+    """Preprocesses the feature files of all the fonts in this process,
+    before the stages are set up. A preprocessed file is only rewritten when
+    its contents change, so the build stages of the other fonts stay up to
+    date."""
+
+    preprocessor = feapp.Preprocessor([SRC])
+    for style, source, latin, kind, defines in VARIANTS:
+        pp = os.path.join(SRC, "%s-%s.fea.pp" % (NAME, style))
+        if feapp.run(preprocessor, os.path.join(SRC, NAME + ".fea"), pp, defines, pp + ".d"):
+            print("   PP\t%s" % pp)
+
+def buildStages(version, styles, cache, incremental=False, directAnchors=False, trace=None):
+    """One build.py invocation per source font, building all the requested
+    fonts that use it with the load-once, fork-many driver."""
+
+    stages = []
+    masters = []
+    for style, source, latin, kind, defines in VARIANTS:
+        if style in styles and source not in masters:
+            masters.append(source)
+
+    for master in masters:
+        inputs = [tool(t) for t in BUILD_TOOLS]
+        inputs.append(os.path.join(SRC, "%s-%s.sfdir" % (NAME, master)))
+        outputs = []
+        command = [FF, tool("build.py"), "--version", version, "--slant=%s" % SLANT]
+        for style, source, latin, kind, defines in VARIANTS:
+            if source != master or style not in styles:
+                continue
+            sfdir = os.path.join(SRC, "%s-%s.sfdir" % (NAME, source))
+            pp = os.path.join(SRC, "%s-%s.fea.pp" % (NAME, style))
+            command.append("--variant=%s,%s,%s,%s" % (kind, sfdir, fontFile(style), pp))
+            inputs.append(os.path.join(SRC, "latin", "amirilatin-%s.sfdir" % latin))
+            inputs.append(pp)
+            outputs.append(fontFile(style))
+        if cache:
+            command.append("--cache=" + cache)
+            if incremental:
+                command.append("--incremental")
+        if directAnchors:
+            command.append("--direct-anchors")
+        if trace:
+            command.append("--trace=" + os.path.join(trace, "build-%s.json" % master))
+        stages.append(Stage("build " + master, "build", command, inputs, outputs))
+
+    return stages
+
+def postStages(targets):
+    stages = []
+    fonts = [fontFile(v[0]) for v in VARIANTS]
+    fonts.insert(2, fontFile("quran-colored"))
+
+    stages.append(Stage("makeclr", "makeclr",
+        [PY, tool("makeclr.py"), fontFile("quran"), fontFile("quran-colored")],
+        [fontFile("quran"), tool("makeclr.py")], [fontFile("quran-colored")]))
+
+    if "web" in targets:
+        webfonts = []
+        for font in fonts:
+            base = os.path.splitext(font)[0]
+            outputs = [os.path.join(WEB, base + ext) for ext in (".ttf", ".woff", ".woff2")]
+            webfonts.append(outputs[0])
+            stages.append(Stage("makeweb " + base, "makeweb",
+                [PY, tool("makeweb.py"), font, WEB], [font, tool("makeweb.py")], outputs))
+        css = os.path.join(WEB, NAME + ".css")
+        stages.append(Stage("makecss", "makecss",
+            [PY, tool("makecss.py"), "--css=" + css, "--fonts=" + " ".join(webfonts)],
+            webfonts + [tool("makecss.py")], [css]))
+
+    if "check" in targets:
+        for font in fonts:
+            stages.append(Stage("ots " + font, "ots", ["ot-sanitise", font], [font], []))
+        tests = sorted(glob.glob(os.path.join(TESTS, "*.test")) + glob.glob(os.path.join(TESTS, "*.ptest")))
+        stages.append(Stage("runtest", "runtest", [PY, tool("runtest.py")] + tests,
+            fonts + tests + [tool("runtest.py")], []))
+
+    if "doc" in targets:
+        table = os.path.join(DOC, NAME + "-table.pdf")
+        command = ["sh", "-c", "fntsample --font-file %(font)s --output-file %(out)s.tmp --print-outline > %(out)s.txt"
+                   " && pdfoutline %(out)s.tmp %(out)s.txt %(out)s && rm -f %(out)s.tmp %(out)s.txt"
+                   % {"font": fontFile("regular"), "out": table}]
+        stages.append(Stage("table", "table", command, [fontFile("regular")], [table]))
+        tex = os.path.join(DOC, "documentation-arabic.tex")
+        stages.append(Stage("documentation", "documentation",
+            ["latexmk", "--norc", "--xelatex", "--quiet", "--output-directory=" + DOC, tex],
+            [tex] + fonts, [os.path.join(DOC, "documentation-arabic.pdf")]))
+
+    return stages
+
+def makeGraph(stages):
+    """Connects each stage to the stages producing its inputs, and decides
+    which stages need to run."""
+
+    producers = {}
+    for stage in stages:
+        for output in stage.outputs:
+            producers[output] = stage
+
+    for stage in stages:
+        for i in stage.inputs:
+            if i in producers and producers[i] is not stage:
+                stage.deps.add(producers[i])
+                producers[i].users.add(stage)
+
+    order = topologicalOrder(stages)
+    for stage in order:
+        stage.stale = any(d.stale for d in stage.deps) or not isUpToDate(stage)
+
+    return order
+
+def topologicalOrder(stages):
+    order = []
+    pending = dict((s, len(s.deps)) for s in stages)
+    ready = sorted(s for s in stages if not s.deps)
+    while ready:
+        stage = ready.pop(0)
+        order.append(stage)
+        for user in sorted(stage.users):
+            pending[user] -= 1
+            if not pending[user]:
+                ready.append(user)
+    if len(order) != len(stages):
+        raise ValueError("dependency cycle between stages: %s" %
+                ", ".join(s.name for s in stages if s not in order))
+    return order
+
+def computeRanks(order):
+    """The rank of a stage is its estimated duration plus the longest ranked
+    path from it to the end of the pipeline, the scheduler starts the highest
+    ranked ready stage first."""
+
+    for stage in reversed(order):
+        own = stage.stale and stage.estimate or 0.0
+        stage.rank = own + max([u.rank for u in stage.users] + [0.0])
+
+def runStage(stage):
+    """Forks a child process running the stage, returns its pid."""
+
+    sys.stdout.flush()
+    sys.stderr.flush()
+    pid = os.fork()
+    if pid == 0:
+        try:
+            if callable(stage.command):
+                stage.command()
+                code = 0
+            else:
+                os.execvp(stage.command[0], stage.command)
+        except SystemExit as e:
+            code = e.code or 0
+        except BaseException:
+            import traceback
+            traceback.print_exc()
+            code = 1
+        sys.stdout.flush()
+        sys.stderr.flush()
+        os._exit(code)
+    return pid
+
+class ArtifactCache(object):
+    """Glue between the scheduler and an artifacts.py store. Stages with
+    outputs and a command line are cached, keyed on their inputs as they are
+    when the stage becomes ready to run."""
+
+    def __init__(self, location, cachedir):
+        self.store = artifacts.openStore(location)
+        self.cachedir = cachedir
+        self.keys = {}
+
+    def fetch(self, stage):
+        """Restores the outputs of the stage, returns False on a miss."""
+
+        if not stage.outputs or callable(stage.command):
+            return False
+        key = artifacts.actionKey(stage.command, stage.inputs, self.cachedir)
+        self.keys[stage] = key
+        return artifacts.restore(self.store, key, stage.outputs)
+
+    def save(self, stage):
+        key = self.keys.get(stage)
+        if key and all(os.path.exists(o) for o in stage.outputs):
+            artifacts.save(self.store, key, stage.outputs)
+
+def schedule(order, jobs, verbose=False, cache=None):
+    """Runs the stale stages, at most jobs of them at a time, taking their
+    outputs from the artifact cache instead when it has them. Returns the
+    list of failed stages."""
+
+    remaining = dict((s, len([d for d in s.deps if d.stale])) for s in order if s.stale)
+    ready = [(-s.rank, s) for s in remaining if not remaining[s]]
+    heapq.heapify(ready)
+    running = {}
+    failed = []
+
+    def finished(stage):
+        for user in stage.users:
+            if user in remaining:
+                remaining[user] -= 1
+                if not remaining[user]:
+                    heapq.heappush(ready, (-user.rank, user))
+
+    while ready or running:
+        while ready and len(running) < jobs and not failed:
+            rank, stage = heapq.heappop(ready)
+            stage.start = time.time()
+            if cache and cache.fetch(stage):
+                print("   CACHE\t%s" % stage.name)
+                stage.end = time.time()
+                stage.status = 0
+                stage.cached = True
+                finished(stage)
+                continue
+            print("   RUN\t%s" % stage.name)
+            if verbose and not callable(stage.command):
+                print("\t%s" % " ".join(stage.command))
+            running[runStage(stage)] = stage
+
+        if not running:
+            break
+
+        pid, status = os.wait()
+        stage = running.pop(pid)
+        stage.end = time.time()
+        stage.status = status
+        if status:
+            print("   FAIL\t%s" % stage.name)
+            failed.append(stage)
+            continue
+
+        if cache:
+            cache.save(stage)
+        finished(stage)
+
+    return failed
+
+def criticalPath(order):
+    """Returns the chain of stages that determined the total run time, using
+    the measured durations, along with the slack of every stage."""
+
+    finish = {}
+    prev = {}
+    for stage in order:
+        best = None
+        for dep in stage.deps:
+            if best is None or finish[dep] > finish[best]:
+                best = dep
+        finish[stage] = (best and finish[best] or 0.0) + stage.duration()
+        prev[stage] = best
+
+    total = max(finish.values() or [0.0])
+    latest = {}
+    for stage in reversed(order):
+        latest[stage] = min([latest[u] - u.duration() for u in stage.users] + [total])
+
+    path = []
+    stage = max(order, key=lambda s: finish[s]) if order else None
+    while stage is not None:
+        path.insert(0, stage)
+        stage = prev[stage]
+
+    slack = dict((s, latest[s] - finish[s]) for s in order)
+    return path, total, slack
+
+def report(order, wall):
+    ran = [s for s in order if s.start is not None]
+    if not ran:
+        print("Nothing to be done")
+        return
+
+    path, total, slack = criticalPath(order)
+
+    print("")
+    print("%-28s %10s %10s" % ("stage", "time (s)", "slack (s)"))
+    for stage in sorted(ran, key=lambda s: -s.duration()):
+        print("%-28s %10.2f %10.2f" % (stage.name, stage.duration(), slack[stage]))
+
+    print("")
+    print("Critical path (%.2fs of %.2fs wall time, %.2fs summed over all stages):" %
+          (total, wall, sum(s.duration() for s in ran)))
+    for stage in path:
+        if stage.start is not None:
+            print("   %-25s %10.2f" % (stage.name, stage.duration()))
+
+def loadTimings(path):
+    try:
+        with open(path) as f:
+            return json.load(f)
+    except (IOError, OSError, ValueError):
+        return {}
+
+def saveTimings(path, order, timings):
+    for stage in order:
+        if stage.start is not None and not stage.status and not stage.cached:
+            timings[stage.name] = stage.duration()
+    directory = os.path.dirname(path)
+    if directory and not os.path.isdir(directory):
+        os.makedirs(directory)
+    with open(path, "w") as f:
+        json.dump(timings, f, indent=1, sort_keys=True)
+
+def makeStages(targets, version, cache, incremental=False, directAnchors=False, trace=None):
+    styles = [v[0] for v in VARIANTS]
+    stages = buildStages(version, styles, cache, incremental, directAnchors, trace)
+    stages += postStages(targets)
+    return stages
+
+def main():
+    parser = argparse.ArgumentParser(description="Build Amiri fonts, running independent stages in parallel.")
+    parser.add_argument("targets", metavar="TARGET", nargs="*", default=["ttf", "web"],
+            help="what to build: ttf, web, check, doc or dist (default: ttf web)")
+    parser.add_argument("--version", metavar="VERSION", help="font version", required=True)
+    parser.add_argument("--jobs", "-j", metavar="N", type=int, default=os.cpu_count() or 1,
+            help="number of stages to run at once (default: number of CPUs)")
+    parser.add_argument("--cache", metavar="DIR", default=".cache", help="directory for build caches and timings")
+    parser.add_argument("--incremental", action="store_true",
+            help="only clean up glyphs that changed since the last build")
+    parser.add_argument("--direct-anchors", action="store_true",
+            help="compile anchor lookups directly instead of through the feature file")
+    parser.add_argument("--trace", metavar="DIR",
+            help="write a timing and memory trace of each build.py run to DIR")
+    parser.add_argument("--artifacts", metavar="DIR|URL",
+            help="artifact cache, a shared directory or an ‘artifacts.py serve’ URL (default: artifacts in the --cache directory)")
+    parser.add_argument("--no-artifacts", action="store_true", help="do not use the artifact cache")
+    parser.add_argument("--force", action="store_true", help="rerun all stages even if up to date")
+    parser.add_argument("--verbose", "-v", action="store_true", help="print commands being run")
+
+    args = parser.parse_args()
+
+    targets = set(args.targets)
+    if "dist" in targets:
+        targets |= set(("ttf", "web", "check", "doc"))
+
+    try:
+        preprocessFeatures()
+    except (feapp.PreprocessorError, IOError, OSError) as e:
+        print("   FAIL\tfeatures: %s" % e)
+        sys.exit(1)
+
+    stages = makeStages(targets, args.version, args.cache, args.incremental, args.direct_anchors, args.trace)
+    order = makeGraph(stages)
+
+    timingspath = os.path.join(args.cache, "timings.json")
+    timings = loadTimings(timingspath)
+    for stage in order:
+        if args.force:
+            stage.stale = True
+        if stage.name in timings:
+            stage.estimate = timings[stage.name]
+    computeRanks(order)
+
+    for directory in (WEB, DOC):
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+
+    cache = None
+    if not args.no_artifacts:
+        cache = ArtifactCache(args.artifacts or os.path.join(args.cache, "artifacts"), args.cache)
+
+    start = time.time()
+    failed = schedule(order, max(1, args.jobs), args.verbose, cache)
+    wall = time.time() - start
+
+    saveTimings(timingspath, order, timings)
+    report(order, wall)
+
+    if failed:
+        print("")
+        print("Failed stages: %s" % ", ".join(s.name for s in failed))
+        sys.exit(1)
+
+if __name__ == "__main__":
+    main()
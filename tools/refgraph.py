@@ -0,0 +1,96 @@
+# coding=utf-8
+#
+# refgraph.py - Glyph reference graph
+#
+# To the extent possible under law, the author have dedicated all copyright
+# and related and neighboring rights to this software to the public domain
+# worldwide. This software is distributed without any warranty.
+#
+# You should have received a copy of the CC0 Public Domain Dedication along
+# with this software. If not, see
+# <http://creativecommons.org/publicdomain/zero/1.0/>.
+
+"""The graph of glyphs and the components they reference, used to flatten
+nested references in a single pass over the font."""
+
+from sortsmill import psMat
+
+def topologicalOrder(components):
+    """Returns glyph names with every glyph after all the glyphs it
+    references, components being {name: [(component name, ...), ...]}.
+    Raises ValueError if references form a cycle."""
+
+    order = []
+    state = {} # 1: being visited, 2: done
+    for root in sorted(components):
+        if root in state:
+            continue
+        stack = [(root, iter(components[root]))]
+        state[root] = 1
+        while stack:
+            name, children = stack[-1]
+            for child in children:
+                child = child[0]
+                if state.get(child) == 1:
+                    cycle = [s[0] for s in stack]
+                    cycle = cycle[cycle.index(child):] + [child]
+                    raise ValueError("reference cycle: %s" % " -> ".join(cycle))
+                if child not in state:
+                    state[child] = 1
+                    stack.append((child, iter(components.get(child, ()))))
+                    break
+            else:
+                stack.pop()
+                state[name] = 2
+                order.append(name)
+
+    return order
+
+class ReferenceGraph(object):
+    """Built once from the current state of the font. A glyph with references
+    and no outlines of its own is a pure composite, references to it can be
+    replaced with references to its components. Every pure composite is
+    flattened exactly once, in topological order, so that the flattened
+    components of a glyph are ready before any glyph using it is visited."""
+
+    def __init__(self, font):
+        self.components = {}
+        self.composites = set()
+        for glyph in font.glyphs():
+            if glyph.references:
+                name = glyph.glyphname
+                self.components[name] = [(ref[0], ref[1]) for ref in glyph.references]
+                if glyph.foreground.isEmpty():
+                    self.composites.add(name)
+
+        self.order = topologicalOrder(self.components)
+
+        self.flattened = {}
+        self.depth = {}
+        for name in self.order:
+            components = self.components.get(name, ())
+            self.depth[name] = max([self.depth.get(c[0], 0) + 1 for c in components] + [0])
+            if name in self.composites:
+                self.flattened[name] = self.expand(components)
+
+    def expand(self, references):
+        """Replaces references to pure composites in the given (name, matrix)
+        list with their flattened components, composing the matrices."""
+
+        new_refs = []
+        for ref in references:
+            name, transform = ref[0], ref[1]
+            if name in self.flattened:
+                for component, matrix in self.flattened[name]:
+                    new_refs.append((component, psMat.compose(matrix, transform)))
+            else:
+                new_refs.append((name, transform))
+
+        return new_refs
+
+    def stats(self):
+        """Returns (number of glyphs with references, number of glyphs with
+        nested references, maximum nesting depth)."""
+
+        nested = [n for n in self.components if self.depth.get(n, 0) > 1]
+        return len(self.components), len(nested), max(list(self.depth.values()) + [0])
@@ -5,99 +5,53 @@ from __future__ import print_function
 import sys
 import os
 import csv
+import io
+import multiprocessing
+import subprocess
 
-import gi
-gi.require_version('HarfBuzz', '0.0')
-from gi.repository import HarfBuzz
-from gi.repository import GLib
-
-from fontTools.ttLib import TTFont
+from glyphorder import openGlyphOrder
+from shapecache import ShapeCache
+from shaping import Shaper, formatResult, harfbuzzVersion
 
 try:
     unicode
 except NameError:
     unicode = str
 
-try:
-    bytes
-except NameError:
-    bytes = str
-
 def toUnicode(s, encoding='utf-8'):
     return s if isinstance(s, unicode) else s.decode(encoding)
 
-def toBytes(s):
-    return s if isinstance(s, bytes) else s.encode()
-
-HbFonts = {}
-def getHbFont(fontname):
-    if fontname not in HbFonts:
-        font = open(fontname, "rb")
-        data = font.read()
-        font.close()
-        blob = HarfBuzz.glib_blob_create(GLib.Bytes.new(data))
-        face = HarfBuzz.face_create(blob, 0)
-        font = HarfBuzz.font_create(face)
-        upem = HarfBuzz.face_get_upem(face)
-        HarfBuzz.font_set_scale(font, upem, upem)
-        HarfBuzz.ot_font_set_funcs(font)
-
-        HbFonts[fontname] = font
+Shapers = {}
+def getShaper(fontname):
+    if fontname not in Shapers:
+        Shapers[fontname] = Shaper(fontname)
 
-    return HbFonts[fontname]
+    return Shapers[fontname]
 
-TtFonts = {}
-def getTtFont(fontname):
-    if fontname not in TtFonts:
-        font = TTFont(fontname)
-        TtFonts[fontname] = font
+GlyphOrders = {}
+CacheDir = None
+def getGlyphOrder(fontname):
+    if fontname not in GlyphOrders:
+        GlyphOrders[fontname] = openGlyphOrder(fontname, CacheDir)
 
-    return TtFonts[fontname]
+    return GlyphOrders[fontname]
 
 def runHB(direction, script, language, features, text, fontname, positions):
-    font = getHbFont(fontname)
-    buf = HarfBuzz.buffer_create()
-    text = toUnicode(text)
-    HarfBuzz.buffer_add_utf8(buf, text.encode('utf-8'), 0, -1)
-    HarfBuzz.buffer_set_direction(buf, HarfBuzz.direction_from_string(toBytes(direction)))
-    HarfBuzz.buffer_set_script(buf, HarfBuzz.script_from_string(toBytes(script)))
-    if language:
-        HarfBuzz.buffer_set_language(buf, HarfBuzz.language_from_string(toBytes(language)))
-
-    if features:
-        features = [HarfBuzz.feature_from_string(toBytes(fea))[1] for fea in features.split(',')]
-    else:
-        features = []
-    HarfBuzz.shape(font, buf, features)
-
-    info = HarfBuzz.buffer_get_glyph_infos(buf)
-    ttfont = getTtFont(fontname)
-    if positions:
-        pos = HarfBuzz.buffer_get_glyph_positions(buf)
-        glyphs = []
-        for i, p in zip(info, pos):
-            glyph = ttfont.getGlyphName(i.codepoint)
-            if p.x_offset or p.y_offset:
-                glyph += "@%d,%d" % (p.x_offset, p.y_offset)
-            glyph += "+%d" % p.x_advance
-            if p.y_advance:
-                glyph += ",%d" % p.y_advance
-            glyphs.append(glyph)
-        out = "|".join(glyphs)
-    else:
-        out = "|".join([ttfont.getGlyphName(i.codepoint) for i in info])
+    result = getShaper(fontname).shape(toUnicode(text), direction, script, language, features)
+    return formatResult(result, getGlyphOrder(fontname), positions)
 
-    return "[%s]" % out
+def shapeRows(test, font, positions, indices):
+    """Shapes the given rows of a test, returns their formatted results."""
 
-def runTest(test, font, positions):
-    count = 0
+    glyphorder = getGlyphOrder(font)
+    results = getShaper(font).shapeMany([test[i] for i in indices])
+    return [formatResult(result, glyphorder, positions) for result in results]
+
+def compareResults(test, results):
     failed = {}
     passed = []
-    for row in test:
-        count += 1
+    for count, (row, result) in enumerate(zip(test, results), 1):
         direction, script, language, features, text, reference = row
-        text = text.encode().decode('unicode-escape') if '\\' in text else text
-        result = runHB(direction, script, language, features, text, font, positions)
         if reference == result:
             passed.append(count)
         else:
@@ -105,6 +59,163 @@ def runTest(test, font, positions):
 
     return passed, failed
 
+def runTest(test, font, positions):
+    return compareResults(test, shapeRows(test, font, positions, range(len(test))))
+
+def readTest(testname):
+    """Reads a test file once, with the escapes in its text decoded."""
+
+    test = []
+    with io.open(testname, encoding="utf-8", newline="") as f:
+        for row in csv.reader(f, delimiter=';'):
+            direction, script, language, features, text, reference = row
+            text = text.encode().decode('unicode-escape') if '\\' in text else text
+            test.append((direction, script, language, features, text, reference))
+    return test
+
+Tests = {}
+
+def runCheck(task):
+    """Runs one check in a worker process: ("test", font, test file, rows
+    to shape) or ("ots", font). Returns the task and the formatted results
+    of the rows or the OTS output (None if it passed), or an error
+    message."""
+
+    try:
+        if task[0] == "ots":
+            process = subprocess.Popen(["ot-sanitise", task[1]], stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
+            output = toUnicode(process.communicate()[0])
+            return task, process.returncode and output or None
+        fontname, testname, indices = task[1:]
+        positions = os.path.splitext(testname)[1] == '.ptest'
+        return task, shapeRows(Tests[testname], fontname, positions, indices)
+    except Exception as e:
+        return task, "%s: %s" % (type(e).__name__, e)
+
+def runChecks(fonts, tests, otsfonts, jobs, cache=None, lookup=True):
+    """Runs every test file with every font, and OTS on otsfonts, on a pool
+    of jobs worker processes. The test files are parsed and the fonts loaded
+    here, before forking, so the workers share them instead of each reading
+    its own copy.
+
+    With a shaping cache, rows it has results for are not sent to the
+    workers (unless lookup is False), and the results the workers return
+    are stored in it from here. Returns a list of (task, passed, failed) and
+    the number of rows answered from the cache."""
+
+    for testname in tests:
+        Tests[testname] = readTest(testname)
+    keys = {}
+    for fontname in fonts:
+        shaper = getShaper(fontname)
+        getGlyphOrder(fontname)
+        if cache:
+            keys[fontname] = cache.fontKey(fontname, shaper.data, harfbuzzVersion())
+
+    tasks = [("ots", fontname) for fontname in otsfonts]
+    known = {}
+    cached = 0
+    for fontname in fonts:
+        for testname in tests:
+            positions = os.path.splitext(testname)[1] == '.ptest'
+            # position tests are only valid for the regular font
+            if positions and fontname != fonts[0]:
+                continue
+            test = Tests[testname]
+            results = {}
+            if cache and lookup:
+                stored = cache.lookup(keys[fontname], positions)
+                for i, row in enumerate(test):
+                    if tuple(row[:5]) in stored:
+                        results[i] = stored[tuple(row[:5])]
+            cached += len(results)
+            known[(fontname, testname)] = results
+            indices = [i for i in range(len(test)) if i not in results]
+            if indices:
+                tasks.append(("test", fontname, testname, indices))
+
+    if jobs > 1 and len(tasks) > 1:
+        try:
+            context = multiprocessing.get_context("fork")
+        except AttributeError:
+            context = multiprocessing
+        pool = context.Pool(min(jobs, len(tasks)))
+        try:
+            outputs = pool.map(runCheck, tasks, chunksize=1)
+        finally:
+            pool.close()
+            pool.join()
+    else:
+        outputs = [runCheck(task) for task in tasks]
+
+    checks = []
+    errors = {}
+    for task, output in outputs:
+        if task[0] == "ots":
+            checks.append((task, 0, output))
+            continue
+        fontname, testname, indices = task[1:]
+        if not isinstance(output, list):
+            errors[(fontname, testname)] = output
+            continue
+        test = Tests[testname]
+        known[(fontname, testname)].update(zip(indices, output))
+        if cache:
+            positions = os.path.splitext(testname)[1] == '.ptest'
+            cache.store(keys[fontname], positions, [tuple(test[i][:5]) + (result,)
+                        for i, result in zip(indices, output)])
+
+    for fontname in fonts:
+        for testname in tests:
+            if (fontname, testname) not in known:
+                continue
+            task = ("test", fontname, testname)
+            if (fontname, testname) in errors:
+                checks.append((task, 0, errors[(fontname, testname)]))
+                continue
+            results = known[(fontname, testname)]
+            test = Tests[testname]
+            passed, failed = compareResults(test, [results[i] for i in range(len(test))])
+            checks.append((task, len(passed), failed))
+
+    return checks, cached
+
+def report(results):
+    """Prints every failure, returns the number of failed checks."""
+
+    failures = 0
+    for task, passed, failed in results:
+        if task[0] == "ots":
+            print("   OTS\t%s" % task[1])
+            if failed:
+                failures += 1
+                print("%s: OTS failed" % task[1])
+                print(failed.rstrip())
+            continue
+
+        fontname, testname = task[1:]
+        if not failed:
+            continue
+        failures += 1
+        if not isinstance(failed, dict):
+            print("%s: font '%s', error: %s" % (os.path.basename(testname), fontname, failed))
+            continue
+        print("%s: font '%s', %d passed, %d failed" % (os.path.basename(testname),
+              fontname, passed, len(failed)))
+        for test in sorted(failed):
+            print(test)
+            print("direction:\t", failed[test][0])
+            print("script:   \t", failed[test][1])
+            print("language: \t", failed[test][2])
+            print("features: \t", failed[test][3])
+            print("string:   \t", failed[test][4])
+            print("reference:\t", failed[test][5])
+            print("result:   \t", failed[test][6])
+
+    checks = len(results)
+    print("   TEST\t%d checks, %d failed" % (checks, failures))
+    return failures
+
 def initTest(test, font, positions):
     out = ""
     for row in test:
@@ -135,34 +246,32 @@ if __name__ == '__main__':
             sys.exit(0)
 
     styles = ('regular', 'bold', 'slanted', 'boldslanted')
-    for style in styles:
-        fontname = 'amiri-%s.ttf' % style
-        print("   TEST\t%s" % fontname)
-        for testname in args:
-            positions = os.path.splitext(testname)[1] == '.ptest'
-
-            if positions and style != "regular":
-                continue
-
-            reader = csv.reader(open(testname), delimiter=';')
-
-            test = []
-            for row in reader:
-                test.append(row)
+    fonts = ['amiri-%s.ttf' % style for style in styles]
+    jobs = multiprocessing.cpu_count()
+    lookup = True
+    otsfonts = []
+    tests = []
+    for arg in args:
+        if arg.startswith("--ots="):
+            otsfonts.append(arg[len("--ots="):])
+        elif arg.startswith("--jobs="):
+            jobs = int(arg[len("--jobs="):])
+        elif arg.startswith("--cache="):
+            CacheDir = arg[len("--cache="):]
+        elif arg == "--no-cache":
+            # shape everything, still refreshing the cache
+            lookup = False
+        else:
+            tests.append(arg)
 
-            passed, failed = runTest(test, fontname, positions)
-            if failed:
-                message = "%s: font '%s', %d passed, %d failed" %(os.path.basename(testname),
-                        fontname, len(passed), len(failed))
-
-                print(message)
-                for test in failed:
-                    print(test)
-                    print("direction:\t", failed[test][0])
-                    print("script:   \t", failed[test][1])
-                    print("language: \t", failed[test][2])
-                    print("features: \t", failed[test][3])
-                    print("string:   \t", failed[test][4])
-                    print("reference:\t", failed[test][5])
-                    print("result:   \t", failed[test][6])
-                sys.exit(1)
+    for fontname in fonts:
+        print("   TEST\t%s" % fontname)
+    cache = None
+    if CacheDir:
+        cache = ShapeCache(os.path.join(CacheDir, "shaping.sqlite"))
+    checks, cached = runChecks(fonts, tests, otsfonts, jobs, cache, lookup)
+    if cache:
+        print("   CACHE\t%d test rows from the shaping cache, %d stored" % (cached, cache.stored))
+        cache.close()
+    if report(checks):
+        sys.exit(1)
@@ -0,0 +1,228 @@
+# coding=utf-8
+#
+# sfdcache.py - Content addressed cache of FontForge source directories
+#
+# To the extent possible under law, the author have dedicated all copyright
+# and related and neighboring rights to this software to the public domain
+# worldwide. This software is distributed without any warranty.
+#
+# You should have received a copy of the CC0 Public Domain Dedication along
+# with this software. If not, see
+# <http://creativecommons.org/publicdomain/zero/1.0/>.
+
+"""Keeps a consolidated single file .sfd snapshot of each .sfdir master.
+
+A .sfdir is a font.props header plus one .glyph file per glyph, and opening
+it means FontForge has to find, open and read every one of the ~6,000 files.
+Here every glyph file is hashed (re-hashing only files whose size or mtime
+changed since the last run), the snapshot is keyed by those hashes and
+font.props, and when a snapshot has to be rebuilt only the changed glyph
+files are read from the disk, everything else is copied from the previous
+snapshot.
+
+This module does not need FontForge, so it can be used by the Python 3 tools
+as well."""
+
+import contextlib
+import errno
+import fcntl
+import hashlib
+import json
+import os
+
+MANIFEST = "manifest.json"
+KEEP = 4 # number of snapshots kept per master
+
+def hashBytes(data):
+    return hashlib.sha1(data).hexdigest()
+
+def readFile(path):
+    with open(path, "rb") as f:
+        return f.read()
+
+def cacheDir(cachedir, sfdir):
+    name = os.path.basename(os.path.normpath(sfdir))
+    return os.path.join(cachedir, "sources", name)
+
+def loadManifest(path):
+    try:
+        with open(path) as f:
+            return json.load(f)
+    except (IOError, OSError, ValueError):
+        return {"files": {}, "snapshots": []}
+
+def saveManifest(path, manifest):
+    tmp = "%s.%d.tmp" % (path, os.getpid())
+    with open(tmp, "w") as f:
+        json.dump(manifest, f, sort_keys=True)
+    os.rename(tmp, path)
+
+def hashSource(sfdir, manifest=None):
+    """Returns a {filename: sha1} dictionary for font.props and every .glyph
+    file in the source directory, reusing the hashes recorded in manifest for
+    files whose size and mtime did not change."""
+
+    known = manifest and manifest["files"] or {}
+    files = {}
+    hashes = {}
+    for name in os.listdir(sfdir):
+        path = os.path.join(sfdir, name)
+        if os.path.isdir(path):
+            # bitmap strikes and the like, not something we know how to
+            # consolidate
+            raise ValueError("unsupported subdirectory in ‘%s’: %s" % (sfdir, name))
+        if name != "font.props" and not name.endswith(".glyph"):
+            continue
+        st = os.stat(path)
+        stamp = [st.st_size, st.st_mtime]
+        if name in known and known[name][:2] == stamp:
+            digest = known[name][2]
+        else:
+            digest = hashBytes(readFile(path))
+        files[name] = stamp + [digest]
+        hashes[name] = digest
+
+    if manifest is not None:
+        manifest["files"] = files
+
+    return hashes
+
+def sourceKey(hashes):
+    """The cache key of a source directory, derived from the hashes of all of
+    its files."""
+
+    key = hashlib.sha1()
+    for name in sorted(hashes):
+        key.update(("%s %s\n" % (name, hashes[name])).encode("utf-8"))
+    return key.hexdigest()
+
+def glyphOrder(data):
+    """Returns the glyph id from the ‘Encoding:’ line of a glyph file, used to
+    keep glyphs in a stable order inside the snapshot."""
+
+    for line in data.split(b"\n"):
+        if line.startswith(b"Encoding:"):
+            return int(line.split()[3]), int(line.split()[1])
+    return -1, -1
+
+def assembleSnapshot(sfdir, hashes, path, previous=None):
+    """Writes a single file .sfd equivalent to the source directory.
+
+    previous is (snapshot path, {filename: [sha1, offset, length, gid, enc]})
+    of an older snapshot, glyphs with unchanged hash are copied from it
+    instead of reading their files again. Returns the index of the new
+    snapshot."""
+
+    old = {}
+    olddata = b""
+    if previous and os.path.exists(previous[0]):
+        olddata = readFile(previous[0])
+        old = previous[1]
+
+    glyphs = []
+    for name in hashes:
+        if name == "font.props":
+            continue
+        if name in old and old[name][0] == hashes[name]:
+            offset, length = old[name][1:3]
+            data = olddata[offset:offset + length]
+            gid, enc = old[name][3:5]
+        else:
+            data = readFile(os.path.join(sfdir, name))
+            if not data.endswith(b"\n"):
+                data += b"\n"
+            gid, enc = glyphOrder(data)
+        glyphs.append((gid, name, enc, data))
+    glyphs.sort()
+
+    props = readFile(os.path.join(sfdir, "font.props")).rstrip()
+    if props.endswith(b"EndSplineFont"):
+        props = props[:-len(b"EndSplineFont")]
+    encsize = max([0x110000] + [g[2] + 1 for g in glyphs])
+    header = props + b"BeginChars: " + str(encsize).encode() + b" " + str(len(glyphs)).encode() + b"\n"
+
+    index = {}
+    tmp = "%s.%d.tmp" % (path, os.getpid())
+    with open(tmp, "wb") as out:
+        out.write(header)
+        offset = len(header)
+        for gid, name, enc, data in glyphs:
+            out.write(b"\n")
+            offset += 1
+            out.write(data)
+            index[name] = [hashes[name], offset, len(data), gid, enc]
+            offset += len(data)
+        out.write(b"EndChars\nEndSplineFont\n")
+    os.rename(tmp, path)
+
+    return index
+
+@contextlib.contextmanager
+def openManifest(sfdir, cachedir):
+    """Yields (cache directory, manifest path, manifest) of a source
+    directory, holding its lock: builds of several fonts from the same
+    master open it at the same time."""
+
+    directory = cacheDir(cachedir, sfdir)
+    if not os.path.isdir(directory):
+        os.makedirs(directory)
+    manifestpath = os.path.join(directory, MANIFEST)
+    with open(manifestpath + ".lock", "w") as lock:
+        fcntl.flock(lock, fcntl.LOCK_EX)
+        yield directory, manifestpath, loadManifest(manifestpath)
+
+def sourceDigest(sfdir, cachedir):
+    """Returns the cache key of a source directory without building a
+    snapshot of it, still reusing (and updating) the recorded hashes."""
+
+    with openManifest(sfdir, cachedir) as (directory, manifestpath, manifest):
+        hashes = hashSource(sfdir, manifest)
+        saveManifest(manifestpath, manifest)
+    return sourceKey(hashes)
+
+def openSource(sfdir, cachedir):
+    """Returns the path of an up to date .sfd snapshot of sfdir, building it
+    if needed. Anything that is not a .sfdir is returned unchanged."""
+
+    if not cachedir or not os.path.isdir(sfdir):
+        return sfdir
+
+    with openManifest(sfdir, cachedir) as (directory, manifestpath, manifest):
+        try:
+            hashes = hashSource(sfdir, manifest)
+        except ValueError as err:
+            print("   CACHE\t%s" % err)
+            return sfdir
+
+        key = sourceKey(hashes)
+        path = os.path.join(directory, key + ".sfd")
+        snapshots = [s for s in manifest["snapshots"] if os.path.exists(os.path.join(directory, s["key"] + ".sfd"))]
+        current = [s for s in snapshots if s["key"] == key]
+
+        if not current:
+            # a snapshot file missing from the manifest has no index, so it is
+            # built again
+            previous = None
+            if snapshots:
+                last = snapshots[-1]
+                previous = (os.path.join(directory, last["key"] + ".sfd"), last["index"])
+            index = assembleSnapshot(sfdir, hashes, path, previous)
+            current = [{"key": key, "index": index}]
+
+        # it goes to the end, it is the most recently used now
+        snapshots = [s for s in snapshots if s["key"] != key] + current
+
+        manifest["snapshots"] = snapshots[-KEEP:]
+        saveManifest(manifestpath, manifest)
+
+        # older snapshots, and any the manifest lost track of
+        keep = set(s["key"] + ".sfd" for s in manifest["snapshots"])
+        for filename in os.listdir(directory):
+            if filename.endswith(".sfd") and filename not in keep:
+                try:
+                    os.remove(os.path.join(directory, filename))
+                except OSError as err:
+                    if err.errno != errno.ENOENT:
+                        raise
+
+    return path
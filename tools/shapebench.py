@@ -0,0 +1,310 @@
+#!/usr/bin/env python3
+# coding=utf-8
+#
+# shapebench.py - Shaping speed benchmark of the compiled fonts
+#
+# To the extent possible under law, the author have dedicated all copyright
+# and related and neighboring rights to this software to the public domain
+# worldwide. This software is distributed without any warranty.
+#
+# You should have received a copy of the CC0 Public Domain Dedication along
+# with this software. If not, see
+# <http://creativecommons.org/publicdomain/zero/1.0/>.
+
+"""Measures how fast HarfBuzz shapes text with each font, for each of the
+language systems of the fonts: the time to create the face and font, the
+time of the first shaping with a new face (which loads the tables and makes
+the shape plan), and the steady state characters and glyphs per second over
+fixed corpora, e.g.:
+
+    shapebench.py --save baseline.json amiri-*.ttf
+    (change the features and rebuild)
+    shapebench.py --baseline baseline.json --threshold 5 amiri-*.ttf
+
+The corpora are the test suite texts and test rows of each language system
+(OFL.txt stands in for Latin prose). Like benchmark.py, the median and spread
+of --repeat runs are recorded, and with --baseline the exit status is 1 if
+anything got slower by more than the threshold. WOFF and WOFF2 fonts are
+decompressed before timing."""
+
+from __future__ import print_function
+
+import argparse
+import glob
+import io
+import json
+import os
+import platform
+import re
+import sys
+import time
+
+from benchmark import median
+from runtest import readTest
+from shaping import Shaper, harfbuzzVersion
+
+FORMAT = 1
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..")
+TESTS = os.path.join(ROOT, "test-suite")
+
+# (name, direction, script, language, text files), the language systems of
+# amiri.fea; there is no Urdu text in the test suite, Pashto is the nearest
+SYSTEMS = (
+    ("arab dflt", "rtl", "arab", "", []),
+    ("arab ARA", "rtl", "arab", "ar", ["ar.txt", "marks.txt", "fatiha.pango"]),
+    ("arab URD", "rtl", "arab", "ur", ["ps.txt"]),
+    ("arab SND", "rtl", "arab", "sd", ["sd.txt"]),
+    ("latn", "ltr", "latn", "", [os.path.join(ROOT, "OFL.txt")]),
+)
+
+# (key, label, unit, scale, higher is better), times are measured in seconds
+# and rates in per second
+METRICS = (
+    ("create", "face+font", "ms", 1000.0, False),
+    ("first", "first shape", "ms", 1000.0, False),
+    ("chars", "chars/s", "k/s", 0.001, True),
+    ("glyphs", "glyphs/s", "k/s", 0.001, True),
+)
+
+# changes smaller than this (in the units above) are noise however big they
+# are relative to the baseline
+NOISE = {"create": 0.05, "first": 0.1, "chars": 0.0, "glyphs": 0.0}
+
+MARKUP = re.compile(r"<[^>]*>")
+
+def readCorpus(system):
+    """The rows of a language system: its text files line by line, and the
+    test suite rows with its script and language."""
+
+    name, direction, script, language, files = system
+    rows = []
+    for filename in files:
+        path = os.path.join(TESTS, filename)
+        with io.open(path, encoding="utf-8") as f:
+            for line in f:
+                line = MARKUP.sub("", line).strip()
+                if line:
+                    rows.append((direction, script, language, "", line))
+
+    for testname in sorted(glob.glob(os.path.join(TESTS, "*.test")) + glob.glob(os.path.join(TESTS, "*.ptest"))):
+        for row in readTest(testname):
+            if row[1] == script and row[2] == language:
+                rows.append(row[:5])
+    return rows
+
+def readFont(path):
+    """The sfnt data of a font, decompressing WOFF and WOFF2."""
+
+    with open(path, "rb") as f:
+        data = f.read()
+    if data[:4] in (b"wOFF", b"wOF2"):
+        from fontTools.ttLib import TTFont
+        font = TTFont(io.BytesIO(data))
+        font.flavor = None
+        out = io.BytesIO()
+        font.save(out)
+        data = out.getvalue()
+    return data
+
+def shapeFor(shaper, rows, mintime):
+    """Shapes the rows over and over for at least mintime seconds, returns
+    (characters, glyphs) per second."""
+
+    chars = sum(len(row[4]) for row in rows)
+    count = passes = 0
+    start = time.perf_counter()
+    while True:
+        results = shaper.shapeMany(rows)
+        count += sum(len(result) for result in results)
+        passes += 1
+        elapsed = time.perf_counter() - start
+        if elapsed >= mintime:
+            break
+    return chars * passes / elapsed, count / elapsed
+
+def measureFont(data, corpora, mintime):
+    """One sample of every metric for one font, returns {name: {key: value}}
+    with the creation time under the font itself and the others under each
+    language system. Every system starts from a new face, so the first
+    shaping is a cold one each time."""
+
+    sample = {"": {"create": []}}
+    for name, rows in corpora:
+        start = time.perf_counter()
+        shaper = Shaper(data=data)
+        created = time.perf_counter()
+        shaper.shapeMany(rows[:1])
+        first = time.perf_counter()
+
+        shaper.shapeMany(rows)
+        chars, glyphs = shapeFor(shaper, rows, mintime)
+
+        sample[""]["create"].append(created - start)
+        sample[name] = {"first": first - created, "chars": chars, "glyphs": glyphs}
+    sample[""]["create"] = median(sample[""]["create"])
+    return sample
+
+def summarize(samples):
+    """Median and spread (half the range) of each metric."""
+
+    result = {}
+    for key in samples[0]:
+        values = [sample[key] for sample in samples]
+        result[key] = {
+            "median": median(values),
+            "spread": (max(values) - min(values)) / 2.0,
+            "samples": values,
+        }
+    return result
+
+def runBenchmark(fonts, corpora, repeat, warmup, mintime):
+    """Measures every font repeat times after warmup runs, returns {entry:
+    summary}, entries are "font" and "font system"."""
+
+    results = {}
+    for path in fonts:
+        # webfonts/amiri-regular.ttf and amiri-regular.ttf are different entries
+        font = os.path.normpath(path)
+        data = readFont(path)
+        samples = []
+        for i in range(warmup + repeat):
+            sample = measureFont(data, corpora, mintime)
+            if i >= warmup:
+                samples.append(sample)
+        for name in samples[0]:
+            entry = name and "%s %s" % (font, name) or font
+            results[entry] = summarize([sample[name] for sample in samples])
+        create = results[font]["create"]
+        print("   BENCH\t%-28s %8.2f ms ±%.2f" % (font, create["median"] * 1000, create["spread"] * 1000))
+        for name, rows in corpora:
+            chars = results["%s %s" % (font, name)]["chars"]
+            print("   BENCH\t%-28s %8.1f kchars/s ±%.1f" % ("%s %s" % (font, name),
+                  chars["median"] / 1000, chars["spread"] / 1000))
+    return results
+
+def formatValue(value, unit, scale):
+    return "%.2f %s ±%.2f" % (value["median"] * scale, unit, value["spread"] * scale)
+
+def report(results):
+    print("")
+    print("%-34s %22s %22s %22s %22s" % (("entry",) + tuple(label for key, label, unit, scale, higher in METRICS)))
+    for name in sorted(results):
+        print(("%-34s %22s %22s %22s %22s" % ((name,) +
+              tuple(key in results[name] and formatValue(results[name][key], unit, scale) or ""
+                    for key, label, unit, scale, higher in METRICS))).rstrip())
+
+def compare(baseline, results, threshold):
+    """Prints the changes from the baseline, returns the list of regressions
+    as (entry, metric) pairs."""
+
+    regressions = []
+    lines = []
+    for name in sorted(results):
+        if name not in baseline:
+            lines.append("%-34s %-11s new entry" % (name, ""))
+            continue
+        for key, label, unit, scale, higher in METRICS:
+            if key not in results[name] or key not in baseline[name]:
+                continue
+            old = baseline[name][key]
+            new = results[name][key]
+            delta = (new["median"] - old["median"]) * scale
+            change = old["median"] and (new["median"] - old["median"]) * 100.0 / old["median"] or 0.0
+            # positive when worse
+            worse = higher and -change or change
+            flag = ""
+            if worse > threshold and abs(delta) > NOISE[key]:
+                flag = "REGRESSION"
+                regressions.append((name, label))
+            elif worse < -threshold and abs(delta) > NOISE[key]:
+                flag = "improved"
+            lines.append("%-34s %-11s %22s %22s %+8.1f%%  %s" % (name, label,
+                         formatValue(old, unit, scale), formatValue(new, unit, scale), change, flag))
+    for name in sorted(set(baseline) - set(results)):
+        lines.append("%-34s %-11s not measured" % (name, ""))
+
+    print("")
+    print("%-34s %-11s %22s %22s %9s" % ("entry", "metric", "baseline", "current", "change"))
+    for line in lines:
+        print(line.rstrip())
+    return regressions
+
+def loadBaseline(path):
+    with open(path) as f:
+        data = json.load(f)
+    if data.get("format") != FORMAT:
+        raise ValueError("%s: unsupported baseline format" % path)
+    return data
+
+def saveBaseline(path, results, args):
+    data = {
+        "format": FORMAT,
+        "harfbuzz": harfbuzzVersion(),
+        "repeat": args.repeat,
+        "time": args.time,
+        "machine": "%s %s, Python %s" % (platform.node(), platform.machine(), platform.python_version()),
+        "date": time.strftime("%Y-%m-%d %H:%M:%S"),
+        "results": results,
+    }
+    tmp = "%s.%d.tmp" % (path, os.getpid())
+    with open(tmp, "w") as f:
+        json.dump(data, f, indent=1, sort_keys=True)
+    os.rename(tmp, path)
+    print("   SAVE\t%s" % path)
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark the shaping speed of the Amiri fonts.")
+    parser.add_argument("fonts", metavar="FONT", nargs="+", help="font files (TTF, OTF, WOFF or WOFF2)")
+    parser.add_argument("--system", metavar="NAME", action="append", choices=[s[0] for s in SYSTEMS],
+            help="language system to measure, e.g. \"arab URD\", can be repeated (default: all)")
+    parser.add_argument("--repeat", metavar="N", type=int, default=5, help="number of measured runs (default: 5)")
+    parser.add_argument("--warmup", metavar="N", type=int, default=1,
+            help="number of unmeasured runs before them (default: 1)")
+    parser.add_argument("--time", metavar="SECONDS", type=float, default=0.5,
+            help="minimum time to shape each corpus for in every run (default: 0.5)")
+    parser.add_argument("--save", metavar="FILE", help="save the results as a baseline")
+    parser.add_argument("--baseline", metavar="FILE", help="compare the results to a saved baseline")
+    parser.add_argument("--threshold", metavar="PERCENT", type=float, default=10,
+            help="slowdown that counts as a regression (default: 10)")
+
+    args = parser.parse_args()
+
+    if args.repeat < 1:
+        parser.error("--repeat must be at least 1")
+
+    baseline = None
+    if args.baseline:
+        try:
+            baseline = loadBaseline(args.baseline)
+        except (IOError, OSError, ValueError) as e:
+            parser.error(str(e))
+
+    corpora = [(system[0], readCorpus(system)) for system in SYSTEMS
+               if not args.system or system[0] in args.system]
+
+    try:
+        results = runBenchmark(args.fonts, corpora, args.repeat, args.warmup, args.time)
+    except (IOError, OSError, ImportError) as e:
+        print("   FAIL\t%s" % e)
+        sys.exit(1)
+
+    report(results)
+
+    if args.save:
+        saveBaseline(args.save, results, args)
+
+    if baseline:
+        if baseline["harfbuzz"] != harfbuzzVersion():
+            print("")
+            print("warning: baseline is for %s" % baseline["harfbuzz"])
+        regressions = compare(baseline["results"], results, args.threshold)
+        if regressions:
+            print("")
+            print("%d regression(s) over the threshold:" % len(regressions))
+            for name, label in regressions:
+                print("   %s (%s)" % (name, label))
+            sys.exit(1)
+
+if __name__ == "__main__":
+    main()
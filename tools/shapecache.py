@@ -0,0 +1,100 @@
+# coding=utf-8
+#
+# shapecache.py - Persistent cache of test shaping results
+#
+# To the extent possible under law, the author have dedicated all copyright
+# and related and neighboring rights to this software to the public domain
+# worldwide. This software is distributed without any warranty.
+#
+# You should have received a copy of the CC0 Public Domain Dedication along
+# with this software. If not, see
+# <http://creativecommons.org/publicdomain/zero/1.0/>.
+
+"""Remembers the formatted shaping result of every (font, test row) pair in
+an SQLite database, so that test rows whose font did not change since the
+last run are answered without shaping them again.
+
+Fonts are identified by the SHA-1 of their bytes and the HarfBuzz version
+that shaped them, rows by (direction, script, language, features, text,
+positions). Only the process that opened the cache writes to it; the results
+of the last KEEP builds of each font file are kept."""
+
+import hashlib
+import os
+import sqlite3
+import time
+
+KEEP = 4 # number of digests kept per font file
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS fonts (
+    name TEXT NOT NULL,
+    font TEXT NOT NULL,
+    used REAL NOT NULL,
+    PRIMARY KEY (name, font)
+);
+CREATE TABLE IF NOT EXISTS results (
+    font TEXT NOT NULL,
+    positions INTEGER NOT NULL,
+    direction TEXT NOT NULL,
+    script TEXT NOT NULL,
+    language TEXT NOT NULL,
+    features TEXT NOT NULL,
+    text TEXT NOT NULL,
+    result TEXT NOT NULL,
+    PRIMARY KEY (font, positions, direction, script, language, features, text)
+);
+"""
+
+class ShapeCache(object):
+    def __init__(self, path):
+        directory = os.path.dirname(path)
+        if directory and not os.path.isdir(directory):
+            os.makedirs(directory)
+        self.db = sqlite3.connect(path)
+        self.db.executescript(SCHEMA)
+        self.stored = 0
+
+    def fontKey(self, fontname, data, version):
+        """The key of the font file fontname with the given bytes, shaped by
+        the given HarfBuzz version."""
+
+        key = "%s %s" % (hashlib.sha1(data).hexdigest(), version)
+        self.db.execute("INSERT OR REPLACE INTO fonts VALUES (?, ?, ?)",
+                        (os.path.basename(fontname), key, time.time()))
+        return key
+
+    def lookup(self, key, positions):
+        """Returns {(direction, script, language, features, text): result}
+        for the font key."""
+
+        cursor = self.db.execute("SELECT direction, script, language, features, text, result FROM results "
+                                 "WHERE font = ? AND positions = ?", (key, int(positions)))
+        return dict((tuple(row[:5]), row[5]) for row in cursor)
+
+    def store(self, key, positions, entries):
+        """Stores (direction, script, language, features, text, result)
+        entries for the font key."""
+
+        self.db.executemany("INSERT OR REPLACE INTO results VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+                            [(key, int(positions)) + tuple(entry) for entry in entries])
+        self.stored += len(entries)
+
+    def prune(self):
+        """Drops the results of all but the KEEP most recently used keys of
+        each font file."""
+
+        keep = set()
+        names = [row[0] for row in self.db.execute("SELECT DISTINCT name FROM fonts")]
+        for name in names:
+            cursor = self.db.execute("SELECT font FROM fonts WHERE name = ? ORDER BY used DESC LIMIT ?", (name, KEEP))
+            keep.update(row[0] for row in cursor)
+        for (key,) in self.db.execute("SELECT DISTINCT font FROM fonts").fetchall():
+            if key not in keep:
+                self.db.execute("DELETE FROM fonts WHERE font = ?", (key,))
+                self.db.execute("DELETE FROM results WHERE font = ?", (key,))
+
+    def close(self):
+        self.prune()
+        self.db.commit()
+        self.db.close()
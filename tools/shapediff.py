@@ -0,0 +1,238 @@
+#!/usr/bin/env python3
+# coding=utf-8
+#
+# shapediff.py - Shaping differences of a text corpus between two font builds
+#
+# To the extent possible under law, the author have dedicated all copyright
+# and related and neighboring rights to this software to the public domain
+# worldwide. This software is distributed without any warranty.
+#
+# You should have received a copy of the CC0 Public Domain Dedication along
+# with this software. If not, see
+# <http://creativecommons.org/publicdomain/zero/1.0/>.
+
+"""Shapes every line of one or more corpora with the old and the new build of
+each style, and writes the lines whose glyphs or positions differ, e.g.:
+
+    shapediff.py --old ../amiri-0.108 --new . test-suite/ar.txt big-corpus.txt
+
+Styles are the font files found in both directories. Corpora are read lazily
+in chunks that worker processes shape, with a bounded number of chunks in
+flight, so memory does not grow with the size of the corpus; differing lines
+are written in corpus order as soon as their chunk is done. The summary at
+the end counts the differing lines by changed glyph, with the first few of
+them for each glyph."""
+
+from __future__ import print_function
+
+import argparse
+import collections
+import io
+import multiprocessing
+import os
+import sys
+
+from glyphorder import openGlyphOrder
+from shaping import Shaper, formatResult
+
+CORPORA = ["ar.txt", "sd.txt", "ps.txt", "marks.txt"]
+
+# the styles, (name, old shaper, old glyph order, new shaper, new glyph order),
+# loaded before forking so that the workers share them
+Styles = []
+
+def findStyles(olddir, newdir, names=None):
+    """The font files present in both directories, or those of the given
+    ones that are."""
+
+    styles = []
+    for name in names or sorted(name for name in os.listdir(newdir)
+                                if os.path.splitext(name)[1].lower() in (".ttf", ".otf")):
+        old, new = os.path.join(olddir, name), os.path.join(newdir, name)
+        if os.path.isfile(old) and os.path.isfile(new):
+            styles.append((name, old, new))
+        elif names:
+            print("   DIFF\t%s is not in both %s and %s, skipped" % (name, olddir, newdir))
+    return styles
+
+def loadStyles(styles, cachedir=None):
+    for name, old, new in styles:
+        Styles.append((name, Shaper(old), openGlyphOrder(old), Shaper(new), openGlyphOrder(new, cachedir)))
+
+def glyphName(token):
+    """The glyph name of a glyph in a formatted result, without position."""
+
+    for separator in "@+":
+        token = token.split(separator, 1)[0]
+    return token
+
+def changedGlyphs(old, new):
+    """The names of the glyphs added, removed or moved between two formatted
+    results."""
+
+    old = collections.Counter(old[1:-1].split("|"))
+    new = collections.Counter(new[1:-1].split("|"))
+    changed = (old - new) + (new - old)
+    return sorted(set(glyphName(token) for token in changed if token))
+
+def shapeChunk(chunk):
+    """Shapes a chunk of (corpus, line number, text) lines with every style,
+    returns (style, corpus, line number, text, old, new, changed glyphs) for
+    the differing ones, or an error message."""
+
+    try:
+        rows = [(None, None, None, None, text) for corpus, lineno, text in chunk]
+        differences = []
+        for name, oldshaper, oldorder, newshaper, neworder in Styles:
+            oldresults = oldshaper.shapeMany(rows)
+            newresults = newshaper.shapeMany(rows)
+            for line, oldresult, newresult in zip(chunk, oldresults, newresults):
+                if oldresult.gids == newresult.gids and oldresult.positions == newresult.positions \
+                   and all(oldorder[gid] == neworder[gid] for gid in oldresult.gids):
+                    continue
+                old = formatResult(oldresult, oldorder, True)
+                new = formatResult(newresult, neworder, True)
+                if old != new:
+                    differences.append((name,) + line + (old, new, changedGlyphs(old, new)))
+        return differences
+    except Exception as e:
+        return "%s: %s" % (type(e).__name__, e)
+
+def readChunks(corpora, size):
+    """Yields lists of up to size (corpus, line number, text), skipping empty
+    lines."""
+
+    chunk = []
+    for corpus in corpora:
+        if corpus == "-":
+            f = io.open(sys.stdin.fileno(), encoding="utf-8", errors="replace", closefd=False)
+        else:
+            f = io.open(corpus, encoding="utf-8", errors="replace")
+        with f:
+            for lineno, line in enumerate(f, 1):
+                line = line.rstrip("\r\n")
+                if not line.strip():
+                    continue
+                chunk.append((corpus, lineno, line))
+                if len(chunk) == size:
+                    yield chunk
+                    chunk = []
+    if chunk:
+        yield chunk
+
+def shapeCorpora(corpora, jobs, size):
+    """Yields the results of shapeChunk() for the chunks of the corpora, in
+    order. At most 4 chunks per worker are queued at a time, unlike
+    Pool.imap() which reads all of its input ahead."""
+
+    chunks = readChunks(corpora, size)
+    if jobs <= 1:
+        for chunk in chunks:
+            yield len(chunk), shapeChunk(chunk)
+        return
+
+    try:
+        context = multiprocessing.get_context("fork")
+    except AttributeError:
+        context = multiprocessing
+    pool = context.Pool(jobs)
+    try:
+        pending = collections.deque()
+        for chunk in chunks:
+            pending.append((len(chunk), pool.apply_async(shapeChunk, (chunk,))))
+            if len(pending) >= 4 * jobs:
+                count, result = pending.popleft()
+                yield count, result.get()
+        while pending:
+            count, result = pending.popleft()
+            yield count, result.get()
+    finally:
+        pool.terminate()
+        pool.join()
+
+class Summary(object):
+    """Differing lines counted by changed glyph, with the first examples
+    locations of each."""
+
+    def __init__(self, examples):
+        self.examples = examples
+        self.lines = 0
+        self.counts = collections.Counter()
+        self.locations = {}
+
+    def add(self, style, corpus, lineno, glyphs):
+        self.lines += 1
+        where = "%s:%d (%s)" % (corpus, lineno, style)
+        for glyph in glyphs:
+            self.counts[glyph] += 1
+            locations = self.locations.setdefault(glyph, [])
+            if len(locations) < self.examples:
+                locations.append(where)
+
+    def write(self, out, top):
+        for glyph, count in self.counts.most_common(top or None):
+            out.write("%6d\t%s\t%s\n" % (count, glyph, ", ".join(self.locations[glyph])))
+
+def writeDifference(out, style, corpus, lineno, text, old, new, glyphs):
+    out.write("%s:%d: %s: %s\n" % (corpus, lineno, style, " ".join(glyphs)))
+    out.write("string:\t%s\n" % text)
+    out.write("old:   \t%s\n" % old)
+    out.write("new:   \t%s\n" % new)
+
+def main():
+    parser = argparse.ArgumentParser(description="Compare the shaping of text corpora with two builds of the fonts.")
+    parser.add_argument("corpora", metavar="FILE", nargs="*",
+            help="text files to shape line by line, - for the standard input (default: the test suite texts)")
+    parser.add_argument("--old", metavar="DIR", required=True, help="directory of the old fonts")
+    parser.add_argument("--new", metavar="DIR", default=".", help="directory of the new fonts (default: .)")
+    parser.add_argument("--font", metavar="NAME", action="append",
+            help="font file name to compare, can be repeated (default: those in both directories)")
+    parser.add_argument("--output", metavar="FILE", help="write the differing lines to FILE instead of the standard output")
+    parser.add_argument("--jobs", metavar="N", type=int, default=multiprocessing.cpu_count(),
+            help="worker processes (default: number of CPUs)")
+    parser.add_argument("--chunk", metavar="N", type=int, default=500, help="lines per worker task (default: 500)")
+    parser.add_argument("--top", metavar="N", type=int, default=50, help="changed glyphs to summarize, 0 for all (default: 50)")
+    parser.add_argument("--examples", metavar="N", type=int, default=3,
+            help="locations to list for each changed glyph (default: 3)")
+    parser.add_argument("--cache", metavar="DIR", help="directory of the glyph name sidecars of the new fonts")
+
+    args = parser.parse_args()
+
+    corpora = args.corpora or [os.path.normpath(os.path.join(os.path.dirname(__file__), "..", "test-suite", name))
+                              for name in CORPORA]
+    for corpus in corpora:
+        if corpus != "-" and not os.path.isfile(corpus):
+            print("shapediff.py: cannot find ‘%s’" % corpus, file=sys.stderr)
+            sys.exit(1)
+    styles = findStyles(args.old, args.new, args.font)
+    if not styles:
+        print("shapediff.py: no fonts to compare in %s and %s" % (args.old, args.new), file=sys.stderr)
+        sys.exit(1)
+    loadStyles(styles, args.cache)
+
+    if args.output:
+        out = io.open(args.output, "w", encoding="utf-8")
+    else:
+        out = io.open(sys.stdout.fileno(), "w", encoding="utf-8", closefd=False)
+
+    summary = Summary(args.examples)
+    lines = 0
+    errors = 0
+    with out:
+        for count, differences in shapeCorpora(corpora, args.jobs, max(args.chunk, 1)):
+            lines += count
+            if not isinstance(differences, list):
+                errors += 1
+                print("shapediff.py: %s" % differences, file=sys.stderr)
+                continue
+            for style, corpus, lineno, text, old, new, glyphs in differences:
+                writeDifference(out, style, corpus, lineno, text, old, new, glyphs)
+                summary.add(style, corpus, lineno, glyphs)
+            out.flush()
+
+    print("   DIFF\t%d lines, %d styles, %d differences" % (lines, len(styles), summary.lines))
+    summary.write(sys.stdout, args.top)
+    sys.exit(1 if summary.lines or errors else 0)
+
+if __name__ == "__main__":
+    main()
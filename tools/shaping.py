@@ -0,0 +1,249 @@
+# coding=utf-8
+#
+# shaping.py - Batch HarfBuzz shaping for the test and build tools
+#
+# To the extent possible under law, the author have dedicated all copyright
+# and related and neighboring rights to this software to the public domain
+# worldwide. This software is distributed without any warranty.
+#
+# You should have received a copy of the CC0 Public Domain Dedication along
+# with this software. If not, see
+# <http://creativecommons.org/publicdomain/zero/1.0/>.
+
+"""Shapes many texts with one font with as little Python work per text as
+possible: rows are grouped by (direction, script, language, features) so the
+features are parsed once per group and HarfBuzz reuses the cached shape plan
+for the whole group, one buffer is cleared and reused for all rows, and the
+results are returned as packed arrays.
+
+The uharfbuzz bindings are used when installed, the GObject introspection
+ones otherwise (e.g. under Python 2 for build_compat.py)."""
+
+import array
+import re
+
+try:
+    import uharfbuzz as hb
+except ImportError:
+    hb = None
+    import gi
+    gi.require_version('HarfBuzz', '0.0')
+    from gi.repository import HarfBuzz
+    from gi.repository import GLib
+
+try:
+    unicode
+except NameError:
+    unicode = str
+
+FEATURE = re.compile(r"^([+-]?)([A-Za-z0-9 ]{1,4})(?:\[(\d*)(?::(\d*))?\])?(?:=(\d+))?$")
+
+def toUnicode(s, encoding='utf-8'):
+    return s if isinstance(s, unicode) else s.decode(encoding)
+
+def splitFeatures(features):
+    """A list of feature strings from the comma separated form used by the
+    test files, or from a list."""
+
+    if not features:
+        return []
+    if isinstance(features, (str, unicode)):
+        features = features.split(',')
+    return [f.strip() for f in features if f.strip()]
+
+def parseFeature(feature):
+    """Parses a HarfBuzz feature string (e.g. "+ss01", "-locl", "kern[3:5]=0")
+    into (tag, value, start, end), end is None for the end of the text."""
+
+    match = FEATURE.match(feature)
+    if not match:
+        raise ValueError("invalid feature: %s" % feature)
+    sign, tag, start, end, value = match.groups()
+    if value is not None:
+        value = int(value)
+    else:
+        value = sign != "-" and 1 or 0
+    start = start and int(start) or 0
+    if end is None:
+        # "tag[3]" applies to the 3rd character only
+        end = start + 1 if match.group(3) else None
+    elif end == "":
+        end = None
+    else:
+        end = int(end)
+    return tag.ljust(4), value, start, end
+
+def harfbuzzVersion():
+    if hb:
+        return "uharfbuzz %s" % hb.version_string()
+    return "gi %s" % HarfBuzz.version_string()
+
+class HbBackend(object):
+    """Native shaping through uharfbuzz."""
+
+    def __init__(self, data):
+        self.face = hb.Face(hb.Blob(data))
+        self.font = hb.Font(self.face)
+        self.upem = self.face.upem
+        self.font.scale = (self.upem, self.upem)
+        self.buffer = hb.Buffer()
+        self.scratch = hb.Buffer()
+
+    def features(self, features):
+        parsed = {}
+        for feature in splitFeatures(features):
+            tag, value, start, end = parseFeature(feature)
+            parsed.setdefault(tag, []).append((start, end if end is not None else 0xFFFFFFFF, value))
+        return parsed
+
+    def shape(self, text, direction, script, language, features, gids, positions):
+        buf = self.buffer
+        buf.clear_contents()
+        buf.add_str(text)
+        if direction:
+            buf.direction = direction
+        if script:
+            buf.script = script
+        if language:
+            buf.language = language
+        if not (direction and script):
+            # guessed on another buffer, guessing on this one would also give
+            # it the language of the locale when the row has none
+            scratch = self.scratch
+            scratch.clear_contents()
+            scratch.add_str(text)
+            if direction:
+                scratch.direction = direction
+            if script:
+                scratch.script = script
+            scratch.guess_segment_properties()
+            buf.direction = scratch.direction
+            buf.script = scratch.script
+        hb.shape(self.font, buf, features)
+
+        for info in buf.glyph_infos:
+            gids.append(info.codepoint)
+        for pos in buf.glyph_positions:
+            positions.extend((pos.x_advance, pos.y_advance, pos.x_offset, pos.y_offset))
+
+class GiBackend(object):
+    """GObject introspection shaping, for where uharfbuzz is not available."""
+
+    def __init__(self, data):
+        blob = HarfBuzz.glib_blob_create(GLib.Bytes.new(data))
+        self.face = HarfBuzz.face_create(blob, 0)
+        self.font = HarfBuzz.font_create(self.face)
+        self.upem = HarfBuzz.face_get_upem(self.face)
+        HarfBuzz.font_set_scale(self.font, self.upem, self.upem)
+        HarfBuzz.ot_font_set_funcs(self.font)
+        self.buffer = HarfBuzz.buffer_create()
+        self.scratch = HarfBuzz.buffer_create()
+
+    def features(self, features):
+        return [HarfBuzz.feature_from_string(f.encode())[1] for f in splitFeatures(features)]
+
+    def shape(self, text, direction, script, language, features, gids, positions):
+        buf = self.buffer
+        HarfBuzz.buffer_clear_contents(buf)
+        HarfBuzz.buffer_add_utf8(buf, text.encode('utf-8'), 0, -1)
+        if language:
+            HarfBuzz.buffer_set_language(buf, HarfBuzz.language_from_string(language.encode()))
+        if direction:
+            HarfBuzz.buffer_set_direction(buf, HarfBuzz.direction_from_string(direction.encode()))
+        if script:
+            HarfBuzz.buffer_set_script(buf, HarfBuzz.script_from_string(script.encode()))
+        if not (direction and script):
+            # see HbBackend.shape()
+            scratch = self.scratch
+            HarfBuzz.buffer_clear_contents(scratch)
+            HarfBuzz.buffer_add_utf8(scratch, text.encode('utf-8'), 0, -1)
+            HarfBuzz.buffer_set_direction(scratch, HarfBuzz.buffer_get_direction(buf))
+            HarfBuzz.buffer_set_script(scratch, HarfBuzz.buffer_get_script(buf))
+            HarfBuzz.buffer_guess_segment_properties(scratch)
+            HarfBuzz.buffer_set_direction(buf, HarfBuzz.buffer_get_direction(scratch))
+            HarfBuzz.buffer_set_script(buf, HarfBuzz.buffer_get_script(scratch))
+        HarfBuzz.shape(self.font, buf, features)
+
+        for info in HarfBuzz.buffer_get_glyph_infos(buf):
+            gids.append(info.codepoint)
+        for pos in HarfBuzz.buffer_get_glyph_positions(buf):
+            positions.extend((pos.x_advance, pos.y_advance, pos.x_offset, pos.y_offset))
+
+class Result(object):
+    """The glyph ids of a shaped text, and their positions as (x advance,
+    y advance, x offset, y offset) quadruples, in packed arrays."""
+
+    __slots__ = ("gids", "positions")
+
+    def __init__(self, gids, positions):
+        self.gids = gids
+        self.positions = positions
+
+    def __len__(self):
+        return len(self.gids)
+
+    def glyphs(self):
+        """Yields (gid, x advance, y advance, x offset, y offset)."""
+
+        positions = self.positions
+        for i, gid in enumerate(self.gids):
+            yield (gid,) + tuple(positions[4 * i:4 * i + 4])
+
+def formatResult(result, glyphorder, positions):
+    """Formats a result as in the test files, "[name|name]", or with
+    positions "[name@x_offset,y_offset+x_advance,y_advance|...]" where the
+    offsets and y advance are left out when zero. glyphorder maps glyph ids
+    to names."""
+
+    if positions:
+        glyphs = []
+        for gid, x_advance, y_advance, x_offset, y_offset in result.glyphs():
+            glyph = glyphorder[gid]
+            if x_offset or y_offset:
+                glyph += "@%d,%d" % (x_offset, y_offset)
+            glyph += "+%d" % x_advance
+            if y_advance:
+                glyph += ",%d" % y_advance
+            glyphs.append(glyph)
+        out = "|".join(glyphs)
+    else:
+        out = "|".join([glyphorder[gid] for gid in result.gids])
+
+    return "[%s]" % out
+
+class Shaper(object):
+    """Shapes texts with one font, given as a file name or its bytes."""
+
+    def __init__(self, fontfile=None, data=None):
+        if data is None:
+            with open(fontfile, "rb") as f:
+                data = f.read()
+        self.data = data
+        self.backend = hb and HbBackend(data) or GiBackend(data)
+        self.upem = self.backend.upem
+
+    def shapeMany(self, rows):
+        """Shapes (direction, script, language, features, text) rows, returns
+        a Result per row in the same order."""
+
+        groups = {}
+        for i, row in enumerate(rows):
+            direction, script, language, features = row[:4]
+            if not isinstance(features, (str, unicode)):
+                features = ",".join(features or ())
+            groups.setdefault((direction, script, language, features), []).append(i)
+
+        results = [None] * len(rows)
+        backend = self.backend
+        for key in sorted(groups, key=lambda k: groups[k][0]):
+            direction, script, language, features = key
+            parsed = backend.features(features)
+            for i in groups[key]:
+                gids = array.array('I')
+                positions = array.array('i')
+                backend.shape(toUnicode(rows[i][4]), direction, script, language, parsed, gids, positions)
+                results[i] = Result(gids, positions)
+        return results
+
+    def shape(self, text, direction=None, script=None, language=None, features=None):
+        return self.shapeMany([(direction, script, language, features, text)])[0]
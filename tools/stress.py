@@ -0,0 +1,312 @@
+#!/usr/bin/env python3
+# coding=utf-8
+#
+# stress.py - Worst case shaping latency finder
+#
+# To the extent possible under law, the author have dedicated all copyright
+# and related and neighboring rights to this software to the public domain
+# worldwide. This software is distributed without any warranty.
+#
+# You should have received a copy of the CC0 Public Domain Dedication along
+# with this software. If not, see
+# <http://creativecommons.org/publicdomain/zero/1.0/>.
+
+"""Shapes generated adversarial Arabic strings of growing length with each
+font, to find inputs that take much longer to shape than typical text or
+that give .notdef glyphs, e.g.:
+
+    stress.py amiri-regular.ttf amiri-quran.ttf --max-length 4096
+
+The strings are made from the characters the font maps, split into letters
+and marks by their GDEF class: long mark stacks, kashida runs, ZWJ chains,
+long runs of letters with no spaces and random mixes of all of these. Every
+family of strings is shaped at doubling lengths, and a power law is fitted
+to its shaping times, an exponent well over 1 means the time grows faster
+than the text. Strings whose time per character is an outlier, or whose
+output has glyph 0, are shrunk to the smallest part that still is, and
+reported. The exit status is 1 if anything was found."""
+
+from __future__ import print_function
+
+import argparse
+import json
+import math
+import os
+import random
+import sys
+import time
+import unicodedata
+
+from fontTools.ttLib import TTFont
+
+from glyphorder import openGlyphOrder
+from shaping import Shaper
+
+KASHIDA = u"\u0640"
+ZWJ = u"\u200D"
+ZWNJ = u"\u200C"
+
+# shortest time (in seconds) that can be an outlier, shorter ones are noise
+FLOOR = 0.00002
+
+# shorter strings are left out of the fits and of the typical time per
+# character, their time is mostly the fixed cost of a shaping
+FIT_LENGTH = 64
+
+# most shaping runs to spend shrinking one input
+SHRINK_BUDGET = 2000
+
+def fontCharacters(fontfile):
+    """Returns (letters, marks) of the Arabic characters the font maps,
+    classified by the GDEF class of their glyphs (or by their Unicode
+    category when there is no GDEF)."""
+
+    font = TTFont(fontfile, lazy=True)
+    cmap = font.getBestCmap()
+    classes = {}
+    if "GDEF" in font and font["GDEF"].table.GlyphClassDef:
+        classes = font["GDEF"].table.GlyphClassDef.classDefs
+    font.close()
+
+    letters = []
+    marks = []
+    for code, glyph in sorted(cmap.items()):
+        char = chr(code)
+        if unicodedata.bidirectional(char) not in ("AL", "NSM"):
+            continue
+        category = unicodedata.category(char)
+        glyphclass = classes.get(glyph)
+        if glyphclass == 3 or (glyphclass is None and category == "Mn"):
+            if category == "Mn":
+                marks.append(char)
+        elif category == "Lo" and char != KASHIDA:
+            letters.append(char)
+    return letters, marks
+
+# generators of the families of strings, (letters, marks, length, random)
+# -> string of about length characters
+
+def markStack(letters, marks, length, rng):
+    return rng.choice(letters) + "".join(rng.choice(marks) for i in range(length - 1))
+
+def kashidaRun(letters, marks, length, rng):
+    text = []
+    while len(text) < length:
+        text.append(rng.choice(letters))
+        text.extend(KASHIDA * rng.randint(1, 8))
+        if marks and rng.random() < 0.5:
+            text.append(rng.choice(marks))
+    return "".join(text[:length])
+
+def zwjChain(letters, marks, length, rng):
+    text = []
+    while len(text) < length:
+        text.append(rng.choice(letters))
+        text.extend(rng.choice((ZWJ, ZWJ, ZWJ + ZWJ, ZWNJ + ZWJ)))
+    return "".join(text[:length])
+
+def noSpaces(letters, marks, length, rng):
+    return "".join(rng.choice(letters) for i in range(length))
+
+def mixed(letters, marks, length, rng):
+    pool = letters + marks + [KASHIDA, ZWJ, ZWNJ]
+    return "".join(rng.choice(pool) for i in range(length))
+
+FAMILIES = (
+    ("marks", markStack),
+    ("kashida", kashidaRun),
+    ("zwj", zwjChain),
+    ("nospace", noSpaces),
+    ("mixed", mixed),
+)
+
+class Tester(object):
+    """Times shaping with one font, and checks its output for glyph 0."""
+
+    def __init__(self, fontfile, language, runs):
+        self.shaper = Shaper(fontfile)
+        self.glyphorder = openGlyphOrder(fontfile)
+        self.language = language
+        self.runs = runs
+        self.shapings = 0
+
+    def shape(self, text):
+        """Returns (best time of the runs, result)."""
+
+        best = None
+        for i in range(self.runs):
+            start = time.perf_counter()
+            result = self.shaper.shape(text, "rtl", "arab", self.language)
+            elapsed = time.perf_counter() - start
+            if best is None or elapsed < best:
+                best = elapsed
+        self.shapings += self.runs
+        return best, result
+
+    def notdef(self, text):
+        return 0 in self.shape(text)[1].gids
+
+    def slow(self, text, perchar, factor):
+        elapsed = self.shape(text)[0]
+        return elapsed > FLOOR and elapsed > factor * perchar * len(text)
+
+def shrink(text, fails, budget=SHRINK_BUDGET):
+    """The smallest part of text that still fails, removing ever smaller
+    slices of it as long as that keeps it failing (delta debugging)."""
+
+    parts = 2
+    tries = 0
+    while len(text) > 1 and tries < budget:
+        size = int(math.ceil(len(text) / float(parts)))
+        for start in range(0, len(text), size):
+            candidate = text[:start] + text[start + size:]
+            tries += 1
+            if candidate and fails(candidate):
+                text = candidate
+                parts = max(parts - 1, 2)
+                break
+        else:
+            if parts >= len(text):
+                break
+            parts = min(parts * 2, len(text))
+    return text
+
+def fitPower(points):
+    """Least squares fit of time = a * length ** exponent to (length, time)
+    points, returns (a, exponent)."""
+
+    xs = [math.log(length) for length, elapsed in points]
+    ys = [math.log(max(elapsed, 1e-9)) for length, elapsed in points]
+    n = len(xs)
+    mx = sum(xs) / n
+    my = sum(ys) / n
+    sxx = sum((x - mx) ** 2 for x in xs)
+    if not sxx:
+        return math.exp(my), 0.0
+    exponent = sum((x - mx) * (y - my) for x, y in zip(xs, ys)) / sxx
+    return math.exp(my - exponent * mx), exponent
+
+def median(values):
+    values = sorted(values)
+    middle = len(values) // 2
+    if len(values) % 2:
+        return values[middle]
+    return (values[middle - 1] + values[middle]) / 2.0
+
+def lengths(maximum):
+    length = 4
+    while length <= maximum:
+        yield length
+        length *= 2
+
+def describe(text):
+    return " ".join("U+%04X" % ord(c) for c in text)
+
+def stressFont(fontfile, args):
+    """Runs every family on one font, prints what it finds and returns it
+    as a dict."""
+
+    letters, marks = fontCharacters(fontfile)
+    if not letters:
+        print("   STRESS\t%s: no Arabic letters, skipped" % fontfile)
+        return None
+    tester = Tester(fontfile, args.language, args.runs)
+    rng = random.Random(args.seed)
+    # the first shaping loads the tables and makes the shape plan
+    tester.shape(letters[0])
+
+    samples = []  # (family, length, text, time, notdef)
+    for name, generate in FAMILIES:
+        if args.family and name not in args.family:
+            continue
+        if not marks and generate is markStack:
+            continue
+        for length in lengths(args.max_length):
+            for i in range(args.samples):
+                text = generate(letters, marks, length, rng)
+                elapsed, result = tester.shape(text)
+                samples.append((name, len(text), text, elapsed, 0 in result.gids))
+
+    long = [s for s in samples if s[1] >= FIT_LENGTH] or samples
+    perchar = median([elapsed / length for name, length, text, elapsed, notdef in long])
+    report = {"font": fontfile, "us per char": perchar * 1e6, "families": {}, "findings": []}
+
+    for name, generate in FAMILIES:
+        points = {}
+        for family, length, text, elapsed, notdef in long:
+            if family == name:
+                points.setdefault(length, []).append(elapsed)
+        if len(points) < 2:
+            continue
+        a, exponent = fitPower([(length, median(times)) for length, times in sorted(points.items())])
+        flag = exponent > args.max_exponent and "SUPERLINEAR" or ""
+        print("   STRESS\t%s %-8s exponent %.2f, %.2f us/char at %d chars  %s" % (os.path.basename(fontfile),
+              name, exponent, median(points[max(points)]) * 1e6 / max(points), max(points), flag))
+        report["families"][name] = {"exponent": exponent, "superlinear": bool(flag)}
+
+    # the shortest failing inputs of each family and kind are shrunk
+    for kind in ("notdef", "slow"):
+        for name, generate in FAMILIES:
+            if kind == "notdef":
+                failing = [s for s in samples if s[0] == name and s[4]]
+                fails = tester.notdef
+            else:
+                failing = [s for s in long if s[0] == name and s[3] > FLOOR and s[3] > args.factor * perchar * s[1]]
+                fails = lambda text: tester.slow(text, perchar, args.factor)
+            for family, length, text, elapsed, notdef in sorted(failing, key=lambda s: s[1])[:args.examples]:
+                small = shrink(text, fails)
+                if any(f["kind"] == kind and f["text"] == small for f in report["findings"]):
+                    continue
+                elapsed, result = tester.shape(small)
+                glyphs = [tester.glyphorder[gid] for gid in result.gids]
+                print("   %s\t%s %s, %d chars shrunk to %d, %.1f us (%.1fx typical): %s" % (kind.upper(),
+                      os.path.basename(fontfile), name, length, len(small), elapsed * 1e6,
+                      elapsed / (perchar * len(small)), describe(small)))
+                if kind == "notdef":
+                    print("\t[%s]" % "|".join(glyphs))
+                report["findings"].append({"kind": kind, "family": name, "length": length, "text": small,
+                                           "time": elapsed, "glyphs": glyphs})
+
+    print("   STRESS\t%s: %d inputs, %.2f us/char typical, %d shapings" % (os.path.basename(fontfile),
+          len(samples), perchar * 1e6, tester.shapings))
+    return report
+
+def main():
+    parser = argparse.ArgumentParser(description="Look for inputs that are slow to shape or give .notdef.")
+    parser.add_argument("fonts", metavar="FONT", nargs="+", help="fonts to test")
+    parser.add_argument("--family", metavar="NAME", action="append", choices=[f[0] for f in FAMILIES],
+            help="family of strings to generate, can be repeated (default: all)")
+    parser.add_argument("--max-length", metavar="N", type=int, default=2048,
+            help="longest string to generate, lengths double from 4 (default: 2048)")
+    parser.add_argument("--samples", metavar="N", type=int, default=3,
+            help="strings per family and length (default: 3)")
+    parser.add_argument("--runs", metavar="N", type=int, default=3, help="timed runs per string, the best is kept (default: 3)")
+    parser.add_argument("--factor", metavar="X", type=float, default=10,
+            help="time per character over the typical one that makes an outlier (default: 10)")
+    parser.add_argument("--max-exponent", metavar="X", type=float, default=1.3,
+            help="scaling exponent over which a family is reported (default: 1.3)")
+    parser.add_argument("--examples", metavar="N", type=int, default=3,
+            help="failing inputs to shrink per family (default: 3)")
+    parser.add_argument("--language", metavar="LANG", default="ar", help="language to shape with (default: ar)")
+    parser.add_argument("--seed", metavar="N", type=int, default=0, help="random seed (default: 0)")
+    parser.add_argument("--json", metavar="FILE", help="write the findings to FILE")
+
+    args = parser.parse_args()
+
+    reports = []
+    for fontfile in args.fonts:
+        report = stressFont(fontfile, args)
+        if report:
+            reports.append(report)
+
+    if args.json:
+        tmp = "%s.%d.tmp" % (args.json, os.getpid())
+        with open(tmp, "w") as f:
+            json.dump(reports, f, indent=1, sort_keys=True, ensure_ascii=False)
+        os.rename(tmp, args.json)
+
+    found = [r for r in reports if r["findings"] or any(f["superlinear"] for f in r["families"].values())]
+    sys.exit(1 if found else 0)
+
+if __name__ == "__main__":
+    main()